@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+from lib.benchmarks import (
+    analyzer_benchmark,
+    batch_query_benchmark,
+    ann_benchmark,
+    binary_benchmark,
+    bm25_benchmark,
+    build_scaling_benchmark,
+    chunk_metadata_benchmark,
+    embedding_build_benchmark,
+    encoding_benchmark,
+    fusion_benchmark,
+    index_load_benchmark,
+    postings_benchmark,
+    quantization_benchmark,
+    result_cache_benchmark,
+    semantic_benchmark,
+    startup_benchmark,
+    threshold_fusion_benchmark,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    index_load_parser = subparsers.add_parser(
+        "index-load",
+        help="Compare load time and memory of the pickled and memory-mapped keyword index",
+    )
+    index_load_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+        help="Synthetic corpus sizes to benchmark",
+    )
+
+    bm25_parser = subparsers.add_parser(
+        "bm25", help="Compare the legacy and vectorized BM25 search latency"
+    )
+    bm25_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000, 1_000_000],
+        help="Synthetic corpus sizes to benchmark",
+    )
+    bm25_parser.add_argument(
+        "--limit", type=int, default=10, help="Number of results per query"
+    )
+
+    subparsers.add_parser(
+        "analyzer",
+        help="Tokenizer throughput in tokens/sec on the movies corpus, before and after the Analyzer",
+    )
+
+    build_parser = subparsers.add_parser(
+        "build", help="Inverted index build time with 1 to N worker processes"
+    )
+    build_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Highest number of workers to try (default: all cores)",
+    )
+    build_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Build over the movies corpus repeated this many times",
+    )
+
+    postings_parser = subparsers.add_parser(
+        "postings",
+        help="Compare size and BM25 latency of raw and compressed postings",
+    )
+    postings_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+        help="Synthetic corpus sizes to benchmark",
+    )
+    postings_parser.add_argument(
+        "--limit", type=int, default=10, help="Number of results per query"
+    )
+
+    semantic_parser = subparsers.add_parser(
+        "semantic",
+        help="Compare the per-chunk cosine loop and the matrix chunk search latency",
+    )
+    semantic_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100_000, 1_000_000],
+        help="Numbers of synthetic chunk embeddings to benchmark",
+    )
+    semantic_parser.add_argument(
+        "--limit", type=int, default=10, help="Number of results per query"
+    )
+
+    ann_parser = subparsers.add_parser(
+        "ann",
+        help="Recall@k and queries per second of the IVF chunk search against exact search",
+    )
+    ann_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100_000, 1_000_000],
+        help="Numbers of synthetic chunk embeddings to benchmark",
+    )
+    ann_parser.add_argument(
+        "--limit", type=int, default=10, help="k of recall@k, results per query"
+    )
+    ann_parser.add_argument(
+        "--nprobes",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16, 64],
+        help="Numbers of IVF lists to probe",
+    )
+    ann_parser.add_argument(
+        "--golden",
+        action="store_true",
+        help="Use the movie chunk embeddings and the golden dataset queries instead (loads the model)",
+    )
+
+    quantization_parser = subparsers.add_parser(
+        "quantization",
+        help="Matrix size, chunk search latency and recall of float32, float16 and int8 embeddings",
+    )
+    quantization_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100_000, 1_000_000],
+        help="Numbers of synthetic chunk embeddings to benchmark",
+    )
+    quantization_parser.add_argument(
+        "--limit", type=int, default=10, help="k of recall@k, results per query"
+    )
+
+    binary_parser = subparsers.add_parser(
+        "binary",
+        help="Scan cost, latency and recall of the sign bit hamming prefilter against exact chunk search",
+    )
+    binary_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100_000, 1_000_000],
+        help="Numbers of synthetic chunk embeddings to benchmark",
+    )
+    binary_parser.add_argument(
+        "--limit", type=int, default=10, help="k of recall@k, results per query"
+    )
+    binary_parser.add_argument(
+        "--candidates",
+        type=int,
+        nargs="+",
+        default=[500, 2000, 8000],
+        help="Numbers of hamming candidates to rescore",
+    )
+
+    chunk_metadata_parser = subparsers.add_parser(
+        "chunk-metadata",
+        help="File size, load time and memory of json and columnar chunk metadata",
+    )
+    chunk_metadata_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100_000, 1_000_000],
+        help="Numbers of synthetic chunks to benchmark",
+    )
+
+    embedding_build_parser = subparsers.add_parser(
+        "embedding-build",
+        help="Build time and peak memory of one-shot vs streaming embedding builds",
+    )
+    embedding_build_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100_000, 500_000],
+        help="Numbers of synthetic texts to embed",
+    )
+
+    encoding_parser = subparsers.add_parser(
+        "encoding",
+        help="Texts/sec of chunk encoding in one process vs pools of worker processes (loads the model)",
+    )
+    encoding_parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Numbers of worker processes to try",
+    )
+    encoding_parser.add_argument(
+        "--texts",
+        type=int,
+        default=20_000,
+        help="Number of movie chunks to encode",
+    )
+
+    fusion_parser = subparsers.add_parser(
+        "fusion",
+        help="Time and memory allocated per query by dict vs array score fusion",
+    )
+    fusion_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000],
+        help="Numbers of candidates each retriever returns",
+    )
+    fusion_parser.add_argument(
+        "--limit", type=int, default=10, help="Number of fused results"
+    )
+
+    batch_parser = subparsers.add_parser(
+        "batch-queries",
+        help="Queries/sec of rrf search over the golden dataset one query at a time vs in one batch (loads the model)",
+    )
+    batch_parser.add_argument(
+        "--limit", type=int, default=5, help="Number of fused results per query"
+    )
+    batch_parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per search, the fastest is kept"
+    )
+
+    result_cache_parser = subparsers.add_parser(
+        "result-cache",
+        help="Queries/sec and hit rate of rrf search on a zipf stream of golden dataset queries with and without the result cache (loads the model)",
+    )
+    result_cache_parser.add_argument(
+        "--queries", type=int, default=1000, help="Length of the query stream"
+    )
+    result_cache_parser.add_argument(
+        "--max-kib",
+        type=int,
+        nargs="+",
+        default=[8, 64, 1024],
+        help="Memory limits of the result cache to try, in KiB",
+    )
+
+    threshold_parser = subparsers.add_parser(
+        "threshold-fusion",
+        help="Time per rrf search and list depth read with full vs threshold fusion over the golden dataset queries (loads the model)",
+    )
+    threshold_parser.add_argument(
+        "--limits",
+        type=int,
+        nargs="+",
+        default=[1, 5, 10, 50],
+        help="Numbers of fused results to benchmark",
+    )
+    threshold_parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per search, the fastest is kept"
+    )
+
+    startup_parser = subparsers.add_parser(
+        "startup",
+        help="Wall and import time of each CLI command in a fresh interpreter (-X importtime)",
+    )
+    startup_parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per command, the fastest is kept"
+    )
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "index-load":
+            index_load_benchmark(args.sizes)
+        case "bm25":
+            bm25_benchmark(args.sizes, args.limit)
+        case "analyzer":
+            analyzer_benchmark()
+        case "build":
+            build_scaling_benchmark(args.workers, args.repeat)
+        case "postings":
+            postings_benchmark(args.sizes, args.limit)
+        case "semantic":
+            semantic_benchmark(args.sizes, args.limit)
+        case "ann":
+            ann_benchmark(args.sizes, args.limit, args.nprobes, args.golden)
+        case "quantization":
+            quantization_benchmark(args.sizes, args.limit)
+        case "binary":
+            binary_benchmark(args.sizes, args.limit, args.candidates)
+        case "chunk-metadata":
+            chunk_metadata_benchmark(args.sizes)
+        case "embedding-build":
+            embedding_build_benchmark(args.sizes)
+        case "encoding":
+            encoding_benchmark(args.workers, args.texts)
+        case "fusion":
+            fusion_benchmark(args.sizes, args.limit)
+        case "batch-queries":
+            batch_query_benchmark(args.limit, args.repeat)
+        case "result-cache":
+            result_cache_benchmark(args.queries, args.max_kib)
+        case "threshold-fusion":
+            threshold_fusion_benchmark(args.limits, args.repeat)
+        case "startup":
+            startup_benchmark(args.repeat)
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
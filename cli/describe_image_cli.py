@@ -1,8 +1,10 @@
 import argparse
 import mimetypes
-from google.genai import types
 
 from lib.gemini_utils import generate_response_parts
+from lib.resources import lazy_import
+
+types = lazy_import("google.genai.types")
 
 
 def main():
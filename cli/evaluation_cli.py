@@ -1,8 +1,11 @@
 import argparse
 import json
 
-from lib.search_utils import GOLDEN_DATASET_PATH
-from lib.hybrid_search import rrf_search
+from lib.search_utils import GOLDEN_DATASET_PATH, load_movies
+from lib.hybrid_search import HybridSearch, format_timing_stats
+from lib.query_cache import format_query_cache_stats, get_query_cache
+from lib.result_cache import format_result_cache_stats
+from lib.semantic_search import SEMANTIC_MODEL
 
 
 def main():
@@ -24,10 +27,14 @@ def main():
 
     print(f"k={limit}\n")
 
-    for test_case in golden_dataset["test_cases"]:
-        query, relevant_docs = test_case.values()
-        result = rrf_search(query, k=60, limit=limit)
+    # indexes and embeddings loaded once for every query
+    hs = HybridSearch(load_movies())
 
+    test_cases = [test_case.values() for test_case in golden_dataset["test_cases"]]
+    # every query searched in one batch
+    results = hs.rrf_search_many([query for query, _ in test_cases], k=60, limit=limit)
+
+    for (query, relevant_docs), result in zip(test_cases, results):
         # check how many correct results was found
         correct_count = 0
         retrieved_titles = []
@@ -48,6 +55,10 @@ def main():
         print(f"    - Retrieved: {', '.join(retrieved_titles)}")
         print(f"    - Relevant: {', '.join(relevant_docs)}\n")
 
+    print(format_query_cache_stats(get_query_cache(SEMANTIC_MODEL).stats()))
+    print(format_result_cache_stats(hs.result_cache.stats()))
+    print(format_timing_stats(hs.timing_stats()))
+
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,9 @@
 import argparse
 
+from lib.fusion import FUSION_STRATEGIES, RRF_K, SCORE_NORMALIZATIONS
 from lib.hybrid_search import (
+    HYBRID_CANDIDATE_MULTIPLIER,
+    fusion_search,
     normalize_scores,
     weighed_search,
     rrf_search,
@@ -10,6 +13,30 @@ from lib.hybrid_search import (
 from lib.gemini_utils import evaluate_results
 
 
+def add_depth_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--depth",
+        type=int,
+        help=f"Candidates each retriever returns before fusion (default limit * {HYBRID_CANDIDATE_MULTIPLIER}, at most the number of movies)",
+    )
+
+
+def add_cache_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Search again instead of reusing cached results of the same query and options",
+    )
+
+
+def add_threshold_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--threshold",
+        action="store_true",
+        help="Read the ranked results of both retrievers only as deep as the top results can still change (same results)",
+    )
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
     subparser = parser.add_subparsers(dest="command", help="Available commands")
@@ -38,6 +65,9 @@ def main() -> None:
     weighed_search_parser.add_argument(
         "--limit", type=int, default=5, help="how many results to show"
     )
+    add_depth_argument(weighed_search_parser)
+    add_cache_argument(weighed_search_parser)
+    add_threshold_argument(weighed_search_parser)
 
     rrf_search_parser = subparser.add_parser(
         "rrf-search",
@@ -53,6 +83,9 @@ def main() -> None:
     rrf_search_parser.add_argument(
         "--limit", type=int, default=5, help="how many results to show"
     )
+    add_depth_argument(rrf_search_parser)
+    add_cache_argument(rrf_search_parser)
+    add_threshold_argument(rrf_search_parser)
     rrf_search_parser.add_argument(
         "--enhance",
         type=str,
@@ -76,6 +109,33 @@ def main() -> None:
         help="Enable debug output",
     )
 
+    fusion_search_parser = subparser.add_parser(
+        "fusion-search",
+        help="combines BM25 and semantic search results with a chosen fusion strategy",
+    )
+    fusion_search_parser.add_argument("query", type=str, help="Your search query")
+    fusion_search_parser.add_argument(
+        "--strategy",
+        type=str,
+        choices=FUSION_STRATEGIES,
+        default="combsum",
+        help="combsum adds the normalized scores, combmnz also multiplies by how many retrievers found the movie, weighted averages them, rrf uses the ranks (default combsum)",
+    )
+    fusion_search_parser.add_argument(
+        "--normalization",
+        type=str,
+        choices=SCORE_NORMALIZATIONS,
+        default="minmax",
+        help="how each retriever's scores are normalized before fusing (default minmax)",
+    )
+    fusion_search_parser.add_argument(
+        "--k", default=RRF_K, type=int, help=f"k of the rrf strategy (default {RRF_K})"
+    )
+    fusion_search_parser.add_argument(
+        "--limit", type=int, default=5, help="how many results to show"
+    )
+    add_depth_argument(fusion_search_parser)
+
     args = parser.parse_args()
 
     match args.command:
@@ -84,7 +144,23 @@ def main() -> None:
             for s in normalized_scores:
                 print(f"* {s:.4f}")
         case "weighted-search":
-            weighed_search(args.query, args.alpha, args.limit)
+            weighed_search(
+                args.query,
+                args.alpha,
+                args.limit,
+                args.depth,
+                not args.no_cache,
+                args.threshold,
+            )
+        case "fusion-search":
+            fusion_search(
+                args.query,
+                args.strategy,
+                args.limit,
+                args.depth,
+                args.normalization,
+                args.k,
+            )
         case "rrf-search":
             result = rrf_search(
                 args.query,
@@ -93,6 +169,9 @@ def main() -> None:
                 args.enhance,
                 args.rerank_method,
                 args.debug,
+                args.depth,
+                cache_results=not args.no_cache,
+                threshold=args.threshold,
             )
             print_results(result, args.rerank_method)
             if args.evaluate:
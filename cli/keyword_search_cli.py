@@ -6,10 +6,14 @@ from lib.search_utils import BM25_K1, BM25_B
 
 from lib.keyword_search import (
     bm25_idf_command,
+    bm25_pruned_search_command,
     bm25_tf_command,
+    apply_delta_command,
     bm25_search_command,
     build_command,
+    convert_command,
     idf_command,
+    merge_command,
     search_command,
     tf_command,
     tfidf_command,
@@ -20,10 +24,64 @@ def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    subparsers.add_parser("build", help="Build the inverted index")
+    build_parser = subparsers.add_parser("build", help="Build the inverted index")
+    build_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to tokenize the corpus with (default 1)",
+    )
+    build_parser.add_argument(
+        "--memory-budget",
+        type=float,
+        help="Stream the corpus and build the array index within roughly this many MB, for corpora larger than RAM",
+    )
+    build_parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Store postings delta + variable byte encoded",
+    )
+    build_parser.add_argument(
+        "--positions",
+        action="store_true",
+        help='Also index token positions, needed for "quoted phrase" searches',
+    )
+
+    convert_parser = subparsers.add_parser(
+        "convert",
+        help="Convert a pickled inverted index to the memory-mapped array format",
+    )
+    convert_parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Store postings delta + variable byte encoded",
+    )
+
+    apply_delta_parser = subparsers.add_parser(
+        "apply-delta",
+        help="Add, update and delete documents from a JSONL delta file without rebuilding",
+    )
+    apply_delta_parser.add_argument(
+        "delta_path",
+        type=str,
+        help='JSONL file with {"op": "add"|"update", "movie": {...}} or {"op": "delete", "id": 1} per line',
+    )
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="Merge the delta segments of the index into one"
+    )
+    merge_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Also merge the base segment, dropping every deleted document",
+    )
 
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
-    search_parser.add_argument("query", type=str, help="Search query")
+    search_parser.add_argument(
+        "query",
+        type=str,
+        help='Search query: words match any of them, combine with AND, OR, NOT and parentheses; "quoted phrases" must match exactly and "phrase"~N within N extra words',
+    )
 
     tf_parser = subparsers.add_parser(
         "tf", help="Get term frequency for a given document ID and term"
@@ -65,19 +123,52 @@ def main() -> None:
         "bm25search", help="Search movies using full BM25 scoring"
     )
     bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument(
+        "--pruned",
+        action="store_true",
+        help="Skip documents that can't reach the top results using block-max bounds",
+    )
 
     args = parser.parse_args()
 
     match args.command:
         case "build":
             print("Building inverted index...")
-            build_command()
+            if args.memory_budget is not None and args.positions:
+                parser.error("--positions is not supported with --memory-budget")
+            build_command(
+                args.workers, args.memory_budget, args.compress, args.positions
+            )
             print("Inverted index built successfully.")
+        case "convert":
+            print("Converting pickled index to array format...")
+            convert_command(args.compress)
+            print("Index converted successfully.")
+        case "apply-delta":
+            counts = apply_delta_command(args.delta_path)
+            print(
+                f"Added {counts['added']}, updated {counts['updated']}, deleted {counts['deleted']}"
+                f" documents ({counts['missing']} deletes of unknown ids ignored)"
+            )
+        case "merge":
+            print("Merging index segments...")
+            merge_command(args.full)
+            print("Segments merged successfully.")
         case "search":
             print("Searching for:", args.query)
-            results = search_command(args.query)
+            try:
+                results, stats = search_command(args.query)
+            except ValueError as e:
+                # malformed queries, and phrases on an index built without --positions
+                parser.error(str(e))
             for i, res in enumerate(results, 1):
                 print(f"{i}. ({res['id']}) {res['title']}")
+            if stats:
+                print(
+                    f"Matching: {stats['match_ms']:.2f} ms ({stats['matches']} documents"
+                    f", {stats['postings_read']}/{stats['postings_total']} postings read)"
+                    f", scoring: {stats['scoring_ms']:.2f} ms"
+                )
         case "tf":
             tf = tf_command(args.doc_id, args.term)
             print(f"Term frequency of '{args.term}' in document '{args.doc_id}': {tf}")
@@ -98,11 +189,20 @@ def main() -> None:
                 f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}"
             )
         case "bm25search":
-            search_result = bm25_search_command(args.query)
+            if args.pruned:
+                search_result, stats = bm25_pruned_search_command(args.query)
+            else:
+                search_result = bm25_search_command(args.query)
             print(f"Search results for query: {args.query}")
 
             for i, (doc, score) in enumerate(search_result, 1):
                 print(f"{i}. ({doc['id']}) {doc['title']} - Score: {score:.2f}")
+            if args.pruned:
+                print(
+                    f"Postings scored: {stats['postings_scored']}/{stats['postings_total']}"
+                    f", skipped: {stats['postings_skipped']}"
+                    f", windows skipped: {stats['windows_skipped']}"
+                )
         case _:
             parser.print_help()
 
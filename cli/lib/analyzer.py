@@ -0,0 +1,53 @@
+import string
+import sys
+from functools import cache, lru_cache
+
+from nltk.stem import PorterStemmer
+
+from .search_utils import load_stopwords
+
+# How many distinct words keep their stem cached, movie descriptions use far fewer
+STEM_CACHE_SIZE = 100_000
+
+
+class Analyzer:
+    # Lowercase -> strip punctuation -> split -> drop stopwords -> Porter stem, with all setup done once
+    def __init__(self, stopwords, stem_cache_size: int = STEM_CACHE_SIZE) -> None:
+        self.stopwords = frozenset(stopwords)
+        self.punctuation_table = str.maketrans("", "", string.punctuation)
+        self.stemmer = PorterStemmer()
+        # interned so equal stems are one object, pickled indexes then don't depend on the cache
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.__stem)
+
+    def __stem(self, word: str) -> str:
+        return sys.intern(self.stemmer.stem(word))
+
+    def preprocess(self, text: str) -> str:
+        return text.lower().translate(self.punctuation_table)
+
+    def tokenize(self, text: str) -> list[str]:
+        stopwords, stem = self.stopwords, self.stem
+        return [
+            stem(word)
+            for word in self.preprocess(text).split()
+            if word not in stopwords
+        ]
+
+    def tokenize_positions(self, text: str) -> tuple[list[str], list[int]]:
+        # tokens with their index among all the words, stopwords included, so words with a
+        # stopword between them are not adjacent
+        stopwords, stem = self.stopwords, self.stem
+        tokens, positions = [], []
+        for position, word in enumerate(self.preprocess(text).split()):
+            if word not in stopwords:
+                tokens.append(stem(word))
+                positions.append(position)
+        return tokens, positions
+
+    def tokenize_many(self, texts) -> list[list[str]]:
+        return [self.tokenize(text) for text in texts]
+
+
+@cache
+def get_analyzer() -> Analyzer:
+    return Analyzer(load_stopwords())
@@ -0,0 +1,955 @@
+import json
+import multiprocessing
+import os
+import resource
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import numpy as np
+from nltk.stem import PorterStemmer
+
+from .analyzer import Analyzer
+from .binary_codes import BinaryCodes
+from .bm25 import BM25Scorer
+from .chunk_metadata import CHUNK_METADATA_FILES, ChunkMetadata
+from .embedding_build import stream_embeddings
+from .embedding_cache import EmbeddingCache
+from .encoding_pool import EncodingPool
+from .fusion import DocIndex, FusionCandidates, fuse, top_k_candidates
+from .index_arrays import ArrayIndex
+from .ivf_index import IVFIndex
+from .quantization import (
+    EMBEDDING_PRECISIONS,
+    full_precision_embeddings,
+    load_embeddings,
+)
+from .keyword_search import InvertedIndex, tokenize_text
+from .query_cache import QueryEmbeddingCache
+from .result_cache import ResultCache, format_result_cache_stats
+from .resources import lazy_import, sentence_transformer
+from .search_utils import (
+    GOLDEN_DATASET_PATH,
+    PROJECT_ROOT,
+    load_movies,
+    load_stopwords,
+)
+from .vector_search import (
+    RESCORE_OVERSAMPLING,
+    ChunkGroups,
+    normalize_rows,
+    top_k_movies,
+)
+
+SYNTHETIC_VOCAB_SIZE = 50_000
+
+# legacy scoring sums the doc lengths for every posting, anything bigger takes hours
+LEGACY_BM25_MAX_DOCS = 10_000
+
+# the per chunk cosine loop takes seconds per query past this
+LEGACY_SEMANTIC_MAX_CHUNKS = 100_000
+
+# all-MiniLM-L6-v2 embedding size
+EMBEDDING_DIM = 384
+
+# synthetic chunks are noisy copies of this many topic vectors, so they have real neighbours
+SYNTHETIC_TOPICS = 1_000
+
+SYNTHETIC_ANN_QUERIES = 200
+
+SYNTHETIC_QUERIES = ["t1", "t2 t7", "t5 t40 t300", "t120 t2500", "t9000 t30000"]
+
+# command lines the startup benchmark runs, relative to cli/, none of them needs a model
+STARTUP_COMMANDS = [
+    ["keyword_search_cli.py", "--help"],
+    ["semantic_search_cli.py", "--help"],
+    ["semantic_search_cli.py", "chunk", "A bear chases a man through the woods."],
+    ["hybrid_search_cli.py", "--help"],
+    ["hybrid_search_cli.py", "normalize", "0.5", "2.3", "1.2"],
+    ["evaluation_cli.py", "--help"],
+    ["augmented_generation_cli.py", "--help"],
+    ["multimodal_search_cli.py", "--help"],
+    ["describe_image_cli.py", "--help"],
+]
+
+# imports that should only happen once a command really needs a model or client
+HEAVY_MODULES = ("torch", "sentence_transformers", "google.genai", "PIL")
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except OSError:
+        # peak instead of current rss, still good enough to compare formats
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthetic_index(num_docs: int, cache_dir: str, seed: int = 42) -> InvertedIndex:
+    # zipf distributed terms so postings lengths look like a real corpus
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(5, 40, num_docs)
+    tokens = (rng.zipf(1.3, int(lengths.sum())) % SYNTHETIC_VOCAB_SIZE).tolist()
+    starts = np.concatenate(([0], np.cumsum(lengths))).tolist()
+
+    idx = InvertedIndex(cache_dir)
+    for doc_id in range(1, num_docs + 1):
+        doc_tokens = [f"t{t}" for t in tokens[starts[doc_id - 1] : starts[doc_id]]]
+        idx.docmap[doc_id] = {
+            "id": doc_id,
+            "title": f"Movie {doc_id}",
+            "description": " ".join(doc_tokens[:10]),
+        }
+        counts = Counter(doc_tokens)
+        for token in counts:
+            idx.index[token].add(doc_id)
+        idx.term_frequencies[doc_id] = counts
+        idx.doc_lengths[doc_id] = len(doc_tokens)
+    return idx
+
+
+def _measure_load(cache_dir: str, fmt: str, queue) -> None:
+    idx = InvertedIndex(cache_dir)
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    if fmt == "pickle":
+        idx.load_pickles()
+    else:
+        idx.load_arrays()
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, current_rss_mb() - rss_before))
+
+
+def measure_in_process(target, *args):
+    # fresh process per measurement so the page cache is the only thing shared
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=target, args=(*args, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def measure_load(cache_dir: str, fmt: str, target=_measure_load) -> tuple[float, float]:
+    return measure_in_process(target, cache_dir, fmt)
+
+
+def index_load_benchmark(sizes: list[int]) -> None:
+    print(f"{'docs':>10} {'format':>8} {'load (s)':>10} {'rss (MB)':>10}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            idx = synthetic_index(size, cache_dir)
+            idx.save()
+            del idx
+            for fmt in ("pickle", "arrays"):
+                elapsed, rss = measure_load(cache_dir, fmt)
+                print(f"{size:>10} {fmt:>8} {elapsed:>10.4f} {rss:>10.1f}")
+
+
+def legacy_bm25_search(idx: InvertedIndex, query: str, limit: int) -> list:
+    # the per posting get_bm25 loop bm25_search used before the vectorized scorer
+    tokens = set(tokenize_text(query))
+    scores = {doc_id: 0 for doc_id in idx.docmap}
+    for t in tokens:
+        for doc_id in idx.get_documents(t):
+            scores[doc_id] += idx.get_bm25(doc_id, t)
+    sorted_scores = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [(idx.docmap[doc_id], score) for doc_id, score in sorted_scores[:limit]]
+
+
+def time_queries(search, queries: list[str], repeat: int = 3) -> float:
+    # best of a few runs, returns milliseconds per query
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for q in queries:
+            search(q)
+        best = min(best, time.perf_counter() - start)
+    return best / len(queries) * 1000
+
+
+def bm25_benchmark(sizes: list[int], limit: int) -> None:
+    print(f"{'docs':>10} {'legacy (ms)':>12} {'vectorized (ms)':>16}")
+    for size in sizes:
+        idx = synthetic_index(size, tempfile.gettempdir())
+        idx.get_segments().get_scorers()
+        vectorized = time_queries(
+            lambda q: idx.bm25_search(q, limit), SYNTHETIC_QUERIES
+        )
+        if size <= LEGACY_BM25_MAX_DOCS:
+            legacy = time_queries(
+                lambda q: legacy_bm25_search(idx, q, limit), SYNTHETIC_QUERIES, 1
+            )
+            legacy_str = f"{legacy:.2f}"
+        else:
+            legacy_str = "-"
+        print(f"{size:>10} {legacy_str:>12} {vectorized:>16.2f}")
+
+
+def legacy_tokenize_text(text: str) -> list[str]:
+    # tokenize_text before the Analyzer, stopwords reread and a new stemmer per call
+    text = text.lower()
+    text = text.translate(str.maketrans("", "", string.punctuation))
+    stop_words = load_stopwords()
+    stemmer = PorterStemmer()
+    return [stemmer.stem(word) for word in text.split() if word not in stop_words]
+
+
+def analyzer_benchmark() -> None:
+    texts = [f"{m['title']} {m['description']}" for m in load_movies()]
+
+    start = time.perf_counter()
+    legacy_tokens = sum(len(legacy_tokenize_text(text)) for text in texts)
+    legacy = legacy_tokens / (time.perf_counter() - start)
+
+    # fresh analyzer so the stem cache starts cold
+    start = time.perf_counter()
+    tokens = sum(len(t) for t in Analyzer(load_stopwords()).tokenize_many(texts))
+    analyzer = tokens / (time.perf_counter() - start)
+
+    print(f"Documents:        {len(texts)}")
+    print(f"Tokens:           {tokens}")
+    print(f"Legacy tokenizer: {legacy:,.0f} tokens/sec")
+    print(f"Analyzer:         {analyzer:,.0f} tokens/sec ({analyzer / legacy:.1f}x)")
+
+
+def build_scaling_benchmark(max_workers: int, repeat: int) -> None:
+    # the movies corpus repeated with shifted ids, so there is enough work to split up
+    movies = load_movies()
+    id_offset = max(m["id"] for m in movies) + 1
+    corpus = [
+        {**m, "id": m["id"] + copy * id_offset}
+        for copy in range(repeat)
+        for m in movies
+    ]
+
+    print(f"Documents: {len(corpus)}")
+    print(f"{'workers':>8} {'build (s)':>10} {'speedup':>8}")
+    serial = None
+    for workers in range(1, max_workers + 1):
+        idx = InvertedIndex(tempfile.gettempdir())
+        start = time.perf_counter()
+        idx.add_movies(corpus, workers)
+        elapsed = time.perf_counter() - start
+        serial = serial or elapsed
+        print(f"{workers:>8} {elapsed:>10.2f} {serial / elapsed:>7.2f}x")
+
+
+def postings_benchmark(sizes: list[int], limit: int) -> None:
+    # postings footprint and search latency of the raw int32 and the compressed postings
+    queries = [query.split() for query in SYNTHETIC_QUERIES]
+    print(
+        f"{'docs':>10} {'format':>11} {'postings (MB)':>14} {'bytes/posting':>14}"
+        f" {'search (ms)':>12} {'pruned (ms)':>12}"
+    )
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            arrays = ArrayIndex.from_inverted_index(synthetic_index(size, cache_dir))
+            num_postings = len(arrays.postings_docs)
+            for fmt, compress in (("raw", False), ("compressed", True)):
+                path = os.path.join(cache_dir, fmt)
+                arrays.save(path, compress)
+                loaded = ArrayIndex.load(path)
+                if compress:
+                    postings_bytes = loaded.compressed.nbytes
+                else:
+                    postings_bytes = (
+                        loaded.postings_docs.nbytes + loaded.postings_tfs.nbytes
+                    )
+                scorer = BM25Scorer(loaded)
+                search = time_queries(lambda q: scorer.top_k(q, limit), queries)
+                pruned = time_queries(lambda q: scorer.top_k_pruned(q, limit), queries)
+                print(
+                    f"{size:>10} {fmt:>11} {postings_bytes / 1024**2:>14.2f}"
+                    f" {postings_bytes / max(num_postings, 1):>14.2f}"
+                    f" {search:>12.2f} {pruned:>12.2f}"
+                )
+
+
+def synthetic_chunk_embeddings(
+    num_chunks: int, seed: int = 42
+) -> tuple[np.ndarray, np.ndarray]:
+    # 1 to 5 chunks per movie, movie after movie like build_chunk_embeddings writes them
+    rng = np.random.default_rng(seed)
+    chunks_per_movie = rng.integers(1, 6, num_chunks)
+    chunk_movies = np.repeat(np.arange(num_chunks), chunks_per_movie)[:num_chunks]
+    topics = rng.standard_normal((SYNTHETIC_TOPICS, EMBEDDING_DIM), dtype=np.float32)
+    embeddings = rng.standard_normal((num_chunks, EMBEDDING_DIM), dtype=np.float32)
+    for start in range(0, num_chunks, 1 << 16):
+        batch = embeddings[start : start + (1 << 16)]
+        batch += topics[rng.integers(0, SYNTHETIC_TOPICS, len(batch))]
+    return embeddings, chunk_movies
+
+
+def legacy_search_chunks(
+    chunk_embeddings: np.ndarray, chunk_movies: np.ndarray, query_embedding, limit: int
+) -> list:
+    # search_chunks before the matrix product, a cosine and a dict per chunk
+    chunk_scores = []
+    for idx, c in enumerate(chunk_embeddings):
+        norm1, norm2 = np.linalg.norm(query_embedding), np.linalg.norm(c)
+        c_sim = (
+            0.0
+            if norm1 == 0 or norm2 == 0
+            else np.dot(query_embedding, c) / (norm1 * norm2)
+        )
+        chunk_scores.append(
+            {"chunk_idx": idx, "movie_idx": chunk_movies[idx], "score": c_sim}
+        )
+    movie_scores = {}
+    for c in chunk_scores:
+        if (
+            c["movie_idx"] not in movie_scores
+            or movie_scores[c["movie_idx"]] < c["score"]
+        ):
+            movie_scores[c["movie_idx"]] = c["score"]
+    return sorted(movie_scores.items(), key=lambda key: key[1], reverse=True)[:limit]
+
+
+def semantic_benchmark(sizes: list[int], limit: int) -> None:
+    # chunk search latency on random embeddings, no model needed
+    queries = list(
+        np.random.default_rng(7).standard_normal(
+            (len(SYNTHETIC_QUERIES), EMBEDDING_DIM), dtype=np.float32
+        )
+    )
+    print(f"{'chunks':>10} {'movies':>10} {'legacy (ms)':>12} {'matrix (ms)':>12}")
+    for size in sizes:
+        raw, chunk_movies = synthetic_chunk_embeddings(size)
+        if size <= LEGACY_SEMANTIC_MAX_CHUNKS:
+            legacy = time_queries(
+                lambda q: legacy_search_chunks(raw, chunk_movies, q, limit), queries, 1
+            )
+            legacy_str = f"{legacy:.2f}"
+        else:
+            legacy_str = "-"
+
+        embeddings = normalize_rows(raw)
+        del raw
+        groups = ChunkGroups(chunk_movies)
+        matrix = time_queries(
+            lambda q: top_k_movies(embeddings, groups, q, limit), queries
+        )
+        print(f"{size:>10} {len(groups.movies):>10} {legacy_str:>12} {matrix:>12.2f}")
+
+
+def synthetic_queries(embeddings: np.ndarray, seed: int = 7) -> list:
+    # queries near random chunks, like a query close to some of the descriptions
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((SYNTHETIC_ANN_QUERIES, EMBEDDING_DIM))
+    return list(
+        embeddings[rng.integers(0, len(embeddings), SYNTHETIC_ANN_QUERIES)]
+        + (noise / np.sqrt(EMBEDDING_DIM)).astype(np.float32)
+    )
+
+
+def recall_at_k(results: list, expected: list) -> float:
+    # mean share of the expected top k ids found, over queries
+    return float(
+        np.mean(
+            [
+                len({i for i, _ in r} & {i for i, _ in e}) / max(len(e), 1)
+                for r, e in zip(results, expected)
+            ]
+        )
+    )
+
+
+def ann_report(
+    dataset: str,
+    embeddings: np.ndarray,
+    groups: ChunkGroups,
+    index: IVFIndex,
+    queries: list,
+    limit: int,
+    nprobes: list[int],
+) -> None:
+    # recall@k of the ivf search against the exact top k movies, and queries per second
+    exact = [top_k_movies(embeddings, groups, q, limit) for q in queries]
+    exact_ms = time_queries(
+        lambda q: top_k_movies(embeddings, groups, q, limit), queries
+    )
+    print(
+        f"{dataset:>10} {len(embeddings):>10} {'exact':>7} {'-':>7}"
+        f" {1.0:>10.4f} {1000 / exact_ms:>10.1f}"
+    )
+    for nprobe in nprobes:
+
+        def search(q):
+            return top_k_movies(
+                embeddings, groups, q, limit, index.candidates(q, nprobe)
+            )
+
+        recall = recall_at_k([search(q) for q in queries], exact)
+        ivf_ms = time_queries(search, queries)
+        print(
+            f"{dataset:>10} {len(embeddings):>10} {'ivf':>7} {nprobe:>7}"
+            f" {recall:>10.4f} {1000 / ivf_ms:>10.1f}"
+        )
+
+
+def ann_benchmark(
+    sizes: list[int], limit: int, nprobes: list[int], golden: bool
+) -> None:
+    print(
+        f"{'dataset':>10} {'chunks':>10} {'search':>7} {'nprobe':>7}"
+        f" {f'recall@{limit}':>10} {'QPS':>10}"
+    )
+    if golden:
+        # the real chunk embeddings and golden queries need the embedding model
+        from .semantic_search import ChunkedSemanticSearch
+
+        css = ChunkedSemanticSearch()
+        css.load_or_create_chunk_embeddings(load_movies())
+        with open(GOLDEN_DATASET_PATH, "r") as f:
+            test_cases = json.load(f)["test_cases"]
+        queries = list(css.model.encode([case["query"] for case in test_cases]))
+        ann_report(
+            "golden",
+            css.chunk_embeddings,
+            css.chunk_groups,
+            css.load_or_create_ann_index(),
+            queries,
+            limit,
+            nprobes,
+        )
+        return
+
+    for size in sizes:
+        raw, chunk_movies = synthetic_chunk_embeddings(size)
+        embeddings = normalize_rows(raw)
+        del raw
+        queries = synthetic_queries(embeddings)
+        start = time.perf_counter()
+        index = IVFIndex.build(embeddings)
+        print(f"# built {index.num_lists} lists in {time.perf_counter() - start:.1f}s")
+        ann_report(
+            "synthetic",
+            embeddings,
+            ChunkGroups(chunk_movies),
+            index,
+            queries,
+            limit,
+            nprobes,
+        )
+
+
+def quantization_benchmark(sizes: list[int], limit: int) -> None:
+    # embedding matrix size, chunk search latency and recall@k against float32 per precision
+    print(
+        f"{'chunks':>10} {'precision':>9} {'rescore':>7} {'matrix (MB)':>12}"
+        f" {'search (ms)':>12} {f'recall@{limit}':>10}"
+    )
+    for size in sizes:
+        raw, chunk_movies = synthetic_chunk_embeddings(size)
+        groups = ChunkGroups(chunk_movies)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "chunk_embeddings.npy")
+            embeddings = normalize_rows(raw)
+            del raw
+            queries = synthetic_queries(embeddings)
+            np.save(path, embeddings)
+            expected = None
+            for precision in EMBEDDING_PRECISIONS:
+                embeddings = load_embeddings(path, precision)
+                full_embeddings = full_precision_embeddings(path, precision)
+                rescores = (
+                    (0, RESCORE_OVERSAMPLING) if full_embeddings is not None else (0,)
+                )
+                for rescore in rescores:
+
+                    def search(q):
+                        return top_k_movies(
+                            embeddings, groups, q, limit, None, full_embeddings, rescore
+                        )
+
+                    results = [search(q) for q in queries]
+                    expected = expected or results
+                    print(
+                        f"{size:>10} {precision:>9} {rescore:>7}"
+                        f" {embeddings.nbytes / 1024**2:>12.1f}"
+                        f" {time_queries(search, queries):>12.2f}"
+                        f" {recall_at_k(results, expected):>10.4f}"
+                    )
+                del embeddings, full_embeddings
+
+
+def binary_benchmark(sizes: list[int], limit: int, candidates: list[int]) -> None:
+    # cost of ranking every chunk by float dot product vs sign bit hamming distance, and the
+    # latency and recall@k of the two stage search that rescores the hamming candidates
+    print(
+        f"{'chunks':>10} {'search':>7} {'candidates':>10} {'index (MB)':>11}"
+        f" {'scan (ms)':>10} {'search (ms)':>12} {f'recall@{limit}':>10}"
+    )
+    for size in sizes:
+        raw, chunk_movies = synthetic_chunk_embeddings(size)
+        embeddings = normalize_rows(raw)
+        del raw
+        groups = ChunkGroups(chunk_movies)
+        queries = synthetic_queries(embeddings)
+        codes = BinaryCodes.encode(embeddings)
+
+        exact = [top_k_movies(embeddings, groups, q, limit) for q in queries]
+        print(
+            f"{size:>10} {'exact':>7} {'-':>10} {embeddings.nbytes / 1024**2:>11.1f}"
+            f" {time_queries(lambda q: embeddings @ q, queries):>10.2f}"
+            f" {time_queries(lambda q: top_k_movies(embeddings, groups, q, limit), queries):>12.2f}"
+            f" {1.0:>10.4f}"
+        )
+        scan = time_queries(codes.distances, queries)
+        for num_candidates in candidates:
+
+            def search(q):
+                rows = codes.candidates(q, num_candidates)
+                return top_k_movies(embeddings, groups, q, limit, rows)
+
+            print(
+                f"{size:>10} {'binary':>7} {num_candidates:>10}"
+                f" {codes.nbytes / 1024**2:>11.1f} {scan:>10.2f}"
+                f" {time_queries(search, queries):>12.2f}"
+                f" {recall_at_k([search(q) for q in queries], exact):>10.4f}"
+            )
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int]]:
+    # (module, cumulative microseconds) of the imports -X importtime reports at top level
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if not module[1:].startswith(" "):
+            imports.append((module.strip(), int(cumulative)))
+    return imports
+
+
+def startup_benchmark(repeat: int) -> None:
+    # wall time and import time of each CLI command in a fresh interpreter, best of repeat runs,
+    # and which heavy modules it imported
+    print(
+        f"{'command':<50} {'wall (ms)':>10} {'imports (ms)':>13}"
+        f" {'slowest import':>30}  heavy modules"
+    )
+    for command in STARTUP_COMMANDS:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.run(
+                [sys.executable, "-X", "importtime"]
+                + [os.path.join(PROJECT_ROOT, "cli", command[0])]
+                + command[1:],
+                capture_output=True,
+                text=True,
+            )
+            runs.append((time.perf_counter() - start, process))
+        wall, process = min(runs, key=lambda run: run[0])
+        imports = parse_importtime(process.stderr)
+        imported = {module for module, _ in imports}
+        heavy = [
+            module
+            for module in HEAVY_MODULES
+            if module in imported or module.split(".")[0] in imported
+        ]
+        slowest = max(imports, key=lambda entry: entry[1], default=("-", 0))
+        label = " ".join(command)
+        if process.returncode != 0:
+            label = f"{label} (exit {process.returncode})"
+        print(
+            f"{label[:50]:<50} {wall * 1000:>10.1f}"
+            f" {sum(us for _, us in imports) / 1000:>13.1f}"
+            f" {f'{slowest[0]} {slowest[1] / 1000:.1f}ms'[:30]:>30}"
+            f"  {', '.join(heavy) or '-'}"
+        )
+
+
+def synthetic_chunk_metadata(num_chunks: int, seed: int = 42) -> ChunkMetadata:
+    # movies of 1 to 8 chunks of a few dozen characters, like the semantic chunks of descriptions
+    rng = np.random.default_rng(seed)
+    movie_indexes = []
+    movie_chunks = []
+    chunk = 0
+    while chunk < num_chunks:
+        count = min(int(rng.integers(1, 9)), num_chunks - chunk)
+        movie_indexes.append(len(movie_indexes))
+        movie_chunks.append(
+            [
+                f"Sentence {chunk + i} of movie {len(movie_indexes)}."
+                for i in range(count)
+            ]
+        )
+        chunk += count
+    return ChunkMetadata.from_chunks(movie_indexes, movie_chunks)
+
+
+def _measure_chunk_metadata_load(cache_dir: str, fmt: str, queue) -> None:
+    # load the metadata and group the chunks by movie, everything a chunk search needs
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    if fmt == "json":
+        with open(os.path.join(cache_dir, "chunk_metadata.json"), "r") as f:
+            chunks = json.load(f)["chunks"]
+        groups = ChunkGroups([c["movie_idx"] for c in chunks])
+    else:
+        groups = ChunkGroups(ChunkMetadata.load(cache_dir).movie_idx)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, current_rss_mb() - rss_before))
+    del groups
+
+
+def chunk_metadata_benchmark(sizes: list[int]) -> None:
+    # the indented json list of dicts chunk metadata used to be saved as vs columnar arrays
+    print(
+        f"{'chunks':>10} {'format':>8} {'file (MB)':>10} {'load (s)':>10} {'rss (MB)':>10}"
+    )
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            metadata = synthetic_chunk_metadata(size)
+            metadata.save(cache_dir)
+            with open(os.path.join(cache_dir, "chunk_metadata.json"), "w") as f:
+                json.dump(
+                    {
+                        "chunks": [
+                            {
+                                "movie_idx": int(movie),
+                                "chunk_idx": int(chunk),
+                                "total_chunks": int(total),
+                            }
+                            for movie, chunk, total in zip(
+                                metadata.movie_idx,
+                                metadata.chunk_idx,
+                                metadata.total_chunks,
+                            )
+                        ],
+                        "total_chunks": len(metadata),
+                    },
+                    f,
+                    indent=2,
+                )
+            del metadata
+            file_sizes = {
+                "json": os.path.getsize(os.path.join(cache_dir, "chunk_metadata.json")),
+                "arrays": sum(
+                    os.path.getsize(os.path.join(cache_dir, name))
+                    for name in CHUNK_METADATA_FILES
+                ),
+            }
+            for fmt in ("json", "arrays"):
+                elapsed, rss = measure_load(
+                    cache_dir, fmt, _measure_chunk_metadata_load
+                )
+                print(
+                    f"{size:>10} {fmt:>8} {file_sizes[fmt] / 1024**2:>10.1f}"
+                    f" {elapsed:>10.4f} {rss:>10.1f}"
+                )
+
+
+class SyntheticEncoder:
+    # stands in for the model so a build benchmark measures the pipeline around it
+    def encode(self, texts: list[str], **encode_kwargs) -> np.ndarray:
+        rng = np.random.default_rng(len(texts))
+        return rng.standard_normal((len(texts), EMBEDDING_DIM), dtype=np.float32)
+
+
+def _measure_embedding_build(cache_dir: str, mode: str, num_texts: int, queue) -> None:
+    cache = EmbeddingCache(os.path.join(cache_dir, mode, "cache"), "synthetic")
+    path = os.path.join(cache_dir, mode, "embeddings.npy")
+    texts = (f"Chunk {i} of a synthetic movie description." for i in range(num_texts))
+    start = time.perf_counter()
+    if mode == "single":
+        # every text and embedding in memory, one encode call, written at the end
+        embeddings = normalize_rows(cache.encode(SyntheticEncoder(), list(texts)))
+        cache.save()
+        np.save(path, embeddings)
+    else:
+        stream_embeddings(
+            path,
+            texts,
+            num_texts,
+            "synthetic",
+            cache,
+            SyntheticEncoder(),
+            show_progress_bar=False,
+        )
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def embedding_build_benchmark(sizes: list[int]) -> None:
+    # build time and peak memory of encoding everything at once vs the streaming build, with a
+    # synthetic encoder so the model's own time and memory stay out of it
+    print(f"{'texts':>10} {'build':>10} {'time (s)':>10} {'peak rss (MB)':>14}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for mode in ("single", "streaming"):
+                elapsed, peak_rss = measure_in_process(
+                    _measure_embedding_build, cache_dir, mode, size
+                )
+                print(f"{size:>10} {mode:>10} {elapsed:>10.2f} {peak_rss:>14.1f}")
+
+
+def encoding_benchmark(workers: list[int], num_texts: int) -> None:
+    # corpus encoding throughput of the model in this process vs pools of worker processes, over
+    # the movie chunks, and the largest difference from the single process embeddings
+    from .semantic_search import SEMANTIC_MODEL, description_chunks
+
+    texts = [chunk for doc in load_movies() for chunk in description_chunks(doc)]
+    texts = texts[:num_texts]
+    model = sentence_transformer(SEMANTIC_MODEL)
+    # the first encode loads the model, it is timed apart from the throughput run
+    start = time.perf_counter()
+    model.encode(texts[:1])
+    startup = time.perf_counter() - start
+    start = time.perf_counter()
+    expected = np.asarray(model.encode(texts), dtype=np.float32)
+    single = time.perf_counter() - start
+
+    print(
+        f"{'workers':>8} {'threads':>8} {'startup (s)':>12} {'texts/sec':>10}"
+        f" {'max diff':>10}"
+    )
+    print(
+        f"{1:>8} {lazy_import('torch').get_num_threads():>8} {startup:>12.2f}"
+        f" {len(texts) / single:>10.1f} {0.0:>10.2g}"
+    )
+    for count in workers:
+        if count < 2:
+            continue
+        with EncodingPool(SEMANTIC_MODEL, count) as pool:
+            start = time.perf_counter()
+            pool.encode(texts[:count])
+            startup = time.perf_counter() - start
+            start = time.perf_counter()
+            embeddings = pool.encode(texts)
+            elapsed = time.perf_counter() - start
+        print(
+            f"{count:>8} {pool.threads_per_worker:>8} {startup:>12.2f}"
+            f" {len(texts) / elapsed:>10.1f}"
+            f" {np.abs(embeddings - expected).max():>10.2g}"
+        )
+
+
+def synthetic_retrieved(num_docs: int, seed: int = 42) -> tuple[list, list, list]:
+    # movies and a BM25 and a semantic result list over all of them, shaped like the
+    # retrievers return them, the two rankings only loosely agree
+    rng = np.random.default_rng(seed)
+    documents = [
+        {"id": i + 1, "title": f"Movie {i + 1}", "description": "A synthetic movie."}
+        for i in range(num_docs)
+    ]
+    bm25_scores = rng.gamma(2.0, 2.0, num_docs)
+    semantic_scores = 0.5 * bm25_scores / bm25_scores.max() + rng.random(num_docs)
+    bm25_result = [
+        (documents[i], float(bm25_scores[i])) for i in np.argsort(-bm25_scores)
+    ]
+    semantic_result = [
+        {"id": documents[i]["id"], "score": round(float(semantic_scores[i]), 4)}
+        for i in np.argsort(-semantic_scores)
+    ]
+    return documents, bm25_result, semantic_result
+
+
+def legacy_rrf_fusion(
+    documents, docmap, bm25_result, semantic_result, k, limit
+) -> list[dict]:
+    # the per candidate dict fusion hybrid search did before fusing arrays
+    results = {}
+    for rank, (doc, _) in enumerate(bm25_result, 1):
+        results[doc["id"]] = {
+            "document": doc,
+            "ranks": {"keyword": rank, "semantic": None},
+            "combined_rrf_score": 1 / (k + rank),
+        }
+    for rank, r in enumerate(semantic_result, 1):
+        if r["id"] in results:
+            results[r["id"]]["ranks"]["semantic"] = rank
+            results[r["id"]]["combined_rrf_score"] += 1 / (k + rank)
+        else:
+            results[r["id"]] = {
+                "document": docmap[r["id"]],
+                "ranks": {"keyword": None, "semantic": rank},
+                "combined_rrf_score": 1 / (k + rank),
+            }
+    return sorted(
+        results.values(), key=lambda key: key["combined_rrf_score"], reverse=True
+    )[:limit]
+
+
+def array_rrf_fusion(
+    documents, doc_index, bm25_result, semantic_result, k, limit
+) -> list[dict]:
+    # what HybridSearch.rrf_search does with the two result lists
+    candidates = FusionCandidates.align(
+        [
+            (
+                doc_index(np.fromiter((doc["id"] for doc, _ in bm25_result), np.int64)),
+                np.fromiter((score for _, score in bm25_result), np.float64),
+            ),
+            (
+                doc_index(np.fromiter((r["id"] for r in semantic_result), np.int64)),
+                np.fromiter((r["score"] for r in semantic_result), np.float64),
+            ),
+        ],
+        "minmax",
+    )
+    top = top_k_candidates(fuse(candidates, "rrf", k=k), limit)
+    return [
+        {
+            "document": documents[candidates.positions[column]],
+            "ranks": {
+                retriever: (
+                    int(candidates.ranks[r, column])
+                    if candidates.present[r, column]
+                    else None
+                )
+                for r, retriever in enumerate(("keyword", "semantic"))
+            },
+            "combined_rrf_score": score,
+        }
+        for column, score in top
+    ]
+
+
+def measure_peak_allocation(fusion, *args) -> float:
+    # KiB allocated at the peak of one call
+    tracemalloc.start()
+    fusion(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def fusion_benchmark(sizes: list[int], limit: int, k: int = 60) -> None:
+    # time and memory allocated per query fusing two result lists of every document, with a
+    # dict per candidate vs the fusion arrays. The id lookups are built once, like the
+    # docmap and doc index of a HybridSearch.
+    print(
+        f"{'candidates':>10} {'fusion':>8} {'time (ms)':>10} {'peak (KiB)':>11} {'same':>5}"
+    )
+    for size in sizes:
+        documents, bm25_result, semantic_result = synthetic_retrieved(size)
+        lookups = {
+            "legacy": {doc["id"]: doc for doc in documents},
+            "arrays": DocIndex([doc["id"] for doc in documents]),
+        }
+        expected = None
+        for name, fusion in (
+            ("legacy", legacy_rrf_fusion),
+            ("arrays", array_rrf_fusion),
+        ):
+            args = (documents, lookups[name], bm25_result, semantic_result, k, limit)
+            elapsed = time_queries(lambda _: fusion(*args), [None])
+            peak = measure_peak_allocation(fusion, *args)
+            results = fusion(*args)
+            expected = expected or results
+            print(
+                f"{size:>10} {name:>8} {elapsed:>10.2f} {peak:>11.1f}"
+                f" {str(results == expected):>5}"
+            )
+
+
+def batch_query_benchmark(limit: int, repeat: int, k: int = 60) -> None:
+    # queries/sec of rrf search over the golden dataset queries one at a time vs as one batch,
+    # every run starts from an empty in-memory query cache so each encodes its queries
+    from .hybrid_search import HybridSearch
+    from .semantic_search import SEMANTIC_MODEL
+
+    with open(GOLDEN_DATASET_PATH, "r") as f:
+        queries = [case["query"] for case in json.load(f)["test_cases"]]
+    hs = HybridSearch(load_movies(), cache_results=False)
+    # the model loads outside the timed runs
+    hs.rrf_search(queries[0], k, limit)
+
+    def cold(search):
+        hs.semantic_search.query_cache = QueryEmbeddingCache(SEMANTIC_MODEL, path=None)
+        return search()
+
+    searches = {
+        "loop": lambda: [hs.rrf_search(query, k, limit) for query in queries],
+        "batch": lambda: hs.rrf_search_many(queries, k, limit),
+    }
+    expected = cold(searches["loop"])
+    print(
+        f"{'search':>8} {'queries':>8} {'time (s)':>10} {'queries/sec':>12} {'same':>5}"
+    )
+    for name, search in searches.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = cold(search)
+            best = min(best, time.perf_counter() - start)
+        print(
+            f"{name:>8} {len(queries):>8} {best:>10.3f} {len(queries) / best:>12.1f}"
+            f" {str(results == expected):>5}"
+        )
+
+
+def result_cache_benchmark(
+    num_queries: int, max_kib: list[int], seed: int = 42
+) -> None:
+    # queries/sec of a stream of golden dataset queries where a few are popular, as zipf
+    # draws, rrf searched without and with in-memory result caches of a few sizes
+    from .hybrid_search import HybridSearch
+
+    with open(GOLDEN_DATASET_PATH, "r") as f:
+        queries = [case["query"] for case in json.load(f)["test_cases"]]
+    rng = np.random.default_rng(seed)
+    stream = [queries[(rank - 1) % len(queries)] for rank in rng.zipf(1.3, num_queries)]
+    hs = HybridSearch(load_movies(), cache_results=False)
+    # the model loads and every query embedding is cached outside the timed runs
+    for query in queries:
+        hs.rrf_search(query, 60, 5)
+
+    print(f"{'cache (KiB)':>12} {'queries/sec':>12} {'hit rate':>9}")
+    start = time.perf_counter()
+    for query in stream:
+        hs.rrf_search(query, 60, 5)
+    print(f"{'none':>12} {num_queries / (time.perf_counter() - start):>12.1f} {'':>9}")
+    for size in max_kib:
+        hs.result_cache = ResultCache(max_bytes=size * 1024, path=None)
+        start = time.perf_counter()
+        for query in stream:
+            hs.rrf_search(query, 60, 5)
+        elapsed = time.perf_counter() - start
+        stats = hs.result_cache.stats()
+        print(f"{size:>12} {num_queries / elapsed:>12.1f} {stats['hit_rate']:>9.0%}")
+        print(f"{'':>12} {format_result_cache_stats(stats)}")
+
+
+def threshold_fusion_benchmark(limits: list[int], repeat: int, k: int = 60) -> None:
+    # ms per rrf search over the golden dataset queries fusing the whole candidate lists vs
+    # threshold fusion, and how deep threshold fusion read them
+    from .hybrid_search import HybridSearch
+
+    with open(GOLDEN_DATASET_PATH, "r") as f:
+        queries = [case["query"] for case in json.load(f)["test_cases"]]
+    hs = HybridSearch(load_movies(), cache_results=False)
+    # the model loads and every query embedding is cached outside the timed runs
+    for query in queries:
+        hs.rrf_search(query, k, 1)
+
+    print(
+        f"{'limit':>6} {'depth':>6} {'full (ms)':>10} {'threshold (ms)':>15}"
+        f" {'mean read':>10} {'max read':>9} {'same':>5}"
+    )
+    for limit in limits:
+        full = time_queries(lambda q: hs.rrf_search(q, k, limit), queries, repeat)
+        threshold = time_queries(
+            lambda q: hs.rrf_search(q, k, limit, threshold=True), queries, repeat
+        )
+        same = True
+        reads = []
+        for query in queries:
+            same &= hs.rrf_search(query, k, limit) == hs.rrf_search(
+                query, k, limit, threshold=True
+            )
+            reads.append(max(hs.fusion_stats["depths"].values()))
+        print(
+            f"{limit:>6} {hs.candidate_depth(limit):>6} {full:>10.2f} {threshold:>15.2f}"
+            f" {np.mean(reads):>10.1f} {max(reads):>9} {str(same):>5}"
+        )
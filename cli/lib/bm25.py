@@ -0,0 +1,288 @@
+import math
+
+import numpy as np
+
+from .index_arrays import ArrayIndex
+from .search_utils import BM25_K1, BM25_B
+
+# pruned search walks the dense doc id space in windows of at least this many documents
+PRUNING_MIN_WINDOW = 1024
+PRUNING_MAX_WINDOWS = 64
+
+# relative tolerance on the pruning threshold so float rounding can never drop a top-k document
+PRUNING_SLACK = 1e-9
+
+
+class BM25Scorer:
+    # Scores whole postings lists at once, everything that only depends on the corpus is computed up front
+    def __init__(
+        self,
+        arrays: ArrayIndex,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+        stats=None,
+        live: np.ndarray | None = None,
+    ) -> None:
+        self.arrays = arrays
+        self.k1 = k1
+        self.b = b
+
+        # corpus wide num_docs, avg_doc_length and doc_frequency, a segment only knows its own
+        self.stats = stats if stats is not None else arrays
+        # mask over the dense doc indexes, False for deleted documents
+        self.live = live
+
+        doc_lengths = np.asarray(arrays.doc_lengths, dtype=np.float64)
+        self.avg_doc_length = self.stats.avg_doc_length
+
+        # k1 * length normalization for every document, the denominator of the BM25 tf is tf + this
+        if self.avg_doc_length > 0:
+            self.length_norms = k1 * (1 - b + b * (doc_lengths / self.avg_doc_length))
+        else:
+            self.length_norms = np.full(len(doc_lengths), k1 * (1 - b))
+
+        self.idfs: dict[str, float] = {}
+
+    def idf(self, token: str) -> float:
+        if token not in self.idfs:
+            doc_count = self.stats.num_docs
+            term_doc_count = self.stats.doc_frequency(token)
+            self.idfs[token] = math.log(
+                (doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1
+            )
+        return self.idfs[token]
+
+    def posting_scores(self, token: str, docs, tfs) -> np.ndarray:
+        tfs = np.asarray(tfs, dtype=np.float64)
+        bm25_tf = (tfs * (self.k1 + 1)) / (tfs + self.length_norms[docs])
+        return bm25_tf * self.idf(token)
+
+    def term_scores(self, token: str) -> tuple[np.ndarray, np.ndarray]:
+        docs, tfs = self.arrays.postings(token)
+        return docs, self.posting_scores(token, docs, tfs)
+
+    def block_bounds(self, token: str) -> np.ndarray:
+        # upper bound of every block's scores, BM25 grows with tf and shrinks with doc length
+        max_tfs, min_lengths = self.arrays.blocks(token)
+        max_tfs = np.asarray(max_tfs, dtype=np.float64)
+        min_lengths = np.asarray(min_lengths, dtype=np.float64)
+        if self.avg_doc_length > 0:
+            norms = self.k1 * (
+                1 - self.b + self.b * (min_lengths / self.avg_doc_length)
+            )
+        else:
+            norms = np.full(len(min_lengths), self.k1 * (1 - self.b))
+        return (max_tfs * (self.k1 + 1)) / (max_tfs + norms) * self.idf(token)
+
+    def score(self, tokens, terms=None) -> tuple[np.ndarray, np.ndarray]:
+        # returns the dense doc indexes matching any token and their summed scores
+        # cost is O(P log P) in the total postings length P, the corpus size never comes into it
+        # terms maps tokens to their term_scores when a batch of queries already scored them
+        all_docs, all_scores = [], []
+        for token in tokens:
+            docs, scores = (
+                terms[token] if terms is not None else self.term_scores(token)
+            )
+            if len(docs):
+                all_docs.append(docs)
+                all_scores.append(scores)
+        if not all_docs:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+        scores = np.bincount(
+            inverse, weights=np.concatenate(all_scores), minlength=len(docs)
+        )
+        if self.live is not None:
+            alive = self.live[docs]
+            docs, scores = docs[alive], scores[alive]
+        return docs, scores
+
+    def score_docs(self, tokens, docs: np.ndarray) -> np.ndarray:
+        # summed scores of the given sorted dense doc indexes only, in query order like score()
+        scores = np.zeros(len(docs))
+        for token in tokens:
+            postings_docs, tfs = self.arrays.postings(token)
+            if not len(postings_docs) or not len(docs):
+                continue
+            positions = np.minimum(
+                np.searchsorted(postings_docs, docs), len(postings_docs) - 1
+            )
+            found = postings_docs[positions] == docs
+            scores[found] += self.posting_scores(
+                token, docs[found], tfs[positions[found]]
+            )
+        return scores
+
+    def top_k(self, tokens, limit: int) -> list[tuple[int, float]]:
+        docs, scores = self.score(tokens)
+        return select_top_k(docs, scores, limit)
+
+    def top_k_many(self, queries, limit: int) -> list[list[tuple[int, float]]]:
+        # top_k of every token list, a token shared by several queries is scored once
+        terms = {token: self.term_scores(token) for token in set().union(*queries)}
+        return [select_top_k(*self.score(tokens, terms), limit) for tokens in queries]
+
+    def top_k_pruned(self, tokens, limit: int) -> tuple[list[tuple[int, float]], dict]:
+        # Block-max MaxScore: the doc id space is walked in windows, per window every term is
+        # bounded by its block maxes. Windows whose bounds can't reach the current k-th score
+        # are skipped, otherwise terms whose summed bounds stay below it are only probed for
+        # candidates found in the other terms. Returns exactly what top_k returns.
+        # Only the blocks of windows that aren't skipped get read, so compressed postings are
+        # decoded block by block as the search goes.
+        arrays = self.arrays
+        terms = []
+        for col, token in enumerate(tokens):
+            first_block, last_block = arrays.term_blocks(token)
+            if last_block > first_block:
+                terms.append(
+                    (col, token, first_block, last_block, self.block_bounds(token))
+                )
+
+        stats = {
+            "postings_total": sum(
+                int(arrays.block_starts[last] - arrays.block_starts[first])
+                for _, _, first, last, _ in terms
+            ),
+            "postings_scored": 0,
+            "windows_skipped": 0,
+        }
+        best_docs = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float64)
+        # first block of every term that still has documents at or after the window start
+        cursors = [first_block for _, _, first_block, _, _ in terms]
+        num_docs = arrays.num_docs
+        window = max(PRUNING_MIN_WINDOW, -(-num_docs // PRUNING_MAX_WINDOWS))
+
+        for window_start in range(0, num_docs if limit > 0 else 0, window):
+            window_end = window_start + window
+            threshold = -np.inf
+            if len(best_scores) >= limit:
+                threshold = best_scores[limit - 1] * (1 - PRUNING_SLACK)
+
+            window_terms = []
+            for i, (col, token, first_block, last_block, block_bounds) in enumerate(
+                terms
+            ):
+                start = cursors[i]
+                end = start + int(
+                    np.searchsorted(
+                        arrays.block_first_docs[start:last_block], window_end
+                    )
+                )
+                # a block carried over from the last window may jump right over this one
+                if end > start and arrays.block_first_docs[start] < window_start:
+                    docs, _ = self.window_postings(
+                        start, start + 1, window_start, window_end
+                    )
+                    if not len(docs):
+                        start += 1
+                if end == start:
+                    continue
+                # the last block may carry on into the next window
+                cursors[i] = (
+                    end - 1 if arrays.block_last_docs[end - 1] >= window_end else end
+                )
+                bound = block_bounds[start - first_block : end - first_block].max()
+                window_terms.append((bound, col, token, start, end))
+            if not window_terms:
+                continue
+            window_terms.sort(key=lambda term: term[0])
+            cumulative_bounds = np.cumsum([term[0] for term in window_terms])
+            if cumulative_bounds[-1] < threshold:
+                stats["windows_skipped"] += 1
+                continue
+
+            # only documents from the essential terms can still make it into the top-k
+            non_essential = int(np.searchsorted(cumulative_bounds, threshold))
+            essential_terms = [
+                (
+                    col,
+                    token,
+                    *self.window_postings(start, end, window_start, window_end),
+                )
+                for _, col, token, start, end in window_terms[non_essential:]
+            ]
+            candidates = np.unique(
+                np.concatenate([docs for _, _, docs, _ in essential_terms])
+            )
+            contributions = np.zeros((len(candidates), len(tokens)))
+            for col, token, docs, tfs in essential_terms:
+                rows = np.searchsorted(candidates, docs)
+                contributions[rows, col] = self.posting_scores(token, docs, tfs)
+                stats["postings_scored"] += len(docs)
+
+            for j in range(non_essential - 1, -1, -1):
+                partial = contributions.sum(axis=1)
+                keep = partial + cumulative_bounds[j] >= threshold
+                candidates, contributions = candidates[keep], contributions[keep]
+                if not len(candidates):
+                    break
+                _, col, token, start, end = window_terms[j]
+                docs, tfs = self.window_postings(start, end, window_start, window_end)
+                positions = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+                found = docs[positions] == candidates
+                stats["postings_scored"] += min(len(candidates), len(docs))
+                contributions[found, col] = self.posting_scores(
+                    token, candidates[found], tfs[positions[found]]
+                )
+
+            # sum in query order so scores match top_k bit for bit
+            scores = np.zeros(len(candidates))
+            for col in range(len(tokens)):
+                scores = scores + contributions[:, col]
+            if self.live is not None:
+                alive = self.live[candidates]
+                candidates, scores = candidates[alive], scores[alive]
+            top = select_top_k(
+                np.concatenate((best_docs, candidates)),
+                np.concatenate((best_scores, scores)),
+                limit,
+            )
+            best_docs = np.array([doc for doc, _ in top], dtype=np.int64)
+            best_scores = np.array([score for _, score in top], dtype=np.float64)
+
+        stats["postings_skipped"] = stats["postings_total"] - stats["postings_scored"]
+        top = [(int(doc), float(score)) for doc, score in zip(best_docs, best_scores)]
+        return top, stats
+
+    def window_postings(
+        self, first_block: int, last_block: int, window_start: int, window_end: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # the postings of a block range that fall inside the window
+        docs, tfs = self.arrays.block_postings(first_block, last_block)
+        start, end = np.searchsorted(docs, (window_start, window_end))
+        return docs[start:end], tfs[start:end]
+
+
+def select_top_k(
+    docs: np.ndarray, scores: np.ndarray, limit: int
+) -> list[tuple[int, float]]:
+    # highest scores first, ties broken by lowest doc index like a stable sort over the whole corpus would
+    if limit <= 0 or len(docs) == 0:
+        return []
+    if len(docs) > limit:
+        kth_score = scores[np.argpartition(scores, -limit)[-limit]]
+        # keep everything tied with the k-th score so the tie break below stays exact
+        candidates = np.flatnonzero(scores >= kth_score)
+        docs, scores = docs[candidates], scores[candidates]
+    order = np.lexsort((docs, -scores))[:limit]
+    return [(int(docs[i]), float(scores[i])) for i in order]
+
+
+def select_top_k_rows(
+    docs: np.ndarray, scores: np.ndarray, limit: int
+) -> list[list[tuple[int, float]]]:
+    # select_top_k of every row of a (queries, docs) score matrix, the k-th score of every row
+    # comes from one argpartition over the whole matrix
+    if limit <= 0 or len(docs) == 0 or len(docs) <= limit:
+        return [select_top_k(docs, row, limit) for row in scores]
+    partitioned = np.argpartition(scores, -limit, axis=1)[:, -limit]
+    kth_scores = scores[np.arange(len(scores)), partitioned]
+    top = []
+    for row, kth_score in zip(scores, kth_scores):
+        candidates = np.flatnonzero(row >= kth_score)
+        row_docs, row_scores = docs[candidates], row[candidates]
+        order = np.lexsort((row_docs, -row_scores))[:limit]
+        top.append([(int(row_docs[i]), float(row_scores[i])) for i in order])
+    return top
@@ -0,0 +1,223 @@
+import re
+
+import numpy as np
+
+from .analyzer import get_analyzer
+from .index_arrays import ArrayIndex
+from .phrases import PHRASE_PATTERN, phrase_docs
+
+# parentheses, "quoted phrases" with an optional ~slop, and words
+QUERY_TOKEN_PATTERN = re.compile(r'\(|\)|"[^"]*"(?:~\d+)?|[^\s()"]+')
+
+BOOLEAN_OPERATORS = ("AND", "OR", "NOT", "(", ")")
+
+
+# Every node matches a sorted array of dense doc indexes in one ArrayIndex. evaluate() produces
+# all of them, filter() keeps the given candidates that match, which is what lets an AND read
+# its rarest operand and only probe the others. stats["postings_read"] counts postings touched.
+class Term:
+    def __init__(self, token: str) -> None:
+        self.token = token
+
+    def cost(self, arrays: ArrayIndex) -> int:
+        return arrays.doc_frequency(self.token)
+
+    def evaluate(self, arrays: ArrayIndex, stats: dict) -> np.ndarray:
+        docs, _ = arrays.postings(self.token)
+        stats["postings_read"] += len(docs)
+        return np.asarray(docs, dtype=np.int64)
+
+    def filter(self, arrays: ArrayIndex, docs: np.ndarray, stats: dict) -> np.ndarray:
+        found, postings_read = arrays.probe(self.token, docs)
+        stats["postings_read"] += postings_read
+        return docs[found]
+
+    def tokens(self, negated: bool = False) -> list[str]:
+        return [] if negated else [self.token]
+
+
+class Phrase:
+    # positions are the tokens' word positions in the query, the stopwords dropped between
+    # them have to be in the document too
+    def __init__(
+        self, tokens: list[str], slop: int, positions: list[int] | None = None
+    ) -> None:
+        self.phrase_tokens = tokens
+        self.slop = slop
+        if positions is None:
+            positions = list(range(len(tokens)))
+        self.offsets = [position - positions[0] for position in positions]
+
+    def cost(self, arrays: ArrayIndex) -> int:
+        return min(arrays.doc_frequency(token) for token in self.phrase_tokens)
+
+    def evaluate(self, arrays: ArrayIndex, stats: dict) -> np.ndarray:
+        if arrays.positions is None:
+            raise ValueError(
+                "phrase queries need token positions, rebuild the index with build --positions"
+            )
+        stats["postings_read"] += sum(
+            arrays.doc_frequency(token) for token in set(self.phrase_tokens)
+        )
+        return phrase_docs(arrays, self.phrase_tokens, self.slop, self.offsets)
+
+    def filter(self, arrays: ArrayIndex, docs: np.ndarray, stats: dict) -> np.ndarray:
+        return np.intersect1d(docs, self.evaluate(arrays, stats), assume_unique=True)
+
+    def tokens(self, negated: bool = False) -> list[str]:
+        return [] if negated else self.phrase_tokens
+
+
+class And:
+    def __init__(self, children: list) -> None:
+        self.children = children
+
+    def cost(self, arrays: ArrayIndex) -> int:
+        return min(child.cost(arrays) for child in self.children)
+
+    def evaluate(self, arrays: ArrayIndex, stats: dict) -> np.ndarray:
+        # rarest operand first, the candidates only shrink from there
+        children = sorted(self.children, key=lambda child: child.cost(arrays))
+        docs = children[0].evaluate(arrays, stats)
+        return self.__narrow(children[1:], arrays, docs, stats)
+
+    def filter(self, arrays: ArrayIndex, docs: np.ndarray, stats: dict) -> np.ndarray:
+        children = sorted(self.children, key=lambda child: child.cost(arrays))
+        return self.__narrow(children, arrays, docs, stats)
+
+    def __narrow(self, children, arrays, docs, stats) -> np.ndarray:
+        for child in children:
+            if not len(docs):
+                break
+            docs = child.filter(arrays, docs, stats)
+        return docs
+
+    def tokens(self, negated: bool = False) -> list[str]:
+        return [token for child in self.children for token in child.tokens(negated)]
+
+
+class Or:
+    def __init__(self, children: list) -> None:
+        self.children = children
+
+    def cost(self, arrays: ArrayIndex) -> int:
+        return min(arrays.num_docs, sum(child.cost(arrays) for child in self.children))
+
+    def evaluate(self, arrays: ArrayIndex, stats: dict) -> np.ndarray:
+        docs = np.empty(0, dtype=np.int64)
+        for child in self.children:
+            docs = np.union1d(docs, child.evaluate(arrays, stats))
+        return docs
+
+    def filter(self, arrays: ArrayIndex, docs: np.ndarray, stats: dict) -> np.ndarray:
+        matched = np.empty(0, dtype=np.int64)
+        for child in self.children:
+            matched = np.union1d(matched, child.filter(arrays, docs, stats))
+        return matched
+
+    def tokens(self, negated: bool = False) -> list[str]:
+        return [token for child in self.children for token in child.tokens(negated)]
+
+
+class Not:
+    def __init__(self, child) -> None:
+        self.child = child
+
+    def cost(self, arrays: ArrayIndex) -> int:
+        # filtering is cheap but standing alone it matches nearly everything, so it goes last
+        return arrays.num_docs
+
+    def evaluate(self, arrays: ArrayIndex, stats: dict) -> np.ndarray:
+        return np.setdiff1d(
+            np.arange(arrays.num_docs), self.child.evaluate(arrays, stats)
+        )
+
+    def filter(self, arrays: ArrayIndex, docs: np.ndarray, stats: dict) -> np.ndarray:
+        return np.setdiff1d(
+            docs, self.child.filter(arrays, docs, stats), assume_unique=True
+        )
+
+    def tokens(self, negated: bool = False) -> list[str]:
+        return self.child.tokens(not negated)
+
+
+def combine(node_type, children: list):
+    # nested nodes of the same type are flattened, operands that analyzed to nothing dropped
+    flat = []
+    for child in children:
+        if isinstance(child, node_type):
+            flat.extend(child.children)
+        elif child is not None:
+            flat.append(child)
+    if len(flat) <= 1:
+        return flat[0] if flat else None
+    return node_type(flat)
+
+
+def query_leaf(text: str):
+    analyzer = get_analyzer()
+    phrase = PHRASE_PATTERN.fullmatch(text)
+    if phrase:
+        tokens, positions = analyzer.tokenize_positions(phrase.group(1))
+        return Phrase(tokens, int(phrase.group(2) or 0), positions) if tokens else None
+    return combine(And, [Term(token) for token in analyzer.tokenize(text)])
+
+
+def is_boolean_query(query: str) -> bool:
+    return any(
+        token in BOOLEAN_OPERATORS for token in QUERY_TOKEN_PATTERN.findall(query)
+    )
+
+
+class QueryParser:
+    # From loosest to tightest: OR, also implied between operands, then AND, also implied
+    # before NOT so "batman NOT joker" excludes, then NOT and parentheses.
+    # Stopwords analyze to nothing and drop out, a query of only stopwords parses to None.
+    def __init__(self, query: str) -> None:
+        self.tokens = QUERY_TOKEN_PATTERN.findall(query)
+        self.pos = 0
+
+    def parse(self):
+        node = self.__parse_or()
+        if self.pos < len(self.tokens):
+            raise ValueError("unbalanced parentheses in query")
+        return node
+
+    def __peek(self) -> str | None:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def __parse_or(self):
+        children = [self.__parse_and()]
+        while self.__peek() not in (None, ")"):
+            if self.__peek() == "OR":
+                self.pos += 1
+            children.append(self.__parse_and())
+        return combine(Or, children)
+
+    def __parse_and(self):
+        children = [self.__parse_not()]
+        while self.__peek() in ("AND", "NOT"):
+            if self.__peek() == "AND":
+                self.pos += 1
+            children.append(self.__parse_not())
+        return combine(And, children)
+
+    def __parse_not(self):
+        token = self.__peek()
+        self.pos += 1
+        match token:
+            case None | ")" | "AND" | "OR":
+                raise ValueError(
+                    f"expected a search term, got {token or 'end of query'}"
+                )
+            case "NOT":
+                child = self.__parse_not()
+                return Not(child) if child is not None else None
+            case "(":
+                node = self.__parse_or()
+                if self.__peek() != ")":
+                    raise ValueError("unbalanced parentheses in query")
+                self.pos += 1
+                return node
+            case _:
+                return query_leaf(token)
@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+
+CHUNK_MOVIES_FILE = "movie_idx.npy"
+CHUNK_INDEXES_FILE = "chunk_idx.npy"
+CHUNK_TOTALS_FILE = "total_chunks.npy"
+CHUNK_TEXTS_FILE = "chunk_texts.npy"
+CHUNK_TEXT_OFFSETS_FILE = "chunk_text_offsets.npy"
+
+CHUNK_METADATA_FILES = (
+    CHUNK_MOVIES_FILE,
+    CHUNK_INDEXES_FILE,
+    CHUNK_TOTALS_FILE,
+    CHUNK_TEXTS_FILE,
+    CHUNK_TEXT_OFFSETS_FILE,
+)
+
+
+def chunk_columns(
+    movie_indexes: list[int], chunk_counts: list[int]
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # movie_idx, chunk_idx and total_chunks of movies with chunk_counts[j] chunks each
+    counts = np.asarray(chunk_counts, dtype=np.int32)
+    movie_idx = np.repeat(np.asarray(movie_indexes, dtype=np.int32), counts)
+    movie_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    chunk_idx = (np.arange(len(movie_idx)) - movie_starts).astype(np.int32)
+    return movie_idx, chunk_idx, np.repeat(counts, counts)
+
+
+def text_offsets(text_lengths: list[int]) -> np.ndarray:
+    offsets = np.zeros(len(text_lengths) + 1, dtype=np.int64)
+    np.cumsum(text_lengths, out=offsets[1:])
+    return offsets
+
+
+class ChunkMetadata:
+    # One entry per chunk embedding in parallel arrays. Chunk i is chunk chunk_idx[i] of the
+    # total_chunks[i] cut from movie movie_idx[i], its utf-8 text is
+    # texts[text_offsets[i] : text_offsets[i + 1]]. Loading memory-maps the files, nothing is
+    # parsed, so opening millions of chunks costs the same as opening a hundred.
+    def __init__(
+        self,
+        movie_idx: np.ndarray,
+        chunk_idx: np.ndarray,
+        total_chunks: np.ndarray,
+        texts: np.ndarray,
+        text_offsets: np.ndarray,
+    ) -> None:
+        self.movie_idx = movie_idx
+        self.chunk_idx = chunk_idx
+        self.total_chunks = total_chunks
+        self.texts = texts
+        self.text_offsets = text_offsets
+
+    @classmethod
+    def from_chunks(
+        cls, movie_indexes: list[int], movie_chunks: list[list[str]]
+    ) -> "ChunkMetadata":
+        # movie_chunks[j] are the chunks of movie movie_indexes[j], in order
+        encoded = [chunk.encode() for chunks in movie_chunks for chunk in chunks]
+        return cls(
+            *chunk_columns(movie_indexes, [len(chunks) for chunks in movie_chunks]),
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            text_offsets([len(text) for text in encoded]),
+        )
+
+    @classmethod
+    def allocate(
+        cls,
+        path: str,
+        movie_indexes: list[int],
+        chunk_counts: list[int],
+        text_lengths: list[int],
+    ) -> "ChunkMetadata":
+        # Metadata saved at path with room for the chunk texts, which are written one at a
+        # time with write_text, so a build never holds every chunk string at once.
+        # text_lengths are the utf-8 sizes of the chunk texts.
+        os.makedirs(path, exist_ok=True)
+        offsets = text_offsets(text_lengths)
+        metadata = cls(
+            *chunk_columns(movie_indexes, chunk_counts),
+            np.lib.format.open_memmap(
+                os.path.join(path, CHUNK_TEXTS_FILE),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(int(offsets[-1]),),
+            ),
+            offsets,
+        )
+        for name, array in zip(
+            (CHUNK_MOVIES_FILE, CHUNK_INDEXES_FILE, CHUNK_TOTALS_FILE),
+            (metadata.movie_idx, metadata.chunk_idx, metadata.total_chunks),
+        ):
+            np.save(os.path.join(path, name), array)
+        np.save(os.path.join(path, CHUNK_TEXT_OFFSETS_FILE), offsets)
+        return metadata
+
+    def write_text(self, chunk: int, text: str) -> None:
+        start, end = self.text_offsets[chunk], self.text_offsets[chunk + 1]
+        self.texts[start:end] = np.frombuffer(text.encode(), dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.movie_idx)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            array.nbytes
+            for array in (
+                self.movie_idx,
+                self.chunk_idx,
+                self.total_chunks,
+                self.texts,
+                self.text_offsets,
+            )
+        )
+
+    def text(self, chunk: int) -> str:
+        start, end = self.text_offsets[chunk], self.text_offsets[chunk + 1]
+        return self.texts[start:end].tobytes().decode()
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        for name, array in zip(
+            CHUNK_METADATA_FILES,
+            (
+                self.movie_idx,
+                self.chunk_idx,
+                self.total_chunks,
+                self.texts,
+                self.text_offsets,
+            ),
+        ):
+            np.save(os.path.join(path, name), array)
+
+    @classmethod
+    def load(cls, path: str) -> "ChunkMetadata":
+        return cls(
+            *(
+                np.load(os.path.join(path, name), mmap_mode="r")
+                for name in CHUNK_METADATA_FILES
+            )
+        )
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return all(
+            os.path.exists(os.path.join(path, name)) for name in CHUNK_METADATA_FILES
+        )
+
+    @staticmethod
+    def remove(path: str) -> None:
+        for name in CHUNK_METADATA_FILES:
+            file_path = os.path.join(path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
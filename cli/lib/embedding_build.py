@@ -0,0 +1,116 @@
+import itertools
+import json
+import os
+
+import numpy as np
+
+from .resources import lazy_import
+from .vector_search import normalize_rows
+
+tqdm = lazy_import("tqdm")
+
+# texts encoded per model call, bounds what a build holds in memory besides the key index
+EMBEDDING_BUILD_BATCH_SIZE = 512
+
+# rows between checkpoints, an interrupted build loses at most this many
+EMBEDDING_CHECKPOINT_ROWS = 16_384
+
+
+def partial_path(embeddings_path: str) -> str:
+    # cache/chunk_embeddings.npy is built in cache/chunk_embeddings.partial.npy
+    return f"{os.path.splitext(embeddings_path)[0]}.partial.npy"
+
+
+def checkpoint_path(embeddings_path: str) -> str:
+    return f"{os.path.splitext(embeddings_path)[0]}.checkpoint"
+
+
+def read_checkpoint(embeddings_path: str, fingerprint: str, num_rows: int) -> int:
+    # rows an interrupted build of the same texts already wrote, 0 to start over
+    if not os.path.exists(checkpoint_path(embeddings_path)) or not os.path.exists(
+        partial_path(embeddings_path)
+    ):
+        return 0
+    with open(checkpoint_path(embeddings_path), "r") as f:
+        checkpoint = json.load(f)
+    if checkpoint["fingerprint"] != fingerprint or checkpoint["num_rows"] != num_rows:
+        return 0
+    return checkpoint["rows"]
+
+
+def write_checkpoint(
+    embeddings_path: str, fingerprint: str, num_rows: int, rows: int
+) -> None:
+    path = checkpoint_path(embeddings_path)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"fingerprint": fingerprint, "num_rows": num_rows, "rows": rows}, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def stream_embeddings(
+    embeddings_path: str,
+    texts,
+    num_rows: int,
+    fingerprint: str,
+    embedding_cache,
+    model,
+    batch_size: int = EMBEDDING_BUILD_BATCH_SIZE,
+    checkpoint_rows: int = EMBEDDING_CHECKPOINT_ROWS,
+    show_progress_bar: bool = True,
+) -> None:
+    # Normalized embeddings of num_rows texts from an iterable, encoded batch by batch through
+    # the embedding cache into a preallocated memory-mapped file that replaces embeddings_path
+    # once complete. Every checkpoint_rows rows the file is flushed, the cache saved and the
+    # row count recorded, a build of the same texts after a crash continues from there.
+    # texts is only iterated once, the rows already written are skipped, not re-encoded.
+    partial = partial_path(embeddings_path)
+    row = read_checkpoint(embeddings_path, fingerprint, num_rows)
+    # stale from here on, nothing may load it next to metadata of the new texts
+    if os.path.exists(embeddings_path):
+        os.remove(embeddings_path)
+    embeddings = None
+    if row:
+        embeddings = np.load(partial, mmap_mode="r+")
+
+    os.makedirs(os.path.dirname(embeddings_path), exist_ok=True)
+    texts = iter(texts)
+    # still used by this build, compact must not drop them
+    embedding_cache.touch(itertools.islice(texts, row))
+    progress = tqdm.tqdm(
+        total=num_rows, initial=row, unit="texts", disable=not show_progress_bar
+    )
+    last_checkpoint = row
+    while batch := list(itertools.islice(texts, batch_size)):
+        vectors = normalize_rows(embedding_cache.encode(model, batch))
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(
+                partial, mode="w+", dtype=np.float32, shape=(num_rows, vectors.shape[1])
+            )
+        embeddings[row : row + len(batch)] = vectors
+        row += len(batch)
+        progress.update(len(batch))
+        if row - last_checkpoint >= checkpoint_rows and row < num_rows:
+            embeddings.flush()
+            # remapping lets go of the pages written so far, memory stays flat as rows grow
+            embeddings = np.load(partial, mmap_mode="r+")
+            embedding_cache.save()
+            write_checkpoint(embeddings_path, fingerprint, num_rows, row)
+            last_checkpoint = row
+    progress.close()
+    if row != num_rows:
+        raise ValueError(f"expected {num_rows} texts to embed, got {row}")
+
+    # saves the cache, dropping texts this build and the others no longer use. Without texts
+    # there is nothing to tell what is still used
+    if num_rows:
+        embedding_cache.compact(os.path.splitext(os.path.basename(embeddings_path))[0])
+    else:
+        embedding_cache.save()
+    if embeddings is None:
+        np.save(embeddings_path, np.empty((0, 0), dtype=np.float32))
+    else:
+        embeddings.flush()
+        del embeddings
+        os.replace(partial, embeddings_path)
+    if os.path.exists(checkpoint_path(embeddings_path)):
+        os.remove(checkpoint_path(embeddings_path))
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# appended to on save, meta.json records how many rows of them are complete and which
+# generation of the files, a compaction writes the next one
+EMBEDDING_CACHE_KEYS_FILE = "keys.bin"
+EMBEDDING_CACHE_VECTORS_FILE = "vectors.bin"
+EMBEDDING_CACHE_META_FILE = "meta.json"
+
+# keys of the texts each build used last time, one file per build
+EMBEDDING_CACHE_LIVE_DIR = "live"
+
+# share of the rows no build uses any more that makes compact rewrite the files
+EMBEDDING_CACHE_COMPACT_RATIO = 0.25
+
+# rows copied at a time while compacting
+EMBEDDING_CACHE_COMPACT_BLOCK = 65536
+
+# saved rows looked up through a dict until there are this many, then the keys get sorted again
+EMBEDDING_CACHE_UNSORTED_ROWS = 65536
+
+# hex digest length of the text keys
+EMBEDDING_KEY_LENGTH = 32
+
+KEY_DTYPE = f"S{EMBEDDING_KEY_LENGTH}"
+
+
+def text_key(model_name: str, text: str) -> str:
+    return hashlib.blake2b(
+        f"{model_name}\0{text}".encode(), digest_size=EMBEDDING_KEY_LENGTH // 2
+    ).hexdigest()
+
+
+def texts_fingerprint(model_name: str, texts) -> str:
+    # one key for a whole list of texts, changes when any text, their order or the model does
+    digest = hashlib.blake2b(digest_size=EMBEDDING_KEY_LENGTH // 2)
+    for text in texts:
+        digest.update(text_key(model_name, text).encode())
+    return digest.hexdigest()
+
+
+def generation_file(name: str, generation: int) -> str:
+    # generation 0 keeps the names caches had before compaction
+    if not generation:
+        return name
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{generation}{ext}"
+
+
+def fingerprint_path(embeddings_path: str) -> str:
+    return f"{os.path.splitext(embeddings_path)[0]}.fingerprint"
+
+
+def read_fingerprint(embeddings_path: str) -> str | None:
+    # fingerprint of the texts the saved embeddings were built from
+    if not os.path.exists(fingerprint_path(embeddings_path)):
+        return None
+    with open(fingerprint_path(embeddings_path), "r") as f:
+        return f.read().strip()
+
+
+def write_fingerprint(embeddings_path: str, fingerprint: str) -> None:
+    with open(fingerprint_path(embeddings_path), "w") as f:
+        f.write(fingerprint)
+
+
+class EmbeddingCache:
+    # Model output for every text encoded so far, keyed by a hash of the model name and the
+    # exact text. A rebuild after an edit only encodes the new or changed texts, hits and misses
+    # count the texts served from the cache and the texts encoded since it was opened.
+    # Saved keys and rows are memory-mapped on the first lookup, opening the cache only reads
+    # meta.json. Keys are found with a binary search over their sorted order, rows encoded
+    # since are the only ones held in memory and save appends them to the files instead of
+    # rewriting everything.
+    # Texts of old revisions of the corpus would stay forever, so every build ends with
+    # compact: the keys it used are recorded as that build's live set, and once a quarter of
+    # the rows are in no build's live set the files are rewritten with only the live rows.
+    def __init__(self, path: str, model_name: str) -> None:
+        self.path = path
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self.saved_rows = 0
+        self.dim = None
+        self.generation = 0
+        self.pending = None
+        # saved keys and their sorted order, mapped on the first lookup
+        self.keys = None
+        self.order = None
+        self.vectors = None
+        # row of every key past the sorted ones, saved or pending
+        self.recent = {}
+        self.pending_keys = []
+        # keys encoded or served since the last compact, one array per call
+        self.used = []
+
+        meta_path = os.path.join(path, EMBEDDING_CACHE_META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            self.saved_rows = meta["rows"]
+            self.dim = meta["dim"]
+            self.generation = meta.get("generation", 0)
+
+    def __file(self, name: str, generation: int | None = None) -> str:
+        if generation is None:
+            generation = self.generation
+        return os.path.join(self.path, generation_file(name, generation))
+
+    def __map(self) -> None:
+        # a mapping of zero rows is an error, those stay None
+        if self.keys is not None or not self.saved_rows:
+            return
+        self.keys = np.memmap(
+            self.__file(EMBEDDING_CACHE_KEYS_FILE),
+            dtype=KEY_DTYPE,
+            mode="r",
+            shape=(self.saved_rows,),
+        )
+        self.order = np.argsort(self.keys)
+        self.vectors = np.memmap(
+            self.__file(EMBEDDING_CACHE_VECTORS_FILE),
+            dtype=np.float32,
+            mode="r",
+            shape=(self.saved_rows, self.dim),
+        )
+        # every saved row is sorted now
+        self.recent = {
+            key: row for key, row in self.recent.items() if row >= self.saved_rows
+        }
+
+    def __unmap(self) -> None:
+        self.keys = None
+        self.order = None
+        self.vectors = None
+
+    def __rows(self, keys: np.ndarray) -> np.ndarray:
+        # row of every key, -1 for the ones not cached
+        self.__map()
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if self.keys is not None and len(keys):
+            at = np.minimum(
+                np.searchsorted(self.keys, keys, sorter=self.order),
+                len(self.order) - 1,
+            )
+            found = self.keys[self.order[at]] == keys
+            rows[found] = self.order[at[found]]
+        if self.recent:
+            for i in np.flatnonzero(rows < 0):
+                rows[i] = self.recent.get(keys[i], -1)
+        return rows
+
+    def __len__(self) -> int:
+        return self.saved_rows + len(self.pending_keys)
+
+    @property
+    def dirty(self) -> bool:
+        return self.pending is not None
+
+    def __keys(self, texts) -> np.ndarray:
+        keys = np.array(
+            [text_key(self.model_name, text) for text in texts], dtype=KEY_DTYPE
+        )
+        self.used.append(keys)
+        return keys
+
+    def encode(self, model, texts: list[str], **encode_kwargs) -> np.ndarray:
+        # embeddings of the texts in order, encoding only the ones not cached yet
+        keys = self.__keys(texts)
+        if not len(keys):
+            return np.empty((0, 0), dtype=np.float32)
+        rows = self.__rows(keys)
+        missing = {}
+        for i in np.flatnonzero(rows < 0):
+            missing.setdefault(keys[i], texts[i])
+        self.misses += len(missing)
+        self.hits += int(np.count_nonzero(rows >= 0))
+
+        if missing:
+            vectors = np.asarray(
+                model.encode(list(missing.values()), **encode_kwargs), dtype=np.float32
+            )
+            for key in missing:
+                self.recent[key] = len(self)
+                self.pending_keys.append(key)
+            if self.pending is None:
+                self.pending = vectors
+            else:
+                self.pending = np.concatenate((self.pending, vectors))
+            for i in np.flatnonzero(rows < 0):
+                rows[i] = self.recent[keys[i]]
+
+        saved = rows < self.saved_rows
+        if saved.all():
+            return np.asarray(self.vectors[rows])
+        embeddings = np.empty((len(rows), self.pending.shape[1]), dtype=np.float32)
+        if saved.any():
+            embeddings[saved] = self.vectors[rows[saved]]
+        embeddings[~saved] = self.pending[rows[~saved] - self.saved_rows]
+        return embeddings
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        # rows past the count in meta.json are left over from an interrupted save, overwrite them
+        new_keys = np.array(self.pending_keys, dtype=KEY_DTYPE)
+        for name, array, row_bytes in (
+            (EMBEDDING_CACHE_KEYS_FILE, new_keys, EMBEDDING_KEY_LENGTH),
+            (EMBEDDING_CACHE_VECTORS_FILE, self.pending, self.pending[0].nbytes),
+        ):
+            file_path = self.__file(name)
+            with open(file_path, "r+b" if os.path.exists(file_path) else "wb") as f:
+                f.seek(self.saved_rows * row_bytes)
+                f.write(array.tobytes())
+                f.truncate()
+                os.fsync(f.fileno())
+
+        self.dim = self.pending.shape[1]
+        self.__write_meta(len(self), self.dim, self.generation)
+        self.saved_rows = len(self)
+        self.pending = None
+        self.pending_keys = []
+        # the mapping only covers the rows saved before, the new ones stay in recent until
+        # there are enough of them to sort everything again
+        if self.keys is None or len(self.recent) > EMBEDDING_CACHE_UNSORTED_ROWS:
+            self.__unmap()
+        else:
+            self.vectors = np.memmap(
+                self.__file(EMBEDDING_CACHE_VECTORS_FILE),
+                dtype=np.float32,
+                mode="r",
+                shape=(self.saved_rows, self.dim),
+            )
+
+    def __write_meta(self, rows: int, dim: int, generation: int) -> None:
+        meta_path = os.path.join(self.path, EMBEDDING_CACHE_META_FILE)
+        with open(f"{meta_path}.tmp", "w") as f:
+            json.dump({"rows": rows, "dim": dim, "generation": generation}, f)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    def touch(self, texts) -> None:
+        # texts a build uses without encoding them, like the rows a resumed build skips
+        self.__keys(list(texts))
+
+    def compact(self, build: str) -> int:
+        # records the texts used since the last compact as everything build needs and drops
+        # the rows no build needs once there are enough of them, returns the rows dropped.
+        # A build that used no texts records nothing, an empty live set would make every
+        # row of the cache look unused.
+        self.save()
+        used = np.unique(np.concatenate(self.used + [np.empty(0, dtype=KEY_DTYPE)]))
+        self.used = []
+        if not len(used):
+            return 0
+        live_dir = os.path.join(self.path, EMBEDDING_CACHE_LIVE_DIR)
+        os.makedirs(live_dir, exist_ok=True)
+        live_path = os.path.join(live_dir, f"{build}.bin")
+        used.tofile(f"{live_path}.tmp")
+        os.replace(f"{live_path}.tmp", live_path)
+
+        # mapped again so the keys cover every saved row
+        self.__unmap()
+        self.__map()
+        if self.keys is None:
+            return 0
+        live = np.concatenate(
+            [
+                np.fromfile(os.path.join(live_dir, name), dtype=KEY_DTYPE)
+                for name in os.listdir(live_dir)
+                if name.endswith(".bin")
+            ]
+        )
+        rows = np.flatnonzero(np.isin(self.keys, live))
+        dropped = self.saved_rows - len(rows)
+        if not dropped or dropped < EMBEDDING_CACHE_COMPACT_RATIO * self.saved_rows:
+            return 0
+        self.__rewrite(rows)
+        return dropped
+
+    def __rewrite(self, rows: np.ndarray) -> None:
+        # the live rows go into files of the next generation, replacing meta.json switches
+        # to them at once so a crash leaves either the old or the new files in use
+        generation = self.generation + 1
+        with open(self.__file(EMBEDDING_CACHE_KEYS_FILE, generation), "wb") as f:
+            f.write(np.ascontiguousarray(self.keys[rows]).tobytes())
+            os.fsync(f.fileno())
+        with open(self.__file(EMBEDDING_CACHE_VECTORS_FILE, generation), "wb") as f:
+            for start in range(0, len(rows), EMBEDDING_CACHE_COMPACT_BLOCK):
+                block = rows[start : start + EMBEDDING_CACHE_COMPACT_BLOCK]
+                f.write(np.ascontiguousarray(self.vectors[block]).tobytes())
+            os.fsync(f.fileno())
+        self.__write_meta(len(rows), self.dim, generation)
+
+        self.__unmap()
+        for name in (EMBEDDING_CACHE_KEYS_FILE, EMBEDDING_CACHE_VECTORS_FILE):
+            os.remove(self.__file(name))
+        self.generation = generation
+        self.saved_rows = len(rows)
+        self.recent = {}
@@ -0,0 +1,89 @@
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .resources import lazy_import, sentence_transformer
+
+# texts per task, big enough that pickling the slice and its embeddings stays cheap next to
+# encoding it, small enough that a batch spreads over every worker
+ENCODING_POOL_SLICE_SIZE = 128
+
+
+def worker_threads(workers: int) -> int:
+    # torch intra-op threads per worker, the cores split evenly so workers do not oversubscribe
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _init_worker(model_name: str, threads: int) -> None:
+    torch = lazy_import("torch")
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    # loaded once here, every slice this worker encodes reuses it
+    sentence_transformer(model_name).get()
+
+
+def _encode_slice(model_name: str, texts: list[str], encode_kwargs: dict):
+    return np.asarray(
+        sentence_transformer(model_name).encode(texts, **encode_kwargs),
+        dtype=np.float32,
+    )
+
+
+class EncodingPool:
+    # Spreads encode calls over worker processes that each load their own copy of the model and
+    # a share of the cores. Slices come back in submission order, so the embeddings are the
+    # same as a single process produces. It has the model's encode, anything that builds
+    # embeddings through a model can be given a pool instead. The workers start on the first
+    # encode, a build served from the embedding cache never starts them.
+    def __init__(
+        self, model_name: str, workers: int, threads_per_worker: int | None = None
+    ) -> None:
+        self.model_name = model_name
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or worker_threads(workers)
+        self.executor = None
+
+    def __enter__(self) -> "EncodingPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def start(self) -> None:
+        if self.executor is None:
+            # spawn, a forked copy of a parent that already ran torch can deadlock
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name, self.threads_per_worker),
+            )
+
+    def encode(self, texts: list[str], **encode_kwargs) -> np.ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        self.start()
+        # a progress bar per slice would interleave across workers
+        encode_kwargs.pop("show_progress_bar", None)
+        slices = [
+            texts[start : start + ENCODING_POOL_SLICE_SIZE]
+            for start in range(0, len(texts), ENCODING_POOL_SLICE_SIZE)
+        ]
+        return np.concatenate(
+            list(
+                self.executor.map(
+                    _encode_slice,
+                    itertools.repeat(self.model_name),
+                    slices,
+                    itertools.repeat(encode_kwargs),
+                )
+            )
+        )
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
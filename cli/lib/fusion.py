@@ -0,0 +1,247 @@
+import numpy as np
+
+from .bm25 import select_top_k
+from .ranked_list import RankedList
+
+FUSION_STRATEGIES = ("rrf", "combsum", "combmnz", "weighted")
+
+SCORE_NORMALIZATIONS = ("minmax", "zscore")
+
+RRF_K = 60
+
+
+def minmax_scale(scores, low: float, high: float) -> np.ndarray:
+    # scores of a list whose lowest and highest scores are low and high, scaled to 0..1
+    scores = np.asarray(scores, dtype=np.float64)
+    if low == high:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def normalize(scores, method: str = "minmax") -> np.ndarray:
+    # float64 like the python floats the scores were fused as before, a constant list is all
+    # 1.0 for min-max and all 0.0 for z-score
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) == 0:
+        return scores
+    match method:
+        case "minmax":
+            return minmax_scale(scores, scores.min(), scores.max())
+        case "zscore":
+            std = scores.std()
+            if std == 0:
+                return np.zeros_like(scores)
+            return (scores - scores.mean()) / std
+        case _:
+            raise ValueError(f"unknown score normalization: {method}")
+
+
+class DocIndex:
+    # Dense mapping of document ids to their position in the documents list, a lookup array
+    # indexed by id, so a retriever's whole result list is aligned with one fancy index.
+    # Ids it does not know map to -1.
+    def __init__(self, doc_ids) -> None:
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        self.positions = np.full(
+            int(doc_ids.max()) + 1 if len(doc_ids) else 0, -1, dtype=np.int64
+        )
+        self.positions[doc_ids] = np.arange(len(doc_ids))
+        self.size = len(doc_ids)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __call__(self, doc_ids) -> np.ndarray:
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        known = (doc_ids >= 0) & (doc_ids < len(self.positions))
+        positions = np.full(len(doc_ids), -1, dtype=np.int64)
+        positions[known] = self.positions[doc_ids[known]]
+        return positions
+
+    def add(self, doc_ids) -> None:
+        # new ids, in order, get the positions after the ones mapped so far
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(doc_ids) and doc_ids.max() >= len(self.positions):
+            grown = np.full(int(doc_ids.max()) + 1, -1, dtype=np.int64)
+            grown[: len(self.positions)] = self.positions
+            self.positions = grown
+        self.positions[doc_ids] = np.arange(self.size, self.size + len(doc_ids))
+        self.size += len(doc_ids)
+
+
+class FusionCandidates:
+    # Documents and what every retriever said about them. Column j is document positions[j],
+    # scores[r, j] the normalized score retriever r gave it and ranks[r, j] its 1-based rank
+    # there, rank 0 and score 0 when r did not return it. Columns are in the order the
+    # documents were first returned, retrievers in turn, so ties keep the order a stable sort
+    # over the merged lists gave.
+    def __init__(
+        self, positions: np.ndarray, scores: np.ndarray, ranks: np.ndarray
+    ) -> None:
+        self.positions = positions
+        self.scores = scores
+        self.ranks = ranks
+        self.present = ranks > 0
+
+    @classmethod
+    def align(
+        cls, retrieved: list[tuple[np.ndarray, np.ndarray]], normalization: str
+    ) -> "FusionCandidates":
+        # the union of ranked (positions, scores) lists
+        lengths = [len(positions) for positions, _ in retrieved]
+        merged = np.concatenate([positions for positions, _ in retrieved])
+        unique, first, inverse = np.unique(
+            merged, return_index=True, return_inverse=True
+        )
+        order = np.argsort(first)
+        column = np.empty(len(unique), dtype=np.int64)
+        column[order] = np.arange(len(unique))
+        columns = np.split(column[inverse], np.cumsum(lengths)[:-1])
+
+        scores = np.zeros((len(retrieved), len(unique)), dtype=np.float64)
+        ranks = np.zeros((len(retrieved), len(unique)), dtype=np.int64)
+        for r, ((_, list_scores), cols) in enumerate(zip(retrieved, columns)):
+            scores[r, cols] = normalize(list_scores, normalization)
+            ranks[r, cols] = np.arange(1, len(cols) + 1)
+        return cls(unique[order], scores, ranks)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+def fuse(
+    candidates: FusionCandidates,
+    strategy: str,
+    weights=None,
+    k: int = RRF_K,
+) -> np.ndarray:
+    # one fused score per candidate. weights are per retriever for weighted fusion, the
+    # retrievers add up one after the other so the floats match the old per document sums.
+    match strategy:
+        case "rrf":
+            contributions = np.where(
+                candidates.present, 1 / (k + candidates.ranks), 0.0
+            )
+        case "combsum" | "combmnz":
+            contributions = candidates.scores
+        case "weighted":
+            if weights is None or len(weights) != len(candidates.scores):
+                raise ValueError("weighted fusion needs one weight per retriever")
+            contributions = [
+                weight * scores for weight, scores in zip(weights, candidates.scores)
+            ]
+        case _:
+            raise ValueError(f"unknown fusion strategy: {strategy}")
+    fused = np.zeros(len(candidates), dtype=np.float64)
+    for scores in contributions:
+        fused += scores
+    if strategy == "combmnz":
+        fused *= candidates.present.sum(axis=0)
+    return fused
+
+
+def top_k_candidates(fused: np.ndarray, limit: int) -> list[tuple[int, float]]:
+    # (column, fused score) of the best candidates, ties in first returned order
+    return select_top_k(np.arange(len(fused)), fused, limit)
+
+
+def threshold_fuse(
+    lists: list[RankedList],
+    strategy: str,
+    limit: int,
+    weights=None,
+    k: int = RRF_K,
+    batch_size: int | None = None,
+) -> tuple[FusionCandidates, list[tuple[int, float]], dict]:
+    # Fagin's threshold algorithm over ranked lists, the same top limit fuse and
+    # top_k_candidates give over the whole lists. Every round reads the next batch of each
+    # list, twice as many as the round before, and looks up the ranks of the new documents in
+    # the other lists, so every document seen has its exact fused score. A document not seen
+    # yet is below the top of every list, it can score at most the threshold: the fused score
+    # of one at the current depth of every list. Reading stops once the limit-th best seen
+    # score is above it. Candidates are the documents seen, stats how deep each list was read.
+    # The retrievers score their whole lists up front, stopping early only saves the sorting
+    # and fusion of the documents below the stop.
+    match strategy:
+        case "rrf":
+            pass
+        case "weighted" | "combsum":
+            if strategy == "combsum":
+                weights = [1.0] * len(lists)
+            if weights is None or len(weights) != len(lists):
+                raise ValueError("weighted fusion needs one weight per retriever")
+            if min(weights) < 0:
+                raise ValueError("threshold fusion needs non-negative weights")
+        case _:
+            raise ValueError(f"threshold fusion does not support {strategy} fusion")
+    ranges = [ranked.score_range() for ranked in lists]
+
+    def candidates_of(docs):
+        ranks = np.stack([ranked.ranks(docs) for ranked in lists])
+        scores = np.stack(
+            [
+                minmax_scale(ranked.reported_scores(docs), *score_range)
+                for ranked, score_range in zip(lists, ranges)
+            ]
+        )
+        return FusionCandidates(docs, np.where(ranks > 0, scores, 0.0), ranks)
+
+    def threshold():
+        fused = 0.0
+        for r, ranked in enumerate(lists):
+            if ranked.exhausted:
+                continue
+            if strategy == "rrf":
+                fused += 1 / (k + ranked.depth + 1)
+            else:
+                fused += weights[r] * float(
+                    minmax_scale([ranked.bound()], *ranges[r])[0]
+                )
+        return fused
+
+    seen = set()
+    found, fused = [], []
+    batch = batch_size or max(limit, 1)
+    rounds = 0
+    while limit > 0:
+        rounds += 1
+        new = [int(doc) for ranked in lists for doc in ranked.read(batch)]
+        new = np.array(
+            [doc for doc in dict.fromkeys(new) if doc not in seen], dtype=np.int64
+        )
+        seen.update(new.tolist())
+        if len(new):
+            found.append(candidates_of(new))
+            fused.append(fuse(found[-1], strategy, weights, k))
+        if all(ranked.exhausted for ranked in lists):
+            break
+        if len(seen) >= limit:
+            all_fused = np.concatenate(fused)
+            if np.partition(all_fused, -limit)[-limit] > threshold():
+                break
+        batch *= 2
+
+    docs = np.concatenate([c.positions for c in found] + [np.empty(0, np.int64)])
+    scores = np.concatenate(
+        [c.scores for c in found] + [np.empty((len(lists), 0))], axis=1
+    )
+    ranks = np.concatenate(
+        [c.ranks for c in found] + [np.empty((len(lists), 0), np.int64)], axis=1
+    )
+    # columns in the order the whole lists merged would first return them
+    offsets = np.cumsum([0] + [len(ranked) for ranked in lists[:-1]])
+    first_list = np.argmax(ranks > 0, axis=0)
+    first_seen = offsets[first_list] + ranks[first_list, np.arange(len(docs))] - 1
+    order = np.argsort(first_seen)
+    candidates = FusionCandidates(docs[order], scores[:, order], ranks[:, order])
+    stats = {
+        "depths": [ranked.depth for ranked in lists],
+        "lengths": [len(ranked) for ranked in lists],
+        "candidates": len(candidates),
+        "rounds": rounds,
+    }
+    return (
+        candidates,
+        top_k_candidates(fuse(candidates, strategy, weights, k), limit),
+        stats,
+    )
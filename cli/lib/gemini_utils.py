@@ -1,18 +1,25 @@
-from google import genai
-from google.genai import errors
 import os
-from dotenv import load_dotenv
 import time
 import json
-from sentence_transformers import CrossEncoder
 
-load_dotenv()
+from .resources import cross_encoder as cross_encoder_model
+from .resources import lazy_import, lazy_resource
 
-api_key = os.environ.get("GEMINI_API_KEY")
-client = genai.Client(api_key=api_key)
+# google.genai and the cross encoder load on first use, not when this module is imported
+dotenv = lazy_import("dotenv")
+genai = lazy_import("google.genai")
+errors = lazy_import("google.genai.errors")
+
+
+def create_client():
+    dotenv.load_dotenv()
+    return genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+
+
+client = lazy_resource("gemini client", create_client)
 model = "gemini-2.5-flash-lite"
 
-cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
+cross_encoder = cross_encoder_model()
 
 
 def enhance_query(query: str, method: str):
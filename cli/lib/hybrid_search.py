@@ -1,121 +1,371 @@
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+
+from .fusion import (
+    RRF_K,
+    DocIndex,
+    FusionCandidates,
+    fuse,
+    normalize,
+    threshold_fuse,
+    top_k_candidates,
+)
 from .gemini_utils import enhance_query, rerank
 from .keyword_search import InvertedIndex
+from .embedding_cache import read_fingerprint
+from .query_cache import format_query_cache_stats
+from .result_cache import (
+    format_result_cache_stats,
+    get_result_cache,
+    index_version,
+    result_key,
+)
 from .semantic_search import ChunkedSemanticSearch
 from .search_utils import load_movies
 
+# candidates each retriever returns per result asked for, before fusion
+HYBRID_CANDIDATE_MULTIPLIER = 500
+
+RETRIEVERS = ("bm25", "semantic")
+
 
 class HybridSearch:
-    def __init__(self, documents):
-        self.documents = documents
+    # BM25 and chunked semantic search over the same movies, fused per query. The two
+    # retrievers run concurrently on a thread pool, numpy and torch release the GIL for the
+    # heavy parts. timings keeps the milliseconds each retriever took for every query.
+    # Results are cached by query, parameters and the version of the indexes they came from,
+    # unless cache_results is False.
+    def __init__(
+        self,
+        documents,
+        candidate_multiplier=HYBRID_CANDIDATE_MULTIPLIER,
+        cache_results=True,
+    ):
+        # documents the keyword index got after movies.json was loaded are added on the way
+        self.documents = list(documents)
+        self.doc_index = DocIndex([doc["id"] for doc in documents])
+        self.candidate_multiplier = candidate_multiplier
         self.semantic_search = ChunkedSemanticSearch()
         self.semantic_search.load_or_create_chunk_embeddings(documents)
+        # query embeddings are shared with every other search using the same model
+        self.query_cache = self.semantic_search.query_cache
 
         self.idx = InvertedIndex()
-        if not os.path.exists(self.idx.index_path):
+        if self.idx.exists():
+            # once here, every query reuses it, the arrays with every applied delta if saved
+            self.idx.load()
+        else:
             self.idx.build()
             self.idx.save()
+        # the most movies either retriever can return
+        self.num_documents = max(len(documents), len(self.idx.docmap))
+
+        # a rebuilt keyword index or new chunk embeddings never get the old results
+        self.index_version = index_version(
+            self.idx.version(),
+            read_fingerprint(self.semantic_search.chunk_embeddings_path),
+            self.semantic_search.precision,
+        )
+        self.result_cache = get_result_cache() if cache_results else None
+
+        self.executor = ThreadPoolExecutor(max_workers=len(RETRIEVERS))
+        self.timings = {retriever: [] for retriever in RETRIEVERS}
+        # how deep the last threshold fusion read each ranked list
+        self.fusion_stats = {}
 
     def _bm25_search(self, query, limit):
-        self.idx.load()
         return self.idx.bm25_search(query, limit)
 
-    def hybrid_score(self, bm25_score, semantic_score, alpha=0.5):
-        return alpha * bm25_score + (1 - alpha) * semantic_score
+    def candidate_depth(self, limit, depth=None):
+        # no retriever returns more movies than there are, asking for more only costs time
+        if depth is None:
+            depth = limit * self.candidate_multiplier
+        return max(limit, min(depth, self.num_documents))
+
+    def __timed(self, retriever, search, *args):
+        start = time.perf_counter()
+        result = search(*args)
+        self.timings[retriever].append((time.perf_counter() - start) * 1000)
+        return result
 
-    def weighted_search(self, query, alpha, limit=5):
-        bm25_result = self._bm25_search(query, limit * 500)
-        semantic_result = self.semantic_search.search_chunks(query, limit * 500)
+    def __timed_many(self, retriever, search, queries, *args):
+        # a batch counts as len(queries) queries of its average latency
+        start = time.perf_counter()
+        results = search(queries, *args)
+        elapsed = (time.perf_counter() - start) * 1000
+        self.timings[retriever].extend([elapsed / len(queries)] * len(queries))
+        return results
 
-        bm25_max = max(item[1] for item in bm25_result)
-        bm25_min = min(item[1] for item in bm25_result)
-        semantic_max = max(item["score"] for item in semantic_result)
-        semantic_min = min(item["score"] for item in semantic_result)
+    def retrieve(self, query, depth):
+        # (bm25 results, semantic results) of depth candidates each, searched concurrently
+        bm25 = self.executor.submit(
+            self.__timed, "bm25", self._bm25_search, query, depth
+        )
+        semantic = self.executor.submit(
+            self.__timed,
+            "semantic",
+            self.semantic_search.search_chunks,
+            query,
+            depth,
+        )
+        return bm25.result(), semantic.result()
 
-        results = {}
+    def retrieve_many(self, queries, depth):
+        # retrieve of every query, each retriever searches the whole batch in one call
+        if not queries:
+            return []
+        bm25 = self.executor.submit(
+            self.__timed_many, "bm25", self.idx.bm25_search_many, queries, depth
+        )
+        semantic = self.executor.submit(
+            self.__timed_many,
+            "semantic",
+            self.semantic_search.search_chunks_many,
+            queries,
+            depth,
+        )
+        return list(zip(bm25.result(), semantic.result()))
 
-        for doc, score in bm25_result:
-            normalized_score = self.normalize_score(score, bm25_min, bm25_max)
-            results[doc["id"]] = {
-                "document": doc,
-                "scores": {"keyword": normalized_score, "semantic": 0.0},
-                "hybrid_score": self.hybrid_score(normalized_score, 0.0, alpha),
+    def cached(self, search, query, params, run):
+        # run's results for the query, from the result cache when they are there
+        if self.result_cache is None:
+            return run()
+        key = result_key(self.index_version, search, query, **params)
+        return self.result_cache.cached(key, run)
+
+    def __cached_many(self, search, queries, params, run_many):
+        # run_many only searches the queries whose results are not cached, each once
+        if self.result_cache is None:
+            return run_many(queries)
+        keys = [
+            result_key(self.index_version, search, query, **params) for query in queries
+        ]
+        results = [self.result_cache.get(key) for key in keys]
+        missing = {
+            key: query
+            for key, query, result in zip(keys, queries, results)
+            if result is None
+        }
+        found = dict(zip(missing, run_many(list(missing.values())))) if missing else {}
+        for key, result in found.items():
+            self.result_cache.put(key, result)
+        return [
+            found[key] if result is None else result
+            for key, result in zip(keys, results)
+        ]
+
+    def timing_stats(self):
+        # percentiles of each retriever's latency over the queries so far
+        return {
+            retriever: {
+                "queries": len(timings),
+                "p50": float(np.percentile(timings, 50)) if timings else 0.0,
+                "p99": float(np.percentile(timings, 99)) if timings else 0.0,
+                "max": max(timings, default=0.0),
             }
+            for retriever, timings in self.timings.items()
+        }
+
+    def positions(self, doc_ids):
+        # position of every document id in documents, ids only the keyword index has, like
+        # movies added with apply-delta, are appended with their body from its docmap
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        positions = self.doc_index(doc_ids)
+        if (positions < 0).any():
+            missing = np.unique(doc_ids[positions < 0])
+            self.documents.extend(self.idx.docmap[int(doc_id)] for doc_id in missing)
+            self.doc_index.add(missing)
+            positions = self.doc_index(doc_ids)
+        return positions
 
-        for r in semantic_result:
-            doc_id = r["id"]
-            normalized_score = self.normalize_score(
-                r["score"], semantic_min, semantic_max
+    def fusion_candidates(self, bm25_result, semantic_result, normalization="minmax"):
+        # both result lists as document positions and scores, aligned into one candidate set
+        retrieved = [
+            (
+                self.positions(
+                    np.fromiter((doc["id"] for doc, _ in bm25_result), np.int64)
+                ),
+                np.fromiter((score for _, score in bm25_result), np.float64),
+            ),
+            (
+                self.positions(
+                    np.fromiter((r["id"] for r in semantic_result), np.int64)
+                ),
+                np.fromiter((r["score"] for r in semantic_result), np.float64),
+            ),
+        ]
+        return FusionCandidates.align(retrieved, normalization)
+
+    def __fuse(self, retrieved, strategy, limit, normalization="minmax", **params):
+        candidates = self.fusion_candidates(*retrieved, normalization)
+        fused = fuse(candidates, strategy, **params)
+        return candidates, top_k_candidates(fused, limit)
+
+    def ranked_lists(self, query, depth):
+        # bm25 and semantic ranked lists of depth movies each, scored concurrently
+        bm25 = self.executor.submit(
+            self.__timed, "bm25", self.idx.bm25_ranked, query, depth
+        )
+        semantic = self.executor.submit(
+            self.__timed,
+            "semantic",
+            self.semantic_search.search_chunks_ranked,
+            query,
+            depth,
+        )
+        return [bm25.result(), semantic.result()]
+
+    def __threshold_fuse(self, query, depth, strategy, limit, **params):
+        candidates, top, stats = threshold_fuse(
+            self.ranked_lists(query, depth), strategy, limit, **params
+        )
+        self.fusion_stats = dict(
+            stats,
+            depths=dict(zip(RETRIEVERS, stats["depths"])),
+            lengths=dict(zip(RETRIEVERS, stats["lengths"])),
+        )
+        # the ranked lists are keyed by movie id
+        candidates.positions = self.positions(candidates.positions)
+        return candidates, top
+
+    def weighted_search(self, query, alpha, limit=5, depth=None, threshold=False):
+        depth = self.candidate_depth(limit, depth)
+
+        def search():
+            weights = (alpha, 1 - alpha)
+            if threshold:
+                return self.__weighted_results(
+                    *self.__threshold_fuse(
+                        query, depth, "weighted", limit, weights=weights
+                    )
+                )
+            return self.__weighted_results(
+                *self.__fuse(
+                    self.retrieve(query, depth), "weighted", limit, weights=weights
+                )
             )
-            if doc_id in results:
-                results[doc_id]["scores"]["semantic"] = normalized_score
-                results[doc_id]["hybrid_score"] = self.hybrid_score(
-                    results[doc_id]["scores"]["keyword"], normalized_score, alpha
+
+        params = {"alpha": alpha, "limit": limit, "depth": depth}
+        return self.cached("weighted", query, params, search)
+
+    def weighted_search_many(self, queries, alpha, limit=5, depth=None):
+        # weighted_search of every query, the ones not cached retrieved in one batch
+        depth = self.candidate_depth(limit, depth)
+
+        def search_many(queries):
+            return [
+                self.__weighted_results(
+                    *self.__fuse(
+                        retrieved, "weighted", limit, weights=(alpha, 1 - alpha)
+                    )
                 )
-            else:
-                results[doc_id] = {
-                    "document": self.idx.docmap[doc_id],
-                    "scores": {"keyword": 0.0, "semantic": normalized_score},
-                    "hybrid_score": self.hybrid_score(0.0, normalized_score, alpha),
-                }
-
-        sorted_results = sorted(
-            results.values(), key=lambda key: key["hybrid_score"], reverse=True
-        )
-        return sorted_results[:limit]
+                for retrieved in self.retrieve_many(queries, depth)
+            ]
+
+        params = {"alpha": alpha, "limit": limit, "depth": depth}
+        queries = [query.strip() for query in queries]
+        return self.__cached_many("weighted", queries, params, search_many)
+
+    def __weighted_results(self, candidates, top, score_key="hybrid_score"):
+        return [
+            {
+                "document": self.documents[candidates.positions[column]],
+                "scores": {
+                    "keyword": float(candidates.scores[0, column]),
+                    "semantic": float(candidates.scores[1, column]),
+                },
+                score_key: score,
+            }
+            for column, score in top
+        ]
+
+    def rrf_search(self, query, k, limit=10, depth=None, threshold=False):
+        depth = self.candidate_depth(limit, depth)
+
+        def search():
+            if threshold:
+                return self.__rrf_results(
+                    *self.__threshold_fuse(query, depth, "rrf", limit, k=k)
+                )
+            retrieved = self.retrieve(query, depth)
+            return self.__rrf_results(*self.__fuse(retrieved, "rrf", limit, k=k))
 
-    def normalize_score(self, score, min_score, max_score):
-        return (score - min_score) / (max_score - min_score)
+        params = {"k": k, "limit": limit, "depth": depth}
+        return self.cached("rrf", query, params, search)
 
-    def rrf_search(self, query, k, limit=10):
-        bm25_result = self._bm25_search(query, limit * 500)
-        semantic_result = self.semantic_search.search_chunks(query, limit * 500)
+    def rrf_search_many(self, queries, k, limit=10, depth=None):
+        # rrf_search of every query, the ones not cached retrieved in one batch
+        depth = self.candidate_depth(limit, depth)
 
-        results = {}
+        def search_many(queries):
+            return [
+                self.__rrf_results(*self.__fuse(retrieved, "rrf", limit, k=k))
+                for retrieved in self.retrieve_many(queries, depth)
+            ]
 
-        for rank, (doc, _) in enumerate(bm25_result, 1):
-            rrf_score = 1 / (k + rank)
-            results[doc["id"]] = {
-                "document": doc,
-                "ranks": {"keyword": rank, "semantic": None},
-                "combined_rrf_score": rrf_score,
+        params = {"k": k, "limit": limit, "depth": depth}
+        queries = [query.strip() for query in queries]
+        return self.__cached_many("rrf", queries, params, search_many)
+
+    def __rrf_results(self, candidates, top):
+        return [
+            {
+                "document": self.documents[candidates.positions[column]],
+                "ranks": {
+                    retriever: (
+                        int(candidates.ranks[r, column])
+                        if candidates.present[r, column]
+                        else None
+                    )
+                    for r, retriever in enumerate(("keyword", "semantic"))
+                },
+                "combined_rrf_score": score,
             }
+            for column, score in top
+        ]
 
-        for rank, r in enumerate(semantic_result, 1):
-            doc_id = r["id"]
-            rrf_score = 1 / (k + rank)
-            if doc_id in results:
-                results[doc_id]["ranks"]["semantic"] = rank
-                results[doc_id]["combined_rrf_score"] += rrf_score
-            else:
-                results[doc_id] = {
-                    "document": r["document"],
-                    "ranks": {"keyword": None, "semantic": rank},
-                    "combined_rrf_score": rrf_score,
-                }
-
-        sorted_results = sorted(
-            results.values(), key=lambda key: key["combined_rrf_score"], reverse=True
+    def fusion_search(
+        self, query, strategy, limit=5, depth=None, normalization="minmax", k=RRF_K
+    ):
+        # any of the fusion strategies, weighted fusion weighs both retrievers the same
+        retrieved = self.retrieve(query, self.candidate_depth(limit, depth))
+        return self.__weighted_results(
+            *self.__fuse(
+                retrieved, strategy, limit, normalization, k=k, weights=(0.5, 0.5)
+            ),
+            score_key="fused_score",
         )
-        return sorted_results[:limit]
 
 
-def normalize_scores(scores: list[float]) -> list[float]:
-    if not scores:
-        return []
-    min_score = min(scores)
-    max_score = max(scores)
+def normalize_scores(scores: list[float], method: str = "minmax") -> list[float]:
+    return normalize(scores, method).tolist()
 
-    if min_score == max_score:
-        return [1.0 for _ in range(len(scores))]
 
-    return [(score - min_score) / (max_score - min_score) for score in scores]
+def format_timing_stats(stats: dict) -> str:
+    return "Retrieval: " + ", ".join(
+        f"{retriever} p50 {s['p50']:.1f} ms / p99 {s['p99']:.1f} ms / max {s['max']:.1f} ms"
+        for retriever, s in stats.items()
+    )
 
 
-def weighed_search(query, alpha, limit):
-    hs = HybridSearch(load_movies())
-    results = hs.weighted_search(query.strip(), alpha, limit)
+def format_fusion_stats(stats: dict) -> str:
+    return (
+        "Threshold fusion: read "
+        + ", ".join(
+            f"{retriever} {depth}/{stats['lengths'][retriever]}"
+            for retriever, depth in stats["depths"].items()
+        )
+        + f" in {stats['rounds']} rounds, {stats['candidates']} candidates"
+    )
+
+
+def weighed_search(
+    query, alpha, limit, depth=None, cache_results=True, threshold=False
+):
+    hs = HybridSearch(load_movies(), cache_results=cache_results)
+    results = hs.weighted_search(query.strip(), alpha, limit, depth, threshold)
     for idx, r in enumerate(results, 1):
         print(f'{idx}. {r["document"]["title"]}')
         print(f'Hybrid Score: {r["hybrid_score"]}')
@@ -124,30 +374,83 @@ def weighed_search(query, alpha, limit):
         print()
 
 
-def rrf_search(query, k, limit, enhance=None, rerank_method=None, debug=False):
+def fusion_search(query, strategy, limit, depth=None, normalization="minmax", k=RRF_K):
     hs = HybridSearch(load_movies())
-    if debug:
-        print("DEBUGGING: original query: " + query)
-    if enhance:
-        query = enhance_query(query, method=enhance)
-        if debug:
-            print("DEBUGGING: enhanced query: " + query)
-    if rerank_method:
-        results = hs.rrf_search(query.strip(), k, limit * 5)
-        if debug:
-            print(f"DEBUGGING: rrf results:")
-            print_results(results)
-        results = rerank(query, results, method=rerank_method)
+    results = hs.fusion_search(query.strip(), strategy, limit, depth, normalization, k)
+    for idx, r in enumerate(results, 1):
+        print(f'{idx}. {r["document"]["title"]}')
+        print(f'Fused Score: {r["fused_score"]:.4f}')
+        print(
+            f'BM25: {r["scores"]["keyword"]:.4f}, Semantic: {r["scores"]["semantic"]:.4f}'
+        )
+        print(r["document"]["description"][:200] + "...")
+        print()
+
+
+def rrf_search(
+    query,
+    k,
+    limit,
+    enhance=None,
+    rerank_method=None,
+    debug=False,
+    depth=None,
+    hs=None,
+    cache_results=True,
+    threshold=False,
+):
+    # hs is reused when given, callers searching many queries load the indexes once
+    if hs is None:
+        hs = HybridSearch(load_movies(), cache_results=cache_results)
+
+    def search():
+        enhanced_query = query
         if debug:
-            print(f"DEBUGGING: rrf-rerank results:")
-            print_results(results, rerank_method)
+            print("DEBUGGING: original query: " + query)
+        if enhance:
+            enhanced_query = enhance_query(query, method=enhance)
+            if debug:
+                print("DEBUGGING: enhanced query: " + enhanced_query)
+        if rerank_method:
+            results = hs.rrf_search(
+                enhanced_query.strip(), k, limit * 5, depth, threshold
+            )
+            if debug:
+                print(f"DEBUGGING: rrf results:")
+                print_results(results)
+            results = rerank(enhanced_query, results, method=rerank_method)
+            if debug:
+                print(f"DEBUGGING: rrf-rerank results:")
+                print_results(results, rerank_method)
+        else:
+            results = hs.rrf_search(enhanced_query.strip(), k, limit, depth, threshold)
+            if debug:
+                print(f"DEBUGGING: rrf-results:")
+                print_results(results, rerank_method)
+        return results[:limit]
+
+    if enhance or rerank_method:
+        # the llm calls are the slow part, the whole pipeline is cached under the original query
+        params = {
+            "k": k,
+            "limit": limit,
+            "depth": depth,
+            "enhance": enhance,
+            "rerank_method": rerank_method,
+        }
+        results = hs.cached("rrf-pipeline", query, params, search)
     else:
-        results = hs.rrf_search(query.strip(), k, limit)
-        if debug:
-            print(f"DEBUGGING: rrf-results:")
-            print_results(results, rerank_method)
+        results = search()
+    if debug:
+        print("DEBUGGING: " + format_query_cache_stats(hs.query_cache.stats()))
+        if hs.result_cache is not None:
+            print("DEBUGGING: " + format_result_cache_stats(hs.result_cache.stats()))
+        print("DEBUGGING: " + format_timing_stats(hs.timing_stats()))
+        # empty when the results came from the cache
+        if hs.fusion_stats:
+            print("DEBUGGING: " + format_fusion_stats(hs.fusion_stats))
 
-    return results[:limit]
+    return results
 
 
 def print_results(results, rerankmethod=None):
@@ -0,0 +1,461 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+from .positions import PositionLists
+from .postings_codec import CompressedPostings, range_indexes
+
+TERMS_FILE = "terms.npy"
+OFFSETS_FILE = "postings_offsets.npy"
+POSTINGS_DOCS_FILE = "postings_docs.npy"
+POSTINGS_TFS_FILE = "postings_tfs.npy"
+DOC_IDS_FILE = "doc_ids.npy"
+DOC_LENGTHS_FILE = "doc_lengths.npy"
+DOCS_FILE = "docs.jsonl"
+DOCS_OFFSETS_FILE = "docs_offsets.npy"
+BLOCK_OFFSETS_FILE = "block_offsets.npy"
+BLOCK_MAX_TFS_FILE = "block_max_tfs.npy"
+BLOCK_MIN_LENGTHS_FILE = "block_min_lengths.npy"
+
+# postings per block for the block-max metadata used by pruned BM25 search
+POSTINGS_BLOCK_SIZE = 128
+
+
+def build_block_offsets(offsets: np.ndarray) -> np.ndarray:
+    # every postings list is cut into POSTINGS_BLOCK_SIZE blocks, block j of term i is
+    # block_offsets[i] + j and covers postings offsets[i] + j * POSTINGS_BLOCK_SIZE onwards
+    blocks_per_term = -(-np.diff(offsets) // POSTINGS_BLOCK_SIZE)
+    block_offsets = np.zeros(len(offsets), dtype=np.int64)
+    np.cumsum(blocks_per_term, out=block_offsets[1:])
+    return block_offsets
+
+
+def build_block_starts(offsets: np.ndarray, block_offsets: np.ndarray) -> np.ndarray:
+    # postings position every block starts at, followed by the total number of postings
+    block_terms = np.repeat(np.arange(len(offsets) - 1), np.diff(block_offsets))
+    block_in_term = np.arange(block_offsets[-1]) - block_offsets[block_terms]
+    block_starts = (
+        np.asarray(offsets)[block_terms] + block_in_term * POSTINGS_BLOCK_SIZE
+    )
+    return np.append(block_starts, offsets[-1]).astype(np.int64)
+
+
+def build_block_maxes(
+    offsets: np.ndarray,
+    postings_docs: np.ndarray,
+    postings_tfs: np.ndarray,
+    doc_lengths: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    block_offsets = build_block_offsets(offsets)
+    block_starts = build_block_starts(offsets, block_offsets)[:-1]
+    if len(block_starts) == 0:
+        empty = np.empty(0, dtype=np.int32)
+        return block_offsets, empty, empty
+
+    # max tf and shortest document bound the BM25 score of any posting in the block
+    block_max_tfs = np.maximum.reduceat(postings_tfs, block_starts).astype(np.int32)
+    posting_lengths = np.asarray(doc_lengths)[postings_docs]
+    block_min_lengths = np.minimum.reduceat(posting_lengths, block_starts).astype(
+        np.int32
+    )
+    return block_offsets, block_max_tfs, block_min_lengths
+
+
+def find_sorted(values: np.ndarray, value) -> int:
+    i = int(np.searchsorted(values, value))
+    if i < len(values) and values[i] == value:
+        return i
+    return -1
+
+
+class DocStore(Mapping):
+    # Lazy id -> movie dict mapping backed by a jsonl blob, documents are only parsed when looked up
+    def __init__(self, doc_ids: np.ndarray, blob, offsets: np.ndarray) -> None:
+        self.doc_ids = doc_ids
+        self.blob = blob
+        self.offsets = offsets
+
+    def dense_index(self, doc_id: int) -> int:
+        return find_sorted(self.doc_ids, doc_id)
+
+    def by_index(self, i: int) -> dict:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return json.loads(bytes(self.blob[start:end]))
+
+    def __getitem__(self, doc_id: int) -> dict:
+        i = self.dense_index(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self.by_index(i)
+
+    def __contains__(self, doc_id) -> bool:
+        return self.dense_index(doc_id) >= 0
+
+    def __iter__(self):
+        return iter(self.doc_ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+
+class ArrayIndex:
+    # CSR layout: postings of terms[i] live in postings_docs/postings_tfs[offsets[i]:offsets[i + 1]]
+    # Postings hold dense doc indexes (position in doc_ids), sorted ascending
+    # With compressed postings the flat arrays are only decoded when something needs all of them,
+    # searches decode the blocks they touch
+    def __init__(
+        self,
+        terms: np.ndarray,
+        offsets: np.ndarray,
+        postings_docs: np.ndarray | None,
+        postings_tfs: np.ndarray | None,
+        doc_ids: np.ndarray,
+        doc_lengths: np.ndarray,
+        docs: Mapping,
+        block_maxes: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None,
+        compressed: CompressedPostings | None = None,
+        positions: PositionLists | None = None,
+    ) -> None:
+        self.terms = terms
+        self.offsets = offsets
+        self.__postings_docs = postings_docs
+        self.__postings_tfs = postings_tfs
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.docs = docs
+        self.compressed = compressed
+        # token positions per posting, only in indexes built with positions
+        self.positions = positions
+
+        if block_maxes is None:
+            block_maxes = build_block_maxes(
+                offsets, self.postings_docs, self.postings_tfs, doc_lengths
+            )
+        self.block_offsets, self.block_max_tfs, self.block_min_lengths = block_maxes
+
+        # first and last doc of every block, lets searches find the blocks covering a doc range
+        if compressed is not None:
+            self.block_starts = compressed.block_starts
+            self.block_first_docs = compressed.block_first_docs
+            self.block_last_docs = compressed.block_last_docs
+        else:
+            self.block_starts = build_block_starts(offsets, self.block_offsets)
+            self.block_first_docs = self.postings_docs[self.block_starts[:-1]]
+            self.block_last_docs = self.postings_docs[self.block_starts[1:] - 1]
+
+    @property
+    def postings_docs(self) -> np.ndarray:
+        if self.__postings_docs is None:
+            self.__decode_all()
+        return self.__postings_docs
+
+    @property
+    def postings_tfs(self) -> np.ndarray:
+        if self.__postings_tfs is None:
+            self.__decode_all()
+        return self.__postings_tfs
+
+    def __decode_all(self) -> None:
+        self.__postings_docs, self.__postings_tfs = self.compressed.decode(
+            0, len(self.block_starts) - 1
+        )
+
+    @classmethod
+    def from_inverted_index(cls, idx) -> "ArrayIndex":
+        doc_ids = np.array(sorted(idx.docmap), dtype=np.int64)
+        dense = {doc_id: i for i, doc_id in enumerate(doc_ids.tolist())}
+        terms = sorted(idx.index)
+
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        postings_docs, postings_tfs, position_lists = [], [], []
+        for term_idx, term in enumerate(terms):
+            ids = sorted(idx.index[term])
+            offsets[term_idx + 1] = offsets[term_idx] + len(ids)
+            postings_docs.extend(dense[doc_id] for doc_id in ids)
+            postings_tfs.extend(idx.term_frequencies[doc_id][term] for doc_id in ids)
+            if idx.positional:
+                position_lists.extend(idx.positions[term][doc_id] for doc_id in ids)
+
+        doc_lengths = np.array(
+            [idx.doc_lengths.get(doc_id, 0) for doc_id in doc_ids.tolist()],
+            dtype=np.int32,
+        )
+        return cls(
+            np.array(terms, dtype=str),
+            offsets,
+            np.array(postings_docs, dtype=np.int32),
+            np.array(postings_tfs, dtype=np.int32),
+            doc_ids,
+            doc_lengths,
+            {doc_id: idx.docmap[doc_id] for doc_id in doc_ids.tolist()},
+            positions=(
+                PositionLists.from_lists(position_lists) if idx.positional else None
+            ),
+        )
+
+    @classmethod
+    def merge(cls, segments: list["ArrayIndex"], lives: list) -> "ArrayIndex":
+        # live documents of every segment, each doc id may only be live in one of them
+        keeps = [
+            np.ones(seg.num_docs, dtype=bool) if live is None else np.asarray(live)
+            for seg, live in zip(segments, lives)
+        ]
+        doc_ids = np.sort(
+            np.concatenate(
+                [seg.doc_ids[keep] for seg, keep in zip(segments, keeps)]
+                + [np.empty(0, dtype=np.int64)]
+            )
+        )
+        terms = np.unique(
+            np.concatenate(
+                [np.asarray(seg.terms) for seg in segments] + [np.empty(0, dtype=str)]
+            )
+        )
+
+        doc_lengths = np.zeros(len(doc_ids), dtype=np.int32)
+        docs = {}
+        posting_terms, postings_docs, postings_tfs, position_lists = [], [], [], []
+        # positions survive a merge only if every segment has them
+        positional = all(seg.positions is not None for seg in segments)
+        for seg, keep in zip(segments, keeps):
+            kept = np.flatnonzero(keep)
+            # old dense index -> merged dense index, -1 for deleted documents
+            remap = np.full(seg.num_docs, -1, dtype=np.int64)
+            remap[kept] = np.searchsorted(doc_ids, seg.doc_ids[kept])
+            doc_lengths[remap[kept]] = seg.doc_lengths[kept]
+            for doc_id in seg.doc_ids[kept].tolist():
+                docs[doc_id] = seg.docs[doc_id]
+
+            seg_terms = np.searchsorted(terms, seg.terms)
+            new_docs = remap[seg.postings_docs]
+            alive = new_docs >= 0
+            posting_terms.append(np.repeat(seg_terms, np.diff(seg.offsets))[alive])
+            postings_docs.append(new_docs[alive])
+            postings_tfs.append(np.asarray(seg.postings_tfs)[alive])
+            if positional:
+                position_lists.append(seg.positions.take(np.flatnonzero(alive)))
+
+        posting_terms = np.concatenate(posting_terms + [np.empty(0, dtype=np.int64)])
+        postings_docs = np.concatenate(postings_docs + [np.empty(0, dtype=np.int64)])
+        postings_tfs = np.concatenate(postings_tfs + [np.empty(0, dtype=np.int32)])
+        order = np.lexsort((postings_docs, posting_terms))
+
+        # terms whose documents were all deleted are dropped
+        doc_counts = np.bincount(posting_terms, minlength=len(terms))
+        offsets = np.zeros(np.count_nonzero(doc_counts) + 1, dtype=np.int64)
+        np.cumsum(doc_counts[doc_counts > 0], out=offsets[1:])
+        return cls(
+            terms[doc_counts > 0],
+            offsets,
+            postings_docs[order].astype(np.int32),
+            postings_tfs[order].astype(np.int32),
+            doc_ids,
+            doc_lengths,
+            docs,
+            positions=(
+                PositionLists.concatenate(position_lists).take(order)
+                if positional
+                else None
+            ),
+        )
+
+    def save(self, path: str, compress: bool = False) -> None:
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, TERMS_FILE), self.terms)
+        np.save(os.path.join(path, OFFSETS_FILE), self.offsets)
+        # only one postings format is kept on disk, load picks whichever is there
+        if compress:
+            compressed = self.compressed or CompressedPostings.encode(
+                self.postings_docs, self.postings_tfs, self.block_starts
+            )
+            compressed.save(path)
+            for name in (POSTINGS_DOCS_FILE, POSTINGS_TFS_FILE):
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+        else:
+            np.save(os.path.join(path, POSTINGS_DOCS_FILE), self.postings_docs)
+            np.save(os.path.join(path, POSTINGS_TFS_FILE), self.postings_tfs)
+            CompressedPostings.remove(path)
+        np.save(os.path.join(path, DOC_IDS_FILE), self.doc_ids)
+        np.save(os.path.join(path, DOC_LENGTHS_FILE), self.doc_lengths)
+        np.save(os.path.join(path, BLOCK_OFFSETS_FILE), self.block_offsets)
+        np.save(os.path.join(path, BLOCK_MAX_TFS_FILE), self.block_max_tfs)
+        np.save(os.path.join(path, BLOCK_MIN_LENGTHS_FILE), self.block_min_lengths)
+        if self.positions is not None:
+            self.positions.save(path)
+        else:
+            PositionLists.remove(path)
+
+        docs_offsets = np.zeros(len(self.doc_ids) + 1, dtype=np.int64)
+        with open(os.path.join(path, DOCS_FILE), "wb") as f:
+            for i, doc_id in enumerate(self.doc_ids.tolist()):
+                line = json.dumps(self.docs[doc_id]).encode() + b"\n"
+                f.write(line)
+                docs_offsets[i + 1] = docs_offsets[i] + len(line)
+        np.save(os.path.join(path, DOCS_OFFSETS_FILE), docs_offsets)
+
+    @classmethod
+    def load(cls, path: str) -> "ArrayIndex":
+        def open_array(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        doc_ids = open_array(DOC_IDS_FILE)
+        docs_path = os.path.join(path, DOCS_FILE)
+        # np.memmap refuses to map empty files
+        if os.path.getsize(docs_path) > 0:
+            blob = np.memmap(docs_path, dtype=np.uint8, mode="r")
+        else:
+            blob = b""
+        # array indexes saved before block-max metadata existed get it computed on load
+        block_maxes = None
+        if os.path.exists(os.path.join(path, BLOCK_OFFSETS_FILE)):
+            block_maxes = (
+                open_array(BLOCK_OFFSETS_FILE),
+                open_array(BLOCK_MAX_TFS_FILE),
+                open_array(BLOCK_MIN_LENGTHS_FILE),
+            )
+        offsets = open_array(OFFSETS_FILE)
+        if CompressedPostings.exists(path):
+            compressed = CompressedPostings.load(
+                path, build_block_starts(offsets, block_maxes[0])
+            )
+            postings_docs, postings_tfs = None, None
+        else:
+            compressed = None
+            postings_docs = open_array(POSTINGS_DOCS_FILE)
+            postings_tfs = open_array(POSTINGS_TFS_FILE)
+        return cls(
+            open_array(TERMS_FILE),
+            offsets,
+            postings_docs,
+            postings_tfs,
+            doc_ids,
+            open_array(DOC_LENGTHS_FILE),
+            DocStore(doc_ids, blob, open_array(DOCS_OFFSETS_FILE)),
+            block_maxes,
+            compressed,
+            PositionLists.load(path) if PositionLists.exists(path) else None,
+        )
+
+    @classmethod
+    def compress_postings(cls, path: str) -> None:
+        # swaps the raw postings files of a saved index for compressed ones, nothing else is rewritten
+        arrays = cls.load(path)
+        if arrays.compressed is not None:
+            return
+        CompressedPostings.encode(
+            arrays.postings_docs, arrays.postings_tfs, arrays.block_starts
+        ).save(path)
+        for name in (POSTINGS_DOCS_FILE, POSTINGS_TFS_FILE):
+            os.remove(os.path.join(path, name))
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, OFFSETS_FILE))
+
+    @staticmethod
+    def remove(path: str) -> None:
+        for name in (
+            TERMS_FILE,
+            OFFSETS_FILE,
+            POSTINGS_DOCS_FILE,
+            POSTINGS_TFS_FILE,
+            DOC_IDS_FILE,
+            DOC_LENGTHS_FILE,
+            DOCS_FILE,
+            DOCS_OFFSETS_FILE,
+            BLOCK_OFFSETS_FILE,
+            BLOCK_MAX_TFS_FILE,
+            BLOCK_MIN_LENGTHS_FILE,
+        ):
+            file_path = os.path.join(path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        CompressedPostings.remove(path)
+        PositionLists.remove(path)
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_ids)
+
+    @property
+    def total_length(self) -> int:
+        return int(np.sum(self.doc_lengths, dtype=np.int64))
+
+    @property
+    def avg_doc_length(self) -> float:
+        if self.num_docs == 0:
+            return 0.0
+        return self.total_length / self.num_docs
+
+    def term_id(self, term: str) -> int:
+        return find_sorted(self.terms, term)
+
+    def dense_index(self, doc_id: int) -> int:
+        return find_sorted(self.doc_ids, doc_id)
+
+    def term_blocks(self, term: str) -> tuple[int, int]:
+        # range of block numbers holding the term's postings, empty for unknown terms
+        term_idx = self.term_id(term)
+        if term_idx < 0:
+            return 0, 0
+        return int(self.block_offsets[term_idx]), int(self.block_offsets[term_idx + 1])
+
+    def block_postings(
+        self, first_block: int, last_block: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # docs and tfs of blocks first_block up to but not including last_block
+        if self.__postings_docs is None:
+            return self.compressed.decode(first_block, last_block)
+        start = self.block_starts[first_block]
+        end = self.block_starts[max(first_block, last_block)]
+        return self.__postings_docs[start:end], self.__postings_tfs[start:end]
+
+    def probe(self, term: str, docs: np.ndarray) -> tuple[np.ndarray, int]:
+        # mask of the sorted dense docs holding the term, and how many postings that took.
+        # Block last docs act as skip pointers, only blocks the docs fall into are read
+        first, last = self.term_blocks(term)
+        blocks = first + np.searchsorted(self.block_last_docs[first:last], docs)
+        blocks = np.unique(blocks[blocks < last])
+        if self.__postings_docs is None:
+            postings, _ = self.compressed.decode_blocks(blocks)
+        else:
+            starts = self.block_starts[blocks]
+            postings = self.__postings_docs[
+                range_indexes(starts, self.block_starts[blocks + 1] - starts)
+            ]
+        if not len(postings):
+            return np.zeros(len(docs), dtype=bool), 0
+        i = np.minimum(np.searchsorted(postings, docs), len(postings) - 1)
+        return postings[i] == docs, len(postings)
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        return self.block_postings(*self.term_blocks(term))
+
+    def blocks(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        start, end = self.term_blocks(term)
+        return self.block_max_tfs[start:end], self.block_min_lengths[start:end]
+
+    def doc_frequency(self, term: str) -> int:
+        term_idx = self.term_id(term)
+        if term_idx < 0:
+            return 0
+        return int(self.offsets[term_idx + 1] - self.offsets[term_idx])
+
+    def tf(self, doc_id: int, term: str) -> int:
+        dense_idx = self.dense_index(doc_id)
+        if dense_idx < 0:
+            return 0
+        # only the block that could hold the document gets looked at
+        start, end = self.term_blocks(term)
+        block = start + int(np.searchsorted(self.block_last_docs[start:end], dense_idx))
+        if block == end:
+            return 0
+        docs, tfs = self.block_postings(block, block + 1)
+        i = find_sorted(docs, dense_idx)
+        return int(tfs[i]) if i >= 0 else 0
+
+    def doc_length(self, doc_id: int) -> int:
+        return int(self.doc_lengths[self.dense_index(doc_id)])
@@ -0,0 +1,127 @@
+import math
+import os
+
+import numpy as np
+
+from .postings_codec import range_indexes
+from .vector_search import normalize_rows
+
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+IVF_ROWS_FILE = "ivf_rows.npy"
+
+# lists probed per query, more lists is higher recall and slower queries
+IVF_DEFAULT_NPROBE = 16
+
+IVF_KMEANS_ITERATIONS = 10
+
+# k-means trains on a sample of this many vectors per list, the full set is only assigned once
+IVF_TRAINING_SAMPLES_PER_LIST = 64
+
+# rows scored against the centroids at once while assigning, bounds the score matrix size
+IVF_ASSIGN_BATCH_SIZE = 1 << 14
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), IVF_ASSIGN_BATCH_SIZE):
+        batch = np.asarray(vectors[start : start + IVF_ASSIGN_BATCH_SIZE])
+        assignments[start : start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(
+    vectors: np.ndarray, num_lists: int, iterations: int, seed: int
+) -> np.ndarray:
+    # k-means on the unit sphere, centroids are renormalized means so a dot product ranks them
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)]
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        lists, starts = np.unique(assignments[order], return_index=True)
+        # lists that lost all their vectors keep their old centroid
+        centroids = centroids.copy()
+        centroids[lists] = normalize_rows(np.add.reduceat(vectors[order], starts))
+    return centroids
+
+
+class IVFIndex:
+    # Inverted file over normalized embeddings. Every row belongs to its nearest centroid's
+    # list, list l holds rows[offsets[l]:offsets[l + 1]] like the postings of a term, and a
+    # query only scores the rows of the nprobe lists whose centroids are closest to it.
+    def __init__(
+        self, centroids: np.ndarray, offsets: np.ndarray, rows: np.ndarray
+    ) -> None:
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray,
+        num_lists: int | None = None,
+        iterations: int = IVF_KMEANS_ITERATIONS,
+        seed: int = 42,
+    ) -> "IVFIndex":
+        # sqrt(rows) lists of sqrt(rows) rows each balances the centroid and the list scan
+        num_lists = min(
+            num_lists or max(1, round(math.sqrt(len(embeddings)))), len(embeddings)
+        )
+        rng = np.random.default_rng(seed)
+        num_samples = min(len(embeddings), num_lists * IVF_TRAINING_SAMPLES_PER_LIST)
+        sample = np.asarray(
+            embeddings[np.sort(rng.choice(len(embeddings), num_samples, replace=False))]
+        )
+        centroids = spherical_kmeans(sample, num_lists, iterations, seed)
+
+        assignments = nearest_centroids(embeddings, centroids)
+        offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=num_lists), out=offsets[1:])
+        rows = np.argsort(assignments, kind="stable").astype(np.int32)
+        return cls(centroids, offsets, rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def num_lists(self) -> int:
+        return len(self.centroids)
+
+    def candidates(
+        self, query_embedding, nprobe: int = IVF_DEFAULT_NPROBE
+    ) -> np.ndarray:
+        # rows of the nprobe lists closest to the query
+        centroid_scores = self.centroids @ normalize_rows(query_embedding)
+        nprobe = min(nprobe, self.num_lists)
+        lists = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        starts = np.asarray(self.offsets)[lists]
+        lengths = np.asarray(self.offsets)[lists + 1] - starts
+        # ascending so gathering the embeddings walks memory forward
+        return np.sort(np.asarray(self.rows)[range_indexes(starts, lengths)])
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, IVF_CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(path, IVF_OFFSETS_FILE), self.offsets)
+        np.save(os.path.join(path, IVF_ROWS_FILE), self.rows)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        return cls(
+            np.load(os.path.join(path, IVF_CENTROIDS_FILE)),
+            np.load(os.path.join(path, IVF_OFFSETS_FILE)),
+            np.load(os.path.join(path, IVF_ROWS_FILE), mmap_mode="r"),
+        )
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, IVF_ROWS_FILE))
+
+    @staticmethod
+    def remove(path: str) -> None:
+        for name in (IVF_CENTROIDS_FILE, IVF_OFFSETS_FILE, IVF_ROWS_FILE):
+            file_path = os.path.join(path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
@@ -1,23 +1,34 @@
+import json
 import math
 import os
 import pickle
-import string
+import sys
 from collections import Counter, defaultdict
-
-from nltk.stem import PorterStemmer
-
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from .analyzer import get_analyzer
+from .index_arrays import ArrayIndex
+from .boolean_query import And, Phrase, QueryParser, combine, is_boolean_query
+from .phrases import parse_phrases
+from .ranked_list import RankedList
+from .segments import MANIFEST_FILE, SegmentedIndex
+from .spimi import SpimiBuilder
 from .search_utils import (
     CACHE_DIR,
     DEFAULT_SEARCH_LIMIT,
     BM25_K1,
     BM25_B,
+    iter_movies,
     load_movies,
-    load_stopwords,
 )
 
+# shards per worker for parallel builds, a few more than one keeps the workers busy
+BUILD_SHARDS_PER_WORKER = 4
+
 
 class InvertedIndex:
-    def __init__(self) -> None:
+    def __init__(self, cache_dir: str = CACHE_DIR, positional: bool = False) -> None:
 
         # key: term -> set(movie ids containing that term) for fast searching
         self.index = defaultdict(set)
@@ -31,21 +42,98 @@ class InvertedIndex:
         # key: id -> length of document
         self.doc_lengths: dict[int, int] = {}
 
-        self.index_path = os.path.join(CACHE_DIR, "index.pkl")
-        self.docmap_path = os.path.join(CACHE_DIR, "docmap.pkl")
-        self.tf_path = os.path.join(CACHE_DIR, "term_frequencies.pkl")
-        self.doc_lengths_path = os.path.join(CACHE_DIR, "doc_lengths.pkl")
-
-    def build(self) -> None:
-        movies = load_movies()
+        # key: term -> {id: token positions of the term in that movie}, only kept when positional
+        self.positional = positional
+        self.positions = defaultdict(dict)
+
+        # memory-mapped CSR segments of the structures above, set when loading the array format
+        self.segments: SegmentedIndex | None = None
+
+        # postings counters of the last pruned bm25 search
+        self.pruning_stats: dict = {}
+
+        # matches, postings read and timings of the last phrase or boolean search
+        self.match_stats: dict = {}
+
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.pkl")
+        self.docmap_path = os.path.join(cache_dir, "docmap.pkl")
+        self.tf_path = os.path.join(cache_dir, "term_frequencies.pkl")
+        self.doc_lengths_path = os.path.join(cache_dir, "doc_lengths.pkl")
+        self.positions_path = os.path.join(cache_dir, "positions.pkl")
+        self.arrays_dir = os.path.join(cache_dir, "index")
+
+    def version(self) -> str:
+        # changes whenever the saved index is rebuilt, added to or merged, so caches of search
+        # results can tell they are stale
+        parts = []
+        for path in (os.path.join(self.arrays_dir, MANIFEST_FILE), self.index_path):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                parts.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        return "/".join(parts)
+
+    def build(self, workers: int = 1) -> None:
+        self.add_movies(load_movies(), workers)
+
+    def build_external(self, memory_budget_mb: float, compress: bool = False) -> None:
+        # streams the corpus straight into the array format, memory stays around the budget
+        builder = SpimiBuilder(self.arrays_dir, memory_budget_mb)
+        for movie in iter_movies():
+            builder.add(movie)
+        builder.finish()
+        if compress:
+            ArrayIndex.compress_postings(self.arrays_dir)
+        SegmentedIndex.create(self.arrays_dir, ArrayIndex.load(self.arrays_dir))
+        self.load_arrays()
+
+    def add_movies(self, movies: list[dict], workers: int = 1) -> None:
+        self.segments = None
+        if workers > 1:
+            self.__add_movies_parallel(movies, workers)
+            return
+        analyzer = get_analyzer()
         for m in movies:
             doc_id = m["id"]
-            doc_description = f"{m['title']} {m['description']}"
             self.docmap[doc_id] = m
-            self.__add_document(doc_id, doc_description)
-
-    def save(self) -> None:
-        os.makedirs(CACHE_DIR, exist_ok=True)
+            text = f"{m['title']} {m['description']}"
+            if self.positional:
+                self.__add_document(doc_id, *analyzer.tokenize_positions(text))
+            else:
+                self.__add_document(doc_id, analyzer.tokenize(text))
+
+    def __add_movies_parallel(self, movies: list[dict], workers: int) -> None:
+        # workers tokenize contiguous shards, merging them in shard order repeats the exact
+        # insertions of a serial build so the saved index is byte for byte the same
+        shard_size = max(1, -(-len(movies) // (workers * BUILD_SHARDS_PER_WORKER)))
+        shards = [movies[i : i + shard_size] for i in range(0, len(movies), shard_size)]
+        shard_docs = [
+            [(m["id"], f"{m['title']} {m['description']}") for m in shard]
+            for shard in shards
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for shard, (postings, frequencies, lengths, positions) in zip(
+                shards,
+                pool.map(partial(build_shard, positional=self.positional), shard_docs),
+            ):
+                for m in shard:
+                    self.docmap[m["id"]] = m
+                for token, doc_ids in postings.items():
+                    self.index[sys.intern(token)].update(doc_ids)
+                for doc_id, counts in frequencies:
+                    self.term_frequencies[doc_id].update(
+                        {sys.intern(token): count for token, count in counts.items()}
+                    )
+                self.doc_lengths.update(lengths)
+                for token, doc_positions in positions.items():
+                    self.positions[sys.intern(token)].update(doc_positions)
+
+    def save(self, compress: bool = False) -> None:
+        self.save_pickles()
+        self.save_arrays(compress)
+
+    def save_pickles(self) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
         with open(self.index_path, "wb") as f:
             pickle.dump(self.index, f)
         with open(self.docmap_path, "wb") as f:
@@ -54,8 +142,32 @@ class InvertedIndex:
             pickle.dump(self.term_frequencies, f)
         with open(self.doc_lengths_path, "wb") as f:
             pickle.dump(self.doc_lengths, f)
+        if self.positional:
+            with open(self.positions_path, "wb") as f:
+                pickle.dump(self.positions, f)
+        elif os.path.exists(self.positions_path):
+            os.remove(self.positions_path)
+
+    def save_arrays(self, compress: bool = False) -> None:
+        ArrayIndex.from_inverted_index(self).save(self.arrays_dir, compress)
+        SegmentedIndex.create(self.arrays_dir, ArrayIndex.load(self.arrays_dir))
+
+    def exists(self) -> bool:
+        # build --memory-budget only writes the arrays, older caches only have the pickles
+        return SegmentedIndex.exists(self.arrays_dir) or os.path.exists(self.index_path)
 
     def load(self) -> None:
+        # prefer the memory-mapped format, older caches only have the pickles
+        if SegmentedIndex.exists(self.arrays_dir):
+            self.load_arrays()
+        else:
+            self.load_pickles()
+
+    def load_arrays(self) -> None:
+        self.segments = SegmentedIndex.load(self.arrays_dir)
+        self.docmap = self.segments.docs
+
+    def load_pickles(self) -> None:
         with open(self.index_path, "rb") as f:
             self.index = pickle.load(f)
         with open(self.docmap_path, "rb") as f:
@@ -64,34 +176,59 @@ class InvertedIndex:
             self.term_frequencies = pickle.load(f)
         with open(self.doc_lengths_path, "rb") as f:
             self.doc_lengths = pickle.load(f)
+        self.positional = os.path.exists(self.positions_path)
+        if self.positional:
+            with open(self.positions_path, "rb") as f:
+                self.positions = pickle.load(f)
 
     def get_documents(self, term: str) -> list[int]:
+        if self.segments is not None:
+            return self.segments.get_documents(term)
         doc_ids = self.index.get(term, set())
         return sorted(list(doc_ids))
 
-    def __add_document(self, doc_id: int, text: str) -> None:
-        tokens = tokenize_text(text)
-        for token in set(tokens):
+    def __add_document(
+        self, doc_id: int, tokens: list[str], positions: list[int] | None = None
+    ) -> None:
+        # first occurrence order instead of a set keeps the build independent of string hashing
+        for token in dict.fromkeys(tokens):
             self.index[token].add(doc_id)
         self.term_frequencies[doc_id].update(tokens)
         self.doc_lengths[doc_id] = len(tokens)
+        if self.positional:
+            for position, token in zip(positions, tokens):
+                self.positions[token].setdefault(doc_id, []).append(position)
 
     def __get_avg_doc_length(self) -> float:
+        if self.segments is not None:
+            return self.segments.avg_doc_length
         if not self.doc_lengths:
             return 0.0
         return sum(self.doc_lengths.values()) / len(self.doc_lengths)
 
+    def __get_doc_length(self, doc_id: int) -> int:
+        if self.segments is not None:
+            return self.segments.doc_length(doc_id)
+        return self.doc_lengths[doc_id]
+
+    def __get_doc_frequency(self, token: str) -> int:
+        if self.segments is not None:
+            return self.segments.doc_frequency(token)
+        return len(self.index[token])
+
     def get_tf(self, doc_id: int, term: str) -> int:
         tokens = tokenize_text(term)
         if len(tokens) != 1:
             raise ValueError("term must be a single token")
         token = tokens[0]
+        if self.segments is not None:
+            return self.segments.tf(doc_id, token)
         return self.term_frequencies[doc_id][token]
 
     def get_bm25_tf(self, doc_id, term, k1=BM25_K1, b=BM25_B):
         # Length normalization factor
         length_norm = (
-            1 - b + b * (self.doc_lengths[doc_id] / self.__get_avg_doc_length())
+            1 - b + b * (self.__get_doc_length(doc_id) / self.__get_avg_doc_length())
         )
         tf = self.get_tf(doc_id, term)
         return (tf * (k1 + 1)) / (tf + k1 * length_norm)
@@ -102,7 +239,7 @@ class InvertedIndex:
             raise ValueError("term must be a single token")
         token = tokens[0]
         doc_count = len(self.docmap)
-        term_doc_count = len(self.index[token])
+        term_doc_count = self.__get_doc_frequency(token)
         return math.log((doc_count + 1) / (term_doc_count + 1))
 
     def get_bm25_idf(self, term: str) -> float:
@@ -111,7 +248,7 @@ class InvertedIndex:
             raise ValueError("term must be a single token")
         token = tokens[0]
         doc_count = len(self.docmap)
-        term_doc_count = len(self.index[token])
+        term_doc_count = self.__get_doc_frequency(token)
         return math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
 
     def get_tf_idf(self, doc_id: int, term: str) -> float:
@@ -124,71 +261,184 @@ class InvertedIndex:
         bm25_idf = self.get_bm25_idf(term)
         return bm25_tf * bm25_idf
 
-    def bm25_search(self, query, limit) -> list[dict]:
-        tokens = set(tokenize_text(query))
-        scores = {doc_id: 0 for doc_id in self.docmap}
-        for t in tokens:
-            ids_containing_term = self.index[t]
-            for id in ids_containing_term:
-                term_score = self.get_bm25(id, t)
-                scores[id] += term_score
-
-        sorted_scores = sorted(scores.items(), key=lambda item: item[1], reverse=True)
-        top_docs = [
-            (self.docmap[doc_id], score) for doc_id, score in sorted_scores[:limit]
-        ]
+    def get_segments(self) -> SegmentedIndex:
+        if self.segments is None:
+            self.segments = SegmentedIndex.from_arrays(
+                ArrayIndex.from_inverted_index(self)
+            )
+        return self.segments
+
+    def bm25_search(self, query, limit, pruned=False) -> list[dict]:
+        tokens = list(dict.fromkeys(get_analyzer().tokenize(query)))
+        top, self.pruning_stats = self.get_segments().top_k(tokens, limit, pruned)
+        return self.__bm25_results(top, limit)
+
+    def bm25_search_many(self, queries, limit) -> list[list[dict]]:
+        # bm25_search of every query, terms the queries share are scored once for all of them
+        analyzer = get_analyzer()
+        tops = self.get_segments().top_k_many(
+            [list(dict.fromkeys(analyzer.tokenize(query))) for query in queries], limit
+        )
+        return [self.__bm25_results(top, limit) for top in tops]
+
+    def bm25_ranked(self, query, depth=None) -> RankedList:
+        # every live document ranked by bm25 and keyed by id, read from the top it returns
+        # what bm25_search with limit depth returns, non matching documents last in doc order
+        tokens = list(dict.fromkeys(get_analyzer().tokenize(query)))
+        keys, doc_ids, scores = self.get_segments().score_all(tokens)
+        return RankedList(doc_ids, scores, tiebreak=keys, depth=depth)
+
+    def __bm25_results(self, top, limit) -> list[dict]:
+        segments = self.get_segments()
+        # like a full sort over every document, fill up with non matching documents in doc order
+        if len(top) < limit:
+            matched = {key for key, _ in top}
+            for key in segments.live_keys():
+                if len(top) >= limit:
+                    break
+                if key not in matched:
+                    top.append((key, 0))
+
+        return [(self.docmap[segments.doc_id(key)], score) for key, score in top]
+
+    def phrase_search(self, query: str, limit: int) -> list[tuple[dict, float]]:
+        # documents containing every quoted phrase, ranked by bm25 over all of the query
+        phrases, rest = parse_phrases(query)
+        analyzer = get_analyzer()
+        node = combine(
+            And,
+            [
+                Phrase(tokens, slop, positions)
+                for (tokens, positions), slop in (
+                    (analyzer.tokenize_positions(text), slop) for text, slop in phrases
+                )
+                if tokens
+            ],
+        )
+        tokens = (node.tokens() if node is not None else []) + analyzer.tokenize(rest)
+        return self.__match_search(node, tokens, limit)
+
+    def boolean_search(self, query: str, limit: int) -> list[tuple[dict, float]]:
+        # AND / OR / NOT / parentheses over terms and phrases, ranked by bm25 over the terms
+        # that aren't negated
+        node = QueryParser(query).parse()
+        return self.__match_search(
+            node, node.tokens() if node is not None else [], limit
+        )
+
+    def __match_search(self, node, tokens, limit) -> list[tuple[dict, float]]:
+        if node is None:
+            self.match_stats = {}
+            return []
+        segments = self.get_segments()
+        top, self.match_stats = segments.match_top_k(
+            node, list(dict.fromkeys(tokens)), limit
+        )
+        return [(self.docmap[segments.doc_id(key)], score) for key, score in top]
+
+    def apply_delta(self, ops: list[dict]) -> dict:
+        # ops are {"op": "add" | "update", "movie": {...}} or {"op": "delete", "id": ...}
+        # touched documents get tombstoned and their new versions go into one new segment
+        segments = self.get_segments()
+        upserts: dict[int, dict] = {}
+        counts = {"added": 0, "updated": 0, "deleted": 0, "missing": 0}
+        for op in ops:
+            match op["op"]:
+                case "add" | "update":
+                    movie = op["movie"]
+                    existed = segments.delete(movie["id"]) or movie["id"] in upserts
+                    upserts[movie["id"]] = movie
+                    counts["updated" if existed else "added"] += 1
+                case "delete":
+                    existed = segments.delete(op["id"])
+                    existed = upserts.pop(op["id"], None) is not None or existed
+                    counts["deleted" if existed else "missing"] += 1
+                case _:
+                    raise ValueError(f"unknown delta operation: {op['op']}")
+
+        if upserts:
+            delta = InvertedIndex(self.cache_dir, segments.positional)
+            delta.add_movies(list(upserts.values()))
+            segments.add_segment(ArrayIndex.from_inverted_index(delta))
+        segments.save_manifest()
+        segments.maybe_merge()
+        return counts
+
+
+def build_shard(
+    docs: list[tuple[int, str]], positional: bool = False
+) -> tuple[dict, list, list, dict]:
+    # partial postings (in doc order), term frequencies, lengths and positions of one shard
+    postings: dict[str, list[int]] = {}
+    positions: dict[str, dict[int, list[int]]] = {}
+    frequencies, lengths = [], []
+    analyzer = get_analyzer()
+    for doc_id, text in docs:
+        tokens, token_positions = analyzer.tokenize_positions(text)
+        for token in dict.fromkeys(tokens):
+            postings.setdefault(token, []).append(doc_id)
+        frequencies.append((doc_id, Counter(tokens)))
+        lengths.append((doc_id, len(tokens)))
+        if positional:
+            for position, token in zip(token_positions, tokens):
+                positions.setdefault(token, {}).setdefault(doc_id, []).append(position)
+    return postings, frequencies, lengths, positions
+
+
+def build_command(
+    workers: int = 1,
+    memory_budget_mb: float | None = None,
+    compress: bool = False,
+    positional: bool = False,
+) -> None:
+    idx = InvertedIndex(positional=positional)
+    if memory_budget_mb is not None:
+        idx.build_external(memory_budget_mb, compress)
+        return
+    idx.build(workers)
+    idx.save(compress)
+
+
+def apply_delta_command(delta_path: str) -> dict:
+    idx = InvertedIndex()
+    idx.load_arrays()
+    with open(delta_path, "r") as f:
+        ops = [json.loads(line) for line in f if line.strip()]
+    return idx.apply_delta(ops)
 
-        return top_docs
+
+def merge_command(full: bool = False) -> None:
+    idx = InvertedIndex()
+    idx.load_arrays()
+    idx.segments.merge(full)
 
 
-def build_command() -> None:
+def convert_command(compress: bool = False) -> None:
     idx = InvertedIndex()
-    idx.build()
-    idx.save()
+    idx.load_pickles()
+    idx.save_arrays(compress)
 
 
-def search_command(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
+def search_command(
+    query: str, limit: int = DEFAULT_SEARCH_LIMIT
+) -> tuple[list[dict], dict]:
+    # quoted phrases alone are required phrases ranked by the whole query, anything with
+    # operators or parentheses is a boolean query, plain words match any of them
     idx = InvertedIndex()
     idx.load()
-    query_tokens = tokenize_text(query)
-    seen, results = set(), []
-    for query_token in query_tokens:
-        matching_doc_ids = idx.get_documents(query_token)
-        for doc_id in matching_doc_ids:
-            if doc_id in seen:
-                continue
-            seen.add(doc_id)
-            doc = idx.docmap[doc_id]
-            results.append(doc)
-            if len(results) >= limit:
-                return results
-
-    return results
+    if parse_phrases(query)[0] and not is_boolean_query(query):
+        results = idx.phrase_search(query, limit)
+    else:
+        results = idx.boolean_search(query, limit)
+    return [doc for doc, _ in results], idx.match_stats
 
 
 def preprocess_text(text: str) -> str:
-    text = text.lower()
-    text = text.translate(str.maketrans("", "", string.punctuation))
-    return text
+    return get_analyzer().preprocess(text)
 
 
 def tokenize_text(text: str) -> list[str]:
-    text = preprocess_text(text)
-    tokens = text.split()
-    valid_tokens = []
-    for token in tokens:
-        if token:
-            valid_tokens.append(token)
-    stop_words = load_stopwords()
-    filtered_words = []
-    for word in valid_tokens:
-        if word not in stop_words:
-            filtered_words.append(word)
-    stemmer = PorterStemmer()
-    stemmed_words = []
-    for word in filtered_words:
-        stemmed_words.append(stemmer.stem(word))
-    return stemmed_words
+    return get_analyzer().tokenize(text)
 
 
 def tf_command(doc_id: int, term: str) -> int:
@@ -225,3 +475,12 @@ def bm25_search_command(query, limit=DEFAULT_SEARCH_LIMIT) -> list[dict]:
     idx = InvertedIndex()
     idx.load()
     return idx.bm25_search(query, limit)
+
+
+def bm25_pruned_search_command(
+    query, limit=DEFAULT_SEARCH_LIMIT
+) -> tuple[list[dict], dict]:
+    idx = InvertedIndex()
+    idx.load()
+    results = idx.bm25_search(query, limit, pruned=True)
+    return results, idx.pruning_stats
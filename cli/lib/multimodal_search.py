@@ -1,44 +1,99 @@
-from PIL import Image
-import torch
-from sentence_transformers import SentenceTransformer
+import contextlib
+import os
 
-from .search_utils import load_movies
+from .embedding_build import EMBEDDING_BUILD_BATCH_SIZE, stream_embeddings
+from .embedding_cache import (
+    EmbeddingCache,
+    read_fingerprint,
+    texts_fingerprint,
+    write_fingerprint,
+)
+from .encoding_pool import EncodingPool
+from .quantization import full_precision_embeddings, load_embeddings, remove_quantized
+from .resources import lazy_import, sentence_transformer
+from .search_utils import CACHE_DIR, load_movies
+from .vector_search import RESCORE_OVERSAMPLING, top_k_rows
+
+Image = lazy_import("PIL.Image")
 
 
 class MultimodalSearch:
-    def __init__(self, documents=[], model_name="clip-ViT-B-32"):
-        self.model = self.model = SentenceTransformer(model_name)
+    # The movie texts are embedded into a float32 file like the semantic search embeddings,
+    # only texts that changed since the last build are encoded again. precision float16 or
+    # int8 searches memory-mapped quantized copies of it and rescores the best candidates from
+    # the memory-mapped float32 rows, workers above 1 encodes the texts on that many processes
+    def __init__(
+        self,
+        documents=[],
+        model_name="clip-ViT-B-32",
+        precision="float32",
+        workers=1,
+    ):
+        self.model_name = model_name
+        self.model = sentence_transformer(model_name)
         self.documents = documents
-        self.texts = [f"{doc['title']}: {doc['description']}" for doc in documents]
-        self.text_embeddings = self.model.encode(self.texts, show_progress_bar=True)
+        self.precision = precision
+        self.workers = workers
+        self.embedding_cache = EmbeddingCache(
+            os.path.join(CACHE_DIR, "embedding_cache", model_name), model_name
+        )
+        self.embeddings_path = os.path.join(
+            CACHE_DIR, f"multimodal_embeddings_{model_name}.npy"
+        )
+        self.text_embeddings = None
+        self.full_text_embeddings = None
+        # image embedding alone needs no movie texts
+        if documents:
+            self.load_or_create_text_embeddings()
+
+    def load_or_create_text_embeddings(self):
+        texts = [f"{doc['title']}: {doc['description']}" for doc in self.documents]
+        fingerprint = texts_fingerprint(self.model_name, texts)
+        if read_fingerprint(self.embeddings_path) != fingerprint or not os.path.exists(
+            self.embeddings_path
+        ):
+            remove_quantized(self.embeddings_path)
+            encoder = contextlib.nullcontext(self.model)
+            if self.workers > 1:
+                encoder = EncodingPool(self.model_name, self.workers)
+            with encoder as model:
+                stream_embeddings(
+                    self.embeddings_path,
+                    texts,
+                    len(texts),
+                    fingerprint,
+                    self.embedding_cache,
+                    model,
+                    EMBEDDING_BUILD_BATCH_SIZE * self.workers,
+                )
+            write_fingerprint(self.embeddings_path, fingerprint)
+        self.text_embeddings = load_embeddings(self.embeddings_path, self.precision)
+        self.full_text_embeddings = full_precision_embeddings(
+            self.embeddings_path, self.precision
+        )
+        return self.text_embeddings
 
     def embed_image(self, image_path: str):
         image = Image.open(image_path)
         image_embeddings = self.model.encode([image])
         return image_embeddings[0]
 
-    def search_with_image(self, image_path: str):
+    def search_with_image(self, image_path: str, rescore=RESCORE_OVERSAMPLING):
         embedding = self.embed_image(image_path)
-        return self.search_with_embedding(embedding)
+        return self.search_with_embedding(embedding, rescore)
 
-    def search_with_embedding(self, embedding):
-        embedding_tensor = torch.tensor(embedding)
-        text_embs_tensor = torch.tensor(self.text_embeddings)
-        similarities = torch.cosine_similarity(
-            embedding_tensor.unsqueeze(0), text_embs_tensor.squeeze(0)
-        )
-        top_k = min(5, len(self.documents))
-        top_values, top_indices = torch.topk(similarities, top_k)
+    def search_with_embedding(self, embedding, rescore=RESCORE_OVERSAMPLING):
         results = []
-        for i in range(top_k):
-            idx = top_indices[i].item()
+        for idx, score in top_k_rows(
+            self.text_embeddings, embedding, 5, self.full_text_embeddings, rescore
+        ):
             doc = self.documents[idx]
             results.append(
                 {
                     "document_id": doc["id"],
                     "title": doc["title"],
                     "description": doc["description"],
-                    "similarity_score": top_values[i].item(),
+                    "similarity_score": score,
                 }
             )
         return results
@@ -50,9 +105,14 @@ def verify_image_embedding(image_path: str):
     print(f"Embedding shape: {embedding.shape[0]} dimensions")
 
 
-def image_search_command(image_path: str):
-    ms = MultimodalSearch(load_movies())
-    result = ms.search_with_image(image_path)
+def image_search_command(
+    image_path: str,
+    precision: str = "float32",
+    rescore: int = RESCORE_OVERSAMPLING,
+    workers: int = 1,
+):
+    ms = MultimodalSearch(load_movies(), precision=precision, workers=workers)
+    result = ms.search_with_image(image_path, rescore)
     for idx, r in enumerate(result):
         print(f"{idx}.  {r['title']} (similarity: {r['similarity_score']:0.3f})")
         print(f"    {r['description'][:300]}...\n")
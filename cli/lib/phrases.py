@@ -0,0 +1,77 @@
+import re
+
+import numpy as np
+
+from .index_arrays import ArrayIndex
+
+# "dark knight" is an exact phrase, "dark knight"~3 lets the words sit up to 3 extra positions apart
+PHRASE_PATTERN = re.compile(r'"([^"]*)"(?:~(\d+))?')
+
+# doc * POSITION_STRIDE + position gives one sortable key per token occurrence
+POSITION_STRIDE = 1 << 32
+
+
+def parse_phrases(query: str) -> tuple[list[tuple[str, int]], str]:
+    # quoted phrases with their slop, and the query text outside of them
+    phrases = [
+        (match.group(1), int(match.group(2) or 0))
+        for match in PHRASE_PATTERN.finditer(query)
+    ]
+    return phrases, PHRASE_PATTERN.sub(" ", query)
+
+
+def position_keys(arrays: ArrayIndex, token: str, docs: np.ndarray) -> np.ndarray:
+    # sorted occurrence keys of the token in the given documents, all of which contain it
+    postings_docs, _ = arrays.postings(token)
+    rows = np.searchsorted(postings_docs, docs)
+    counts, positions = arrays.positions.decode(
+        arrays.offsets[arrays.term_id(token)] + rows
+    )
+    return np.repeat(docs.astype(np.int64), counts) * POSITION_STRIDE + positions
+
+
+def phrase_docs(
+    arrays: ArrayIndex, tokens: list[str], slop: int = 0, offsets=None
+) -> np.ndarray:
+    # Dense indexes of the documents where the tokens follow each other in order, token i
+    # offsets[i] words after the first one, consecutive by default. With slop they only have
+    # to fall within the phrase's span + slop consecutive positions, in any order.
+    # Only documents holding every token get their position lists decoded and merged.
+    if offsets is None:
+        offsets = list(range(len(tokens)))
+    unique_tokens = list(dict.fromkeys(tokens))
+    postings = {token: arrays.postings(token)[0] for token in unique_tokens}
+    docs = None
+    for token in sorted(unique_tokens, key=lambda token: len(postings[token])):
+        if docs is None:
+            docs = np.asarray(postings[token])
+        else:
+            docs = np.intersect1d(docs, postings[token], assume_unique=True)
+    if docs is None:
+        return np.empty(0, dtype=np.int64)
+    docs = docs.astype(np.int64)
+    if len(docs) == 0 or len(tokens) == 1 or slop > 0 and len(unique_tokens) == 1:
+        return docs
+
+    keys = {token: position_keys(arrays, token, docs) for token in unique_tokens}
+    if slop == 0:
+        # shifting every token's keys back by its offset in the phrase lines up the matches
+        order = sorted(range(len(tokens)), key=lambda i: len(keys[tokens[i]]))
+        matched = keys[tokens[order[0]]] - offsets[order[0]]
+        for i in order[1:]:
+            matched = np.intersect1d(
+                matched, keys[tokens[i]] - offsets[i], assume_unique=True
+            )
+        return np.unique(matched // POSITION_STRIDE)
+
+    # a window starting at any occurrence matches when every token occurs again inside it
+    # the span without repeated tokens, they can share one occurrence in any order
+    window = offsets[-1] - offsets[0] - (len(tokens) - len(unique_tokens)) + slop
+    starts = np.unique(np.concatenate(list(keys.values())))
+    matches = np.ones(len(starts), dtype=bool)
+    for token_keys in keys.values():
+        following = np.minimum(np.searchsorted(token_keys, starts), len(token_keys) - 1)
+        matches &= (token_keys[following] >= starts) & (
+            token_keys[following] - starts <= window
+        )
+    return np.unique(starts[matches] // POSITION_STRIDE)
@@ -0,0 +1,101 @@
+import os
+from itertools import chain
+
+import numpy as np
+
+from .postings_codec import (
+    decode_varints,
+    encode_varints,
+    range_indexes,
+    varint_lengths,
+)
+
+POSITIONS_FILE = "positions.npy"
+POSITIONS_OFFSETS_FILE = "positions_offsets.npy"
+
+
+class PositionLists:
+    # Token positions of every posting, in postings order. Posting p owns
+    # data[offsets[p]:offsets[p + 1]], varint coded gaps with the first position absolute,
+    # so lists can be decoded, reordered and concatenated without touching the others.
+    def __init__(self, offsets: np.ndarray, data: np.ndarray) -> None:
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_lists(cls, lists) -> "PositionLists":
+        counts = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+        positions = np.fromiter(
+            chain.from_iterable(lists), dtype=np.int64, count=int(counts.sum())
+        )
+        gaps = np.diff(positions, prepend=0)
+        firsts = (np.cumsum(counts) - counts)[counts > 0]
+        gaps[firsts] = positions[firsts]
+
+        byte_counts = np.bincount(
+            np.repeat(np.arange(len(lists)), counts),
+            weights=varint_lengths(gaps),
+            minlength=len(lists),
+        )
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(byte_counts.astype(np.int64), out=offsets[1:])
+        return cls(offsets, encode_varints(gaps))
+
+    @classmethod
+    def concatenate(cls, parts: list["PositionLists"]) -> "PositionLists":
+        offsets, datas, base = [np.zeros(1, dtype=np.int64)], [], 0
+        for part in parts:
+            offsets.append(np.asarray(part.offsets[1:]) + base)
+            datas.append(np.asarray(part.data))
+            base += int(part.offsets[-1])
+        return cls(
+            np.concatenate(offsets),
+            np.concatenate(datas + [np.empty(0, dtype=np.uint8)]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def take(self, postings: np.ndarray) -> "PositionLists":
+        # the lists of the given postings, in that order
+        starts = np.asarray(self.offsets)[postings]
+        lengths = np.asarray(self.offsets)[np.asarray(postings) + 1] - starts
+        offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return PositionLists(
+            offsets, np.asarray(self.data)[range_indexes(starts, lengths)]
+        )
+
+    def decode(self, postings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # number of positions of every given posting and all their positions, list after list
+        lists = self.take(postings)
+        if len(lists.data) == 0:
+            return np.zeros(len(lists), dtype=np.int64), np.empty(0, dtype=np.int64)
+        values = decode_varints(lists.data)
+        # every list is at least one position, so each one ends a whole number of varints in
+        counts = np.add.reduceat(lists.data < 0x80, lists.offsets[:-1]).astype(np.int64)
+        sums = np.cumsum(values)
+        firsts = np.cumsum(counts) - counts
+        return counts, sums - np.repeat(sums[firsts] - values[firsts], counts)
+
+    def save(self, path: str) -> None:
+        np.save(os.path.join(path, POSITIONS_OFFSETS_FILE), self.offsets)
+        np.save(os.path.join(path, POSITIONS_FILE), self.data)
+
+    @classmethod
+    def load(cls, path: str) -> "PositionLists":
+        return cls(
+            np.load(os.path.join(path, POSITIONS_OFFSETS_FILE), mmap_mode="r"),
+            np.load(os.path.join(path, POSITIONS_FILE), mmap_mode="r"),
+        )
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, POSITIONS_OFFSETS_FILE))
+
+    @staticmethod
+    def remove(path: str) -> None:
+        for name in (POSITIONS_OFFSETS_FILE, POSITIONS_FILE):
+            file_path = os.path.join(path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
@@ -0,0 +1,194 @@
+import os
+
+import numpy as np
+
+DOC_GAPS_FILE = "postings_doc_gaps.npy"
+TF_BYTES_FILE = "postings_tf_bytes.npy"
+BLOCK_DOC_GAP_OFFSETS_FILE = "block_doc_gap_offsets.npy"
+BLOCK_TF_OFFSETS_FILE = "block_tf_offsets.npy"
+BLOCK_FIRST_DOCS_FILE = "block_first_docs.npy"
+BLOCK_LAST_DOCS_FILE = "block_last_docs.npy"
+
+COMPRESSED_FILES = (
+    DOC_GAPS_FILE,
+    TF_BYTES_FILE,
+    BLOCK_DOC_GAP_OFFSETS_FILE,
+    BLOCK_TF_OFFSETS_FILE,
+    BLOCK_FIRST_DOCS_FILE,
+    BLOCK_LAST_DOCS_FILE,
+)
+
+
+def varint_lengths(values: np.ndarray) -> np.ndarray:
+    # bytes per value, 7 payload bits each, values are dense doc indexes or tfs so < 2**35
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        lengths += values >= (1 << shift)
+    return lengths
+
+
+def encode_varints(values) -> np.ndarray:
+    # little endian base 128, the high bit is set on every byte except a value's last
+    values = np.asarray(values, dtype=np.int64)
+    lengths = varint_lengths(values)
+    ends = np.cumsum(lengths)
+    value_idx = np.repeat(np.arange(len(values)), lengths)
+    shifts = 7 * (np.arange(len(value_idx)) - (ends - lengths)[value_idx])
+    data = ((values[value_idx] >> shifts) & 0x7F).astype(np.uint8)
+    continued = np.ones(len(data), dtype=bool)
+    continued[ends - 1] = False
+    data[continued] |= 0x80
+    return data
+
+
+def decode_varints(data) -> np.ndarray:
+    data = np.asarray(data)
+    ends = np.flatnonzero(data < 0x80)
+    # small gaps and tfs are one byte each, nothing to stitch together
+    if len(ends) == len(data):
+        return data.astype(np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    return np.add.reduceat((data & 0x7F).astype(np.int64) << shifts, starts)
+
+
+def range_indexes(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    # every index of the ranges [starts[i], starts[i] + lengths[i]) one after another
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(
+        ends[-1] if len(ends) else 0
+    )
+
+
+class CompressedPostings:
+    # Block-wise variable byte postings. Every POSTINGS_BLOCK_SIZE block stores its first doc
+    # as is and the rest as gaps to the previous doc, so any run of blocks decodes on its own.
+    # Blocks are numbered like the block-max metadata, block_starts[j] is the postings position
+    # block j starts at.
+    def __init__(
+        self,
+        doc_gaps: np.ndarray,
+        tf_bytes: np.ndarray,
+        block_doc_gap_offsets: np.ndarray,
+        block_tf_offsets: np.ndarray,
+        block_first_docs: np.ndarray,
+        block_last_docs: np.ndarray,
+        block_starts: np.ndarray,
+    ) -> None:
+        self.doc_gaps = doc_gaps
+        self.tf_bytes = tf_bytes
+        self.block_doc_gap_offsets = block_doc_gap_offsets
+        self.block_tf_offsets = block_tf_offsets
+        self.block_first_docs = block_first_docs
+        self.block_last_docs = block_last_docs
+        self.block_starts = block_starts
+
+    @classmethod
+    def encode(
+        cls, postings_docs, postings_tfs, block_starts: np.ndarray
+    ) -> "CompressedPostings":
+        docs = np.asarray(postings_docs, dtype=np.int64)
+        tfs = np.asarray(postings_tfs, dtype=np.int64)
+        firsts, lasts = block_starts[:-1], block_starts[1:] - 1
+
+        is_first = np.zeros(len(docs), dtype=bool)
+        is_first[firsts] = True
+        gaps = np.diff(docs, prepend=0)[~is_first]
+
+        # bytes before every block, the first docs take none in the gap stream
+        gap_lengths = np.zeros(len(docs), dtype=np.int64)
+        gap_lengths[~is_first] = varint_lengths(gaps)
+        gap_ends = np.concatenate(([0], np.cumsum(gap_lengths)))
+        tf_ends = np.concatenate(([0], np.cumsum(varint_lengths(tfs))))
+        return cls(
+            encode_varints(gaps),
+            encode_varints(tfs),
+            gap_ends[block_starts],
+            tf_ends[block_starts],
+            docs[firsts].astype(np.int32),
+            docs[lasts].astype(np.int32),
+            block_starts,
+        )
+
+    def decode(
+        self, first_block: int, last_block: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # docs and tfs of blocks first_block up to but not including last_block
+        return self.decode_blocks(np.arange(first_block, last_block))
+
+    def decode_blocks(self, blocks: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # docs and tfs of the given ascending blocks, one block after the other
+        if len(blocks) == 0:
+            empty = np.empty(0, dtype=np.int32)
+            return empty, empty
+        counts = self.block_starts[blocks + 1] - self.block_starts[blocks]
+        gap_starts = self.block_doc_gap_offsets[blocks]
+        gaps = decode_varints(
+            np.asarray(self.doc_gaps)[
+                range_indexes(
+                    gap_starts, self.block_doc_gap_offsets[blocks + 1] - gap_starts
+                )
+            ]
+        )
+        tf_starts = self.block_tf_offsets[blocks]
+        tfs = decode_varints(
+            np.asarray(self.tf_bytes)[
+                range_indexes(tf_starts, self.block_tf_offsets[blocks + 1] - tf_starts)
+            ]
+        )
+
+        # a block's first doc enters the running sum as the jump from the previous block
+        starts = np.cumsum(counts) - counts
+        values = np.empty(int(counts.sum()), dtype=np.int64)
+        is_first = np.zeros(len(values), dtype=bool)
+        is_first[starts] = True
+        values[~is_first] = gaps
+        previous_lasts = np.concatenate(([0], self.block_last_docs[blocks[:-1]]))
+        values[starts] = self.block_first_docs[blocks] - previous_lasts
+        return np.cumsum(values).astype(np.int32), tfs.astype(np.int32)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            np.asarray(array).nbytes
+            for array in (
+                self.doc_gaps,
+                self.tf_bytes,
+                self.block_doc_gap_offsets,
+                self.block_tf_offsets,
+                self.block_first_docs,
+                self.block_last_docs,
+            )
+        )
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, DOC_GAPS_FILE), self.doc_gaps)
+        np.save(os.path.join(path, TF_BYTES_FILE), self.tf_bytes)
+        np.save(
+            os.path.join(path, BLOCK_DOC_GAP_OFFSETS_FILE), self.block_doc_gap_offsets
+        )
+        np.save(os.path.join(path, BLOCK_TF_OFFSETS_FILE), self.block_tf_offsets)
+        np.save(os.path.join(path, BLOCK_FIRST_DOCS_FILE), self.block_first_docs)
+        np.save(os.path.join(path, BLOCK_LAST_DOCS_FILE), self.block_last_docs)
+
+    @classmethod
+    def load(cls, path: str, block_starts: np.ndarray) -> "CompressedPostings":
+        return cls(
+            *(
+                np.load(os.path.join(path, name), mmap_mode="r")
+                for name in COMPRESSED_FILES
+            ),
+            block_starts,
+        )
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, DOC_GAPS_FILE))
+
+    @staticmethod
+    def remove(path: str) -> None:
+        for name in COMPRESSED_FILES:
+            file_path = os.path.join(path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+
+from .vector_search import normalize_rows
+
+EMBEDDING_PRECISIONS = ("float32", "float16", "int8")
+
+# rows converted to float32 at once while scoring, small enough for the copy to stay in cache
+QUANTIZED_BATCH_ROWS = 1 << 10
+
+INT8_MAX = 127
+
+
+class QuantizedEmbeddings:
+    # Embedding rows in fewer bytes than float32. float16 halves them, int8 keeps
+    # round(x / scale) with one scale per dimension and takes a quarter. Scoring folds the
+    # scale into the query and converts a batch of rows at a time, the float32 matrix is never
+    # materialized. Indexing returns dequantized float32 rows.
+    def __init__(self, codes: np.ndarray, scale: np.ndarray | None = None) -> None:
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def quantize(cls, embeddings: np.ndarray, precision: str) -> "QuantizedEmbeddings":
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        match precision:
+            case "float16":
+                return cls(embeddings.astype(np.float16))
+            case "int8":
+                scale = np.abs(embeddings).max(axis=0) / INT8_MAX
+                scale[scale == 0] = 1
+                codes = np.rint(embeddings / scale).astype(np.int8)
+                return cls(codes, scale.astype(np.float32))
+            case _:
+                raise ValueError(f"unknown quantized precision: {precision}")
+
+    @property
+    def precision(self) -> str:
+        return self.codes.dtype.name
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, index) -> np.ndarray:
+        rows = np.asarray(self.codes[index], dtype=np.float32)
+        return rows if self.scale is None else rows * self.scale
+
+    def __matmul__(self, query: np.ndarray) -> np.ndarray:
+        query = np.asarray(query, dtype=np.float32)
+        if self.scale is not None:
+            query = query * self.scale
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), QUANTIZED_BATCH_ROWS):
+            batch = self.codes[start : start + QUANTIZED_BATCH_ROWS]
+            scores[start : start + len(batch)] = batch.astype(np.float32) @ query
+        return scores
+
+    def save(self, path: str) -> None:
+        # path without the extension, the int8 scale goes next to the codes
+        np.save(f"{path}.npy", self.codes)
+        if self.scale is not None:
+            np.save(f"{path}_scale.npy", self.scale)
+
+    @classmethod
+    def load(cls, path: str) -> "QuantizedEmbeddings":
+        codes = np.load(f"{path}.npy", mmap_mode="r")
+        scale = np.load(f"{path}_scale.npy") if codes.dtype == np.int8 else None
+        return cls(codes, scale)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(f"{path}.npy")
+
+    @staticmethod
+    def remove(path: str) -> None:
+        for file_path in (f"{path}.npy", f"{path}_scale.npy"):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+def quantized_path(embeddings_path: str, precision: str) -> str:
+    # cache/chunk_embeddings.npy is quantized to cache/chunk_embeddings_int8.npy
+    return f"{os.path.splitext(embeddings_path)[0]}_{precision}"
+
+
+def load_embeddings(embeddings_path: str, precision: str):
+    # Normalized embeddings of a saved float32 matrix. float32 is loaded whole, the other
+    # precisions are quantized from it once and memory-mapped from then on.
+    if precision == "float32":
+        return normalize_rows(np.load(embeddings_path))
+    path = quantized_path(embeddings_path, precision)
+    num_rows = len(np.load(embeddings_path, mmap_mode="r"))
+    if (
+        not QuantizedEmbeddings.exists(path)
+        or len(QuantizedEmbeddings.load(path)) != num_rows
+    ):
+        embeddings = normalize_rows(np.load(embeddings_path))
+        QuantizedEmbeddings.quantize(embeddings, precision).save(path)
+    return QuantizedEmbeddings.load(path)
+
+
+def full_precision_embeddings(embeddings_path: str, precision: str):
+    # memory-mapped float32 rows to rescore quantized candidates with, None for float32 itself
+    if precision == "float32":
+        return None
+    return np.load(embeddings_path, mmap_mode="r")
+
+
+def remove_quantized(embeddings_path: str) -> None:
+    # quantized copies of embeddings that are about to be replaced
+    for precision in EMBEDDING_PRECISIONS[1:]:
+        QuantizedEmbeddings.remove(quantized_path(embeddings_path, precision))
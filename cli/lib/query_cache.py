@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .search_utils import CACHE_DIR
+
+# query embeddings kept in memory per model, least recently used evicted first
+QUERY_CACHE_SIZE = 1024
+
+QUERY_CACHE_PATH = os.path.join(CACHE_DIR, "query_embeddings.sqlite")
+
+
+def normalize_query(query: str) -> str:
+    # surrounding and repeated whitespace never changes the embedding
+    return " ".join(query.split())
+
+
+class QueryEmbeddingCache:
+    # Bounded LRU of query embeddings in front of an optional SQLite store, keyed by model and
+    # normalized query text, so repeated queries skip the model across searches and runs.
+    # The store is opened on the first lookup memory cannot answer and created on the first
+    # embedding stored, a search that never encodes a query never touches the disk.
+    def __init__(
+        self,
+        model_name: str,
+        max_size: int = QUERY_CACHE_SIZE,
+        path: str | None = QUERY_CACHE_PATH,
+    ) -> None:
+        self.model_name = model_name
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # searches may run on worker threads
+        self.lock = threading.Lock()
+
+        self.path = path
+        self.db = None
+
+    def __database(self, create: bool = False) -> sqlite3.Connection | None:
+        # callers hold the lock
+        if self.db is None and self.path is not None:
+            if not create and not os.path.exists(self.path):
+                return None
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model TEXT, query TEXT, embedding BLOB, PRIMARY KEY (model, query))"
+            )
+        return self.db
+
+    def get(self, query: str) -> np.ndarray | None:
+        key = normalize_query(query)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            db = self.__database()
+            if db is not None:
+                row = db.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model = ? AND query = ?",
+                    (self.model_name, key),
+                ).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self.__remember(key, embedding)
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, query: str, embedding: np.ndarray) -> None:
+        key = normalize_query(query)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            self.__remember(key, embedding)
+            db = self.__database(create=True)
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                    (self.model_name, key, embedding.tobytes()),
+                )
+                db.commit()
+
+    def __remember(self, key: str, embedding: np.ndarray) -> None:
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def encode(self, model, query: str) -> np.ndarray:
+        embedding = self.get(query)
+        if embedding is None:
+            embedding = np.asarray(model.encode([query])[0], dtype=np.float32)
+            self.put(query, embedding)
+        return embedding
+
+    def encode_many(self, model, queries: list[str]) -> np.ndarray:
+        # one row per query, the ones not cached are encoded together in a single model call
+        embeddings = [self.get(query) for query in queries]
+        missing = list(
+            dict.fromkeys(
+                query
+                for query, embedding in zip(queries, embeddings)
+                if embedding is None
+            )
+        )
+        if missing:
+            encoded = dict(
+                zip(
+                    missing,
+                    np.asarray(model.encode(missing), dtype=np.float32),
+                )
+            )
+            for query, embedding in encoded.items():
+                self.put(query, embedding)
+            embeddings = [
+                encoded[query] if embedding is None else embedding
+                for query, embedding in zip(queries, embeddings)
+            ]
+        return np.stack(embeddings)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+query_caches = {}
+
+
+def get_query_cache(model_name: str) -> QueryEmbeddingCache:
+    # one cache per model and process, shared by every search object using that model
+    if model_name not in query_caches:
+        query_caches[model_name] = QueryEmbeddingCache(model_name)
+    return query_caches[model_name]
+
+
+def format_query_cache_stats(stats: dict) -> str:
+    return (
+        f"Query cache: {stats['hits']} hits, {stats['disk_hits']} disk hits,"
+        f" {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)"
+    )
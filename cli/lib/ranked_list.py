@@ -0,0 +1,115 @@
+import numpy as np
+
+
+class RankedList:
+    # A retriever's complete result list, every document it scored ranked by order score, high
+    # first, ties broken by the lowest tiebreak like select_top_k. Reading it from the top only
+    # sorts as much of it as was read or looked up, growing the sorted prefix by doubling, so a
+    # reader that stops early never pays for a full sort. The retriever has already scored
+    # every document though, it is not resumable: stopping early saves sorting and fusion
+    # work, not scoring. depth cuts the list where a top-k search with that limit would.
+    # scores are what the retriever reports for each document, they may be rounded order
+    # scores but never rank differently.
+    def __init__(
+        self,
+        docs,
+        order_scores,
+        tiebreak=None,
+        depth: int | None = None,
+        scores=None,
+    ) -> None:
+        self.docs = np.asarray(docs, dtype=np.int64)
+        self.order_scores = np.asarray(order_scores)
+        self.tiebreak = self.docs if tiebreak is None else np.asarray(tiebreak)
+        self.scores = np.asarray(
+            self.order_scores if scores is None else scores, dtype=np.float64
+        )
+        self.length = len(self.docs) if depth is None else min(depth, len(self.docs))
+        # row of every document id in the arrays above, -1 for ids not in the list
+        self.index = np.full(
+            int(self.docs.max()) + 1 if len(self.docs) else 0, -1, dtype=np.int64
+        )
+        self.index[self.docs] = np.arange(len(self.docs))
+        # rows of the sorted prefix, and how much of it was read
+        self.order = np.empty(0, dtype=np.int64)
+        self.depth = 0
+        # 1-based rank of every row in the sorted prefix, 0 for the rows not in it
+        self.rank = np.zeros(len(self.docs), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def exhausted(self) -> bool:
+        return self.depth >= self.length
+
+    def __sort(self, count: int) -> None:
+        if count <= len(self.order):
+            return
+        count = min(self.length, max(count, 2 * len(self.order)))
+        if count < len(self.docs):
+            kth_score = self.order_scores[
+                np.argpartition(self.order_scores, -count)[-count]
+            ]
+            # everything tied with the k-th score so the tie break stays exact
+            rows = np.flatnonzero(self.order_scores >= kth_score)
+        else:
+            rows = np.arange(len(self.docs))
+        order = np.lexsort((self.tiebreak[rows], -self.order_scores[rows]))
+        # the order is total, the prefix sorted before stays as it was
+        sorted_before = len(self.order)
+        self.order = rows[order[:count]]
+        self.rank[self.order[sorted_before:]] = np.arange(sorted_before + 1, count + 1)
+
+    def read(self, count: int) -> np.ndarray:
+        # the next count documents, fewer at the end of the list
+        self.__sort(self.depth + count)
+        rows = self.order[self.depth : min(self.depth + count, self.length)]
+        self.depth += len(rows)
+        return self.docs[rows]
+
+    def bound(self) -> float | None:
+        # reported score of the first document not read yet, None once the list is read
+        if self.exhausted:
+            return None
+        self.__sort(self.depth + 1)
+        return float(self.scores[self.order[self.depth]])
+
+    def score_range(self) -> tuple[float, float]:
+        # lowest and highest reported score of the list, without sorting it
+        if self.length == 0:
+            return 0.0, 0.0
+        highest = np.argmax(self.order_scores)
+        if self.length == len(self.docs):
+            lowest = np.argmin(self.order_scores)
+        else:
+            lowest = np.argpartition(self.order_scores, -self.length)[-self.length]
+        return float(self.scores[lowest]), float(self.scores[highest])
+
+    def rows(self, docs) -> np.ndarray:
+        docs = np.asarray(docs, dtype=np.int64)
+        known = docs < len(self.index)
+        rows = np.full(len(docs), -1, dtype=np.int64)
+        rows[known] = self.index[docs[known]]
+        return rows
+
+    def ranks(self, docs) -> np.ndarray:
+        # 1-based rank of each document, 0 for ones the list does not have or cuts off. Works
+        # for documents not read yet, the sorted prefix grows down to the lowest scored of them
+        rows = self.rows(docs)
+        found = rows[rows >= 0]
+        if len(found):
+            lowest = self.order_scores[found].min()
+            self.__sort(
+                min(self.length, int(np.count_nonzero(self.order_scores >= lowest)))
+            )
+        ranks = np.zeros(len(rows), dtype=np.int64)
+        ranks[rows >= 0] = self.rank[found]
+        return ranks
+
+    def reported_scores(self, docs) -> np.ndarray:
+        # reported score of each document the list has, 0 for the others
+        rows = self.rows(docs)
+        scores = np.zeros(len(rows), dtype=np.float64)
+        scores[rows >= 0] = self.scores[rows[rows >= 0]]
+        return scores
@@ -0,0 +1,79 @@
+import importlib
+import threading
+import time
+
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-TinyBERT-L2-v2"
+
+
+class LazyResource:
+    # Stands in for a model, client or module that is slow to create. The factory runs on the
+    # first attribute access and its result is shared by the whole process from then on, so a
+    # command that never touches it never pays for it.
+    def __init__(self, name: str, factory) -> None:
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.loaded = False
+        self.load_seconds = 0.0
+        # searches may run on worker threads, the factory must still run once
+        self.lock = threading.Lock()
+
+    def get(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    start = time.perf_counter()
+                    self.value = self.factory()
+                    self.load_seconds = time.perf_counter() - start
+                    self.loaded = True
+        return self.value
+
+    def __getattr__(self, attribute: str):
+        # only reached for attributes the proxy itself does not have
+        if attribute.startswith("__"):
+            raise AttributeError(attribute)
+        return getattr(self.get(), attribute)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<LazyResource {self.name} ({state})>"
+
+
+resources = {}
+
+
+def lazy_resource(name: str, factory) -> LazyResource:
+    # one resource per name and process, later registrations share the first one
+    if name not in resources:
+        resources[name] = LazyResource(name, factory)
+    return resources[name]
+
+
+def lazy_import(module_name: str) -> LazyResource:
+    return lazy_resource(
+        f"module {module_name}", lambda: importlib.import_module(module_name)
+    )
+
+
+def sentence_transformer(model_name: str) -> LazyResource:
+    # sentence_transformers pulls in torch, importing it alone takes seconds
+    return lazy_resource(
+        f"sentence transformer {model_name}",
+        lambda: lazy_import("sentence_transformers").SentenceTransformer(model_name),
+    )
+
+
+def cross_encoder(model_name: str = CROSS_ENCODER_MODEL) -> LazyResource:
+    return lazy_resource(
+        f"cross encoder {model_name}",
+        lambda: lazy_import("sentence_transformers").CrossEncoder(model_name),
+    )
+
+
+def loaded_resources() -> dict[str, float]:
+    # seconds each resource took to load, for the ones used so far
+    return {
+        name: resource.load_seconds
+        for name, resource in resources.items()
+        if resource.loaded
+    }
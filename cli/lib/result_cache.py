@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .query_cache import normalize_query
+from .search_utils import CACHE_DIR
+
+# bytes of serialized results kept in memory, least recently used evicted first
+RESULT_CACHE_MAX_BYTES = 32 * 1024**2
+
+# seconds a cached result is served, reranked results come from an llm that may change
+RESULT_CACHE_TTL = 24 * 60 * 60
+
+RESULT_CACHE_PATH = os.path.join(CACHE_DIR, "hybrid_results.sqlite")
+
+
+def index_version(*parts: str | None) -> str:
+    # one fingerprint of everything a search result depends on besides its parameters
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(f"{part}\0".encode())
+    return digest.hexdigest()
+
+
+def result_key(version: str, search: str, query: str, **params) -> str:
+    # params like k, alpha, limit, enhance or rerank_method, None ones are left out so adding
+    # an option later keeps the keys of searches that do not use it
+    params = {name: value for name, value in params.items() if value is not None}
+    return json.dumps(
+        [version, search, normalize_query(query), params],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+
+
+class ResultCache:
+    # Search results by result_key, serialized to json. The memory tier is an LRU bounded by
+    # the size of the serialized results, an optional SQLite store keeps them across runs.
+    # Every entry expires ttl seconds after it was stored, and the index version in the key
+    # makes results of a rebuilt index unreachable. get returns a fresh copy each time,
+    # callers may add scores to the result dicts. The store is opened, and its expired rows
+    # deleted, on the first lookup memory cannot answer, and created on the first put.
+    def __init__(
+        self,
+        max_bytes: int = RESULT_CACHE_MAX_BYTES,
+        ttl: float = RESULT_CACHE_TTL,
+        path: str | None = RESULT_CACHE_PATH,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        # searches may run on worker threads
+        self.lock = threading.Lock()
+
+        self.path = path
+        self.db = None
+
+    def __database(self, create: bool = False) -> sqlite3.Connection | None:
+        # callers hold the lock
+        if self.db is None and self.path is not None:
+            if not create and not os.path.exists(self.path):
+                return None
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS hybrid_results ("
+                "key TEXT PRIMARY KEY, results TEXT, stored REAL)"
+            )
+            self.db.execute(
+                "DELETE FROM hybrid_results WHERE stored < ?",
+                (time.time() - self.ttl,),
+            )
+            self.db.commit()
+        return self.db
+
+    def get(self, key: str) -> list[dict] | None:
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                stored, payload = self.entries[key]
+                if now - stored <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(payload)
+                self.__forget(key)
+                self.expired += 1
+            db = self.__database()
+            if db is not None:
+                row = db.execute(
+                    "SELECT results, stored FROM hybrid_results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl:
+                    self.disk_hits += 1
+                    self.__remember(key, row[1], row[0])
+                    return json.loads(row[0])
+            self.misses += 1
+            return None
+
+    def put(self, key: str, results: list[dict]) -> None:
+        # numpy scores serialize as plain floats
+        payload = json.dumps(results, default=float)
+        stored = time.time()
+        with self.lock:
+            self.__remember(key, stored, payload)
+            db = self.__database(create=True)
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO hybrid_results VALUES (?, ?, ?)",
+                    (key, payload, stored),
+                )
+                db.commit()
+
+    def __remember(self, key: str, stored: float, payload: str) -> None:
+        if key in self.entries:
+            self.__forget(key)
+        self.entries[key] = (stored, payload)
+        self.nbytes += len(payload)
+        while self.nbytes > self.max_bytes and self.entries:
+            self.__forget(next(iter(self.entries)))
+            self.evictions += 1
+
+    def __forget(self, key: str) -> None:
+        _, payload = self.entries.pop(key)
+        self.nbytes -= len(payload)
+
+    def cached(self, key: str, search) -> list[dict]:
+        results = self.get(key)
+        if results is None:
+            results = search()
+            # stored serialized, changes the caller makes from here on do not reach the cache
+            self.put(key, results)
+        return results
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+result_cache = None
+
+
+def get_result_cache() -> ResultCache:
+    # one cache per process, shared by every hybrid search
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache()
+    return result_cache
+
+
+def format_result_cache_stats(stats: dict) -> str:
+    return (
+        f"Result cache: {stats['hits']} hits, {stats['disk_hits']} disk hits,"
+        f" {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate),"
+        f" {stats['entries']} entries / {stats['bytes'] / 1024:.0f} KiB,"
+        f" {stats['evictions']} evicted, {stats['expired']} expired"
+    )
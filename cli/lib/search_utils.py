@@ -26,6 +26,51 @@ def load_movies() -> list[dict]:
     return data["movies"]
 
 
+def iter_movies(chunk_size: int = 1 << 16):
+    # streams the movies array of movies.json one movie at a time instead of loading it whole
+    decoder = json.JSONDecoder()
+    with open(DATA_PATH, "r") as f:
+        buffer, pos = "", 0
+
+        def fill() -> bool:
+            nonlocal buffer, pos
+            chunk = f.read(chunk_size)
+            buffer, pos = buffer[pos:] + chunk, 0
+            return bool(chunk)
+
+        while '"movies"' not in buffer:
+            if not fill():
+                return
+        pos = buffer.index('"movies"') + len('"movies"')
+        for expected in ":[":
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer) or not fill():
+                    break
+            if buffer[pos : pos + 1] != expected:
+                raise ValueError(f"expected '{expected}' in {DATA_PATH}")
+            pos += 1
+
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+                pos += 1
+            if pos == len(buffer):
+                if not fill():
+                    raise ValueError(f"unterminated movies array in {DATA_PATH}")
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                movie, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+                continue
+            pos = end
+            yield movie
+
+
 def load_stopwords() -> list[str]:
     with open(STOPWORDS_PATH, "r") as f:
         return f.read().splitlines()
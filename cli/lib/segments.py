@@ -0,0 +1,348 @@
+import bisect
+import json
+import os
+import shutil
+import time
+from collections.abc import Mapping
+
+import numpy as np
+
+from .analyzer import get_analyzer
+from .bm25 import BM25Scorer, select_top_k
+from .index_arrays import ArrayIndex
+from .search_utils import BM25_K1, BM25_B
+
+MANIFEST_FILE = "manifest.json"
+SEGMENTS_DIR = "segments"
+
+# once there are more delta segments than this they get merged into one
+MAX_DELTA_SEGMENTS = 8
+
+
+def new_entry(path: str, arrays: ArrayIndex) -> dict:
+    # num_docs and total_length only count live documents, df_deltas undo the deleted ones
+    return {
+        "path": path,
+        "num_docs": arrays.num_docs,
+        "total_length": arrays.total_length,
+        "tombstones": [],
+        "df_deltas": {},
+    }
+
+
+class SegmentedIndex:
+    # LSM style keyword index: immutable ArrayIndex segments, oldest first, plus per segment
+    # tombstones. A document is identified across segments by its key, the segment's base
+    # offset plus its dense index, which also gives the doc order for ties.
+    def __init__(
+        self, path: str | None, entries: list[dict], segments: list[ArrayIndex]
+    ) -> None:
+        self.path = path
+        self.entries = entries
+        self.segments = segments
+        self.next_segment = 1
+        # segments written later use the base's postings format
+        self.compress = bool(segments) and segments[0].compressed is not None
+        self.lives = [self.__live_mask(s, e) for s, e in zip(segments, entries)]
+        self.bases = [0]
+        for seg in segments:
+            self.bases.append(self.bases[-1] + seg.num_docs)
+        self.scorers: list[BM25Scorer] | None = None
+        self.docs = SegmentedDocs(self)
+
+    @classmethod
+    def from_arrays(cls, arrays: ArrayIndex) -> "SegmentedIndex":
+        return cls(None, [new_entry(".", arrays)], [arrays])
+
+    @classmethod
+    def create(cls, path: str, arrays: ArrayIndex) -> "SegmentedIndex":
+        # a freshly saved base segment replaces whatever segments were there before
+        shutil.rmtree(os.path.join(path, SEGMENTS_DIR), ignore_errors=True)
+        segmented = cls(path, [new_entry(".", arrays)], [arrays])
+        segmented.save_manifest()
+        return segmented
+
+    @classmethod
+    def load(cls, path: str) -> "SegmentedIndex":
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return cls.create(path, ArrayIndex.load(path))
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        entries = manifest["segments"]
+        segments = [ArrayIndex.load(os.path.join(path, e["path"])) for e in entries]
+        segmented = cls(path, entries, segments)
+        segmented.next_segment = manifest["next_segment"]
+        segmented.compress = manifest.get("compress", False)
+        return segmented
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, MANIFEST_FILE)) or ArrayIndex.exists(
+            path
+        )
+
+    def save_manifest(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        # write then rename so readers never see a half written manifest
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "next_segment": self.next_segment,
+                    "compress": self.compress,
+                    "segments": self.entries,
+                },
+                f,
+            )
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def __live_mask(self, seg: ArrayIndex, entry: dict) -> np.ndarray | None:
+        if not entry["tombstones"]:
+            return None
+        return ~np.isin(seg.doc_ids, entry["tombstones"])
+
+    @property
+    def num_docs(self) -> int:
+        return sum(e["num_docs"] for e in self.entries)
+
+    @property
+    def total_length(self) -> int:
+        return sum(e["total_length"] for e in self.entries)
+
+    @property
+    def avg_doc_length(self) -> float:
+        if self.num_docs == 0:
+            return 0.0
+        return self.total_length / self.num_docs
+
+    @property
+    def positional(self) -> bool:
+        return all(seg.positions is not None for seg in self.segments)
+
+    def doc_frequency(self, term: str) -> int:
+        return sum(
+            seg.doc_frequency(term) + entry["df_deltas"].get(term, 0)
+            for seg, entry in zip(self.segments, self.entries)
+        )
+
+    def locate(self, doc_id: int) -> tuple[int, int]:
+        # segment and dense index of the live version of a document, newest segment wins
+        for i in range(len(self.segments) - 1, -1, -1):
+            dense_idx = self.segments[i].dense_index(doc_id)
+            if dense_idx >= 0 and (self.lives[i] is None or self.lives[i][dense_idx]):
+                return i, dense_idx
+        return -1, -1
+
+    def doc_id(self, key: int) -> int:
+        i = bisect.bisect_right(self.bases, key) - 1
+        return int(self.segments[i].doc_ids[key - self.bases[i]])
+
+    def live_keys(self):
+        for i, seg in enumerate(self.segments):
+            for dense_idx in range(seg.num_docs):
+                if self.lives[i] is None or self.lives[i][dense_idx]:
+                    yield self.bases[i] + dense_idx
+
+    def get_documents(self, term: str) -> list[int]:
+        doc_ids = []
+        for seg, live in zip(self.segments, self.lives):
+            docs, _ = seg.postings(term)
+            if live is not None:
+                docs = docs[live[docs]]
+            doc_ids.append(seg.doc_ids[docs])
+        return np.sort(np.concatenate(doc_ids)).tolist()
+
+    def tf(self, doc_id: int, term: str) -> int:
+        i, _ = self.locate(doc_id)
+        return self.segments[i].tf(doc_id, term) if i >= 0 else 0
+
+    def doc_length(self, doc_id: int) -> int:
+        i, dense_idx = self.locate(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return int(self.segments[i].doc_lengths[dense_idx])
+
+    def get_scorers(self) -> list[BM25Scorer]:
+        if self.scorers is None:
+            self.scorers = [
+                BM25Scorer(seg, BM25_K1, BM25_B, stats=self, live=live)
+                for seg, live in zip(self.segments, self.lives)
+            ]
+        return self.scorers
+
+    def top_k(self, tokens, limit: int, pruned: bool = False):
+        # per segment top-k merged on keys, returns ([(key, score)], pruning counters)
+        keys, scores = [], []
+        stats = {}
+        for base, scorer in zip(self.bases, self.get_scorers()):
+            if pruned:
+                top, seg_stats = scorer.top_k_pruned(tokens, limit)
+                for name, value in seg_stats.items():
+                    stats[name] = stats.get(name, 0) + value
+            else:
+                top = scorer.top_k(tokens, limit)
+            keys.extend(base + dense_idx for dense_idx, _ in top)
+            scores.extend(score for _, score in top)
+        top = select_top_k(
+            np.array(keys, dtype=np.int64), np.array(scores, dtype=np.float64), limit
+        )
+        return top, stats
+
+    def score_all(self, tokens) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (keys, doc ids, scores) of every live document, 0 for the ones matching no token
+        keys, doc_ids, scores = [], [], []
+        for base, seg, live, scorer in zip(
+            self.bases, self.segments, self.lives, self.get_scorers()
+        ):
+            docs, matched = scorer.score(tokens)
+            seg_scores = np.zeros(seg.num_docs, dtype=np.float64)
+            seg_scores[docs] = matched
+            dense = np.arange(seg.num_docs)
+            if live is not None:
+                dense = dense[live]
+            keys.append(base + dense)
+            doc_ids.append(np.asarray(seg.doc_ids)[dense])
+            scores.append(seg_scores[dense])
+        return (
+            np.concatenate(keys + [np.empty(0, dtype=np.int64)]),
+            np.concatenate(doc_ids + [np.empty(0, dtype=np.int64)]),
+            np.concatenate(scores + [np.empty(0, dtype=np.float64)]),
+        )
+
+    def top_k_many(self, queries, limit: int) -> list[list[tuple[int, float]]]:
+        # top_k of every token list, each segment scores the whole batch at once
+        keys = [[] for _ in queries]
+        scores = [[] for _ in queries]
+        for base, scorer in zip(self.bases, self.get_scorers()):
+            for i, top in enumerate(scorer.top_k_many(queries, limit)):
+                keys[i].extend(base + dense_idx for dense_idx, _ in top)
+                scores[i].extend(score for _, score in top)
+        return [
+            select_top_k(
+                np.array(query_keys, dtype=np.int64),
+                np.array(query_scores, dtype=np.float64),
+                limit,
+            )
+            for query_keys, query_scores in zip(keys, scores)
+        ]
+
+    def match_top_k(self, query, tokens, limit: int):
+        # top-k by bm25 over tokens among the documents matching a boolean query node, returns
+        # ([(key, score)], counters) with matching and scoring timed apart
+        stats = {
+            "matches": 0,
+            "postings_read": 0,
+            # what reading every postings list of the query would take
+            "postings_total": sum(
+                seg.doc_frequency(token)
+                for seg in self.segments
+                for token in set(query.tokens() + query.tokens(True))
+            ),
+            "match_ms": 0.0,
+            "scoring_ms": 0.0,
+        }
+        keys, scores = [], []
+        for base, seg, live, scorer in zip(
+            self.bases, self.segments, self.lives, self.get_scorers()
+        ):
+            start = time.perf_counter()
+            docs = query.evaluate(seg, stats)
+            if live is not None:
+                docs = docs[live[docs]]
+            stats["match_ms"] += (time.perf_counter() - start) * 1000
+            stats["matches"] += len(docs)
+
+            start = time.perf_counter()
+            keys.append(base + docs)
+            scores.append(scorer.score_docs(tokens, docs))
+            stats["scoring_ms"] += (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        top = select_top_k(
+            np.concatenate(keys + [np.empty(0, dtype=np.int64)]),
+            np.concatenate(scores + [np.empty(0, dtype=np.float64)]),
+            limit,
+        )
+        stats["scoring_ms"] += (time.perf_counter() - start) * 1000
+        return top, stats
+
+    def delete(self, doc_id: int) -> bool:
+        i, dense_idx = self.locate(doc_id)
+        if i < 0:
+            return False
+        seg, entry = self.segments[i], self.entries[i]
+        entry["tombstones"].append(doc_id)
+        if self.lives[i] is None:
+            self.lives[i] = np.ones(seg.num_docs, dtype=bool)
+        self.lives[i][dense_idx] = False
+
+        # the segment's postings still count the document, undo it in the stats
+        doc = seg.docs[doc_id]
+        for token in set(
+            get_analyzer().tokenize(f"{doc['title']} {doc['description']}")
+        ):
+            entry["df_deltas"][token] = entry["df_deltas"].get(token, 0) - 1
+        entry["num_docs"] -= 1
+        entry["total_length"] -= int(seg.doc_lengths[dense_idx])
+        self.scorers = None
+        return True
+
+    def add_segment(self, arrays: ArrayIndex) -> None:
+        path = os.path.join(SEGMENTS_DIR, f"{self.next_segment:06d}")
+        self.next_segment += 1
+        arrays.save(os.path.join(self.path, path), self.compress)
+        self.__append(path, ArrayIndex.load(os.path.join(self.path, path)))
+
+    def __append(self, path: str, arrays: ArrayIndex) -> None:
+        self.entries.append(new_entry(path, arrays))
+        self.segments.append(arrays)
+        self.lives.append(None)
+        self.bases.append(self.bases[-1] + arrays.num_docs)
+        self.scorers = None
+
+    def merge(self, full: bool = False) -> None:
+        # merges every delta segment into one, or everything including the base with full
+        start = 0 if full else 1
+        if len(self.segments) - start < 2 and not any(
+            e["tombstones"] for e in self.entries[start:]
+        ):
+            return
+        merged = ArrayIndex.merge(self.segments[start:], self.lives[start:])
+        old_paths = [e["path"] for e in self.entries[start:]]
+
+        del self.entries[start:], self.segments[start:], self.lives[start:]
+        del self.bases[start + 1 :]
+        self.add_segment(merged)
+        self.save_manifest()
+
+        for path in old_paths:
+            if path == ".":
+                ArrayIndex.remove(self.path)
+            else:
+                shutil.rmtree(os.path.join(self.path, path), ignore_errors=True)
+
+    def maybe_merge(self) -> None:
+        if len(self.segments) - 1 > MAX_DELTA_SEGMENTS:
+            self.merge()
+
+
+class SegmentedDocs(Mapping):
+    # id -> movie dict over the live documents of all segments
+    def __init__(self, segmented: SegmentedIndex) -> None:
+        self.segmented = segmented
+
+    def __getitem__(self, doc_id: int) -> dict:
+        i, _ = self.segmented.locate(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self.segmented.segments[i].docs[doc_id]
+
+    def __contains__(self, doc_id) -> bool:
+        return self.segmented.locate(doc_id)[0] >= 0
+
+    def __iter__(self):
+        return (self.segmented.doc_id(key) for key in self.segmented.live_keys())
+
+    def __len__(self) -> int:
+        return self.segmented.num_docs
@@ -1,18 +1,81 @@
-from sentence_transformers import SentenceTransformer
+import contextlib
 import numpy as np
 import os
 from lib.search_utils import CACHE_DIR, load_movies
 import re
-import json
 
+from lib.binary_codes import BINARY_DEFAULT_CANDIDATES, BinaryCodes
+from lib.chunk_metadata import ChunkMetadata
+from lib.embedding_build import EMBEDDING_BUILD_BATCH_SIZE, stream_embeddings
+from lib.embedding_cache import (
+    EmbeddingCache,
+    read_fingerprint,
+    texts_fingerprint,
+    write_fingerprint,
+)
+from lib.encoding_pool import EncodingPool
+from lib.ivf_index import IVF_DEFAULT_NPROBE, IVFIndex
+from lib.query_cache import get_query_cache
+from lib.ranked_list import RankedList
+from lib.quantization import (
+    QuantizedEmbeddings,
+    full_precision_embeddings,
+    load_embeddings,
+    remove_quantized,
+)
+from lib.resources import sentence_transformer
 from lib.search_utils import SCORE_PRECISION
+from lib.vector_search import (
+    RESCORE_OVERSAMPLING,
+    ChunkGroups,
+    normalize_rows,
+    rescore_rows,
+    top_k_movies,
+    top_k_movies_many,
+    top_k_rows,
+)
+
+# exact scores every chunk, ivf only the chunks in the nprobe closest lists of the ANN index,
+# binary only the candidates chunks whose sign bit codes are closest in hamming distance
+SEARCH_STRATEGIES = ("exact", "ivf", "binary")
+
+SEMANTIC_MODEL = "all-MiniLM-L6-v2"
+
+# queries scored per matrix product in batch searches, bounds the (chunks, queries) scores
+SEMANTIC_QUERY_BATCH_SIZE = 64
+
+
+def document_text(doc: dict) -> str:
+    # the text a movie is embedded from
+    return f"{doc['title']}: {doc['description']}"
+
+
+def description_chunks(doc: dict) -> list[str]:
+    # the texts a movie's chunk embeddings are embedded from
+    description = doc["description"]
+    if not description or not description.strip():
+        return []
+    return chunking_semantic(description, max_chunk_size=4, overlap=1)
 
 
 class SemanticSearch:
-    def __init__(self):
-        self.model = SentenceTransformer("all-MiniLM-L6-v2")
+    # precision float16 or int8 searches quantized, memory-mapped copies of the embeddings and
+    # rescores the best candidates from the memory-mapped float32 ones, workers above 1 builds
+    # embeddings on that many processes
+    def __init__(self, precision="float32", workers=1):
+        self.model_name = SEMANTIC_MODEL
+        # loaded on the first text that is not in the embedding or query cache
+        self.model = sentence_transformer(self.model_name)
+        self.precision = precision
+        self.workers = workers
+        self.embedding_cache = EmbeddingCache(
+            os.path.join(CACHE_DIR, "embedding_cache", self.model_name),
+            self.model_name,
+        )
+        self.query_cache = get_query_cache(self.model_name)
 
         self.embeddings = None
+        self.full_embeddings = None
         self.documents = None
         self.document_map = {}
 
@@ -22,142 +85,292 @@ class SemanticSearch:
         if len(text) == 0:
             raise ValueError("text must not be empty.")
 
-        result = self.model.encode([text])
-        return result[0]
+        return self.query_cache.encode(self.model, text)
 
-    def search(self, query, limit):
+    def search(self, query, limit, rescore=RESCORE_OVERSAMPLING):
         if self.embeddings is None:
             raise ValueError(
                 "No embeddings loaded. Call `load_or_create_embeddings` first."
             )
         query_embedding = self.generate_embedding(query)
 
-        similarities = np.array(
-            [cosine_similarity(query_embedding, emb) for emb in self.embeddings]
-        )
-        top_indices = np.argsort(similarities)[::-1][:limit]
         return [
             {
-                "score": similarities[i],
+                "score": score,
                 "title": self.documents[i]["title"],
                 "description": self.documents[i]["description"],
             }
-            for i in top_indices
+            for i, score in top_k_rows(
+                self.embeddings, query_embedding, limit, self.full_embeddings, rescore
+            )
         ]
 
     def build_embeddings(self, documents):
         self.documents = documents
-
-        doc_strings = []
         for doc in documents:
             self.document_map[doc["id"]] = doc
-            doc_strings.append(f"{doc['title']}: {doc['description']}")
 
-        self.embeddings = self.model.encode(doc_strings, show_progress_bar=True)
-        self.save()
+        fingerprint = texts_fingerprint(
+            self.model_name, (document_text(doc) for doc in documents)
+        )
+        remove_quantized(self.embeddings_path)
+        with self.corpus_encoder() as encoder:
+            stream_embeddings(
+                self.embeddings_path,
+                (document_text(doc) for doc in documents),
+                len(documents),
+                fingerprint,
+                self.embedding_cache,
+                encoder,
+                EMBEDDING_BUILD_BATCH_SIZE * self.workers,
+            )
+        write_fingerprint(self.embeddings_path, fingerprint)
+        self.__load_embeddings()
         return self.embeddings
 
+    def corpus_encoder(self):
+        # the model for queries and single process builds, a pool of workers otherwise
+        if self.workers > 1:
+            return EncodingPool(self.model_name, self.workers)
+        return contextlib.nullcontext(self.model)
+
+    def __load_embeddings(self):
+        self.embeddings = load_embeddings(self.embeddings_path, self.precision)
+        self.full_embeddings = full_precision_embeddings(
+            self.embeddings_path, self.precision
+        )
+
     def load_or_create_embeddings(self, documents):
-        if os.path.exists(self.embeddings_path):
-            self.embeddings = np.load(self.embeddings_path)
+        # any changed movie text rebuilds, the embedding cache only encodes what changed
+        fingerprint = texts_fingerprint(
+            self.model_name, (document_text(doc) for doc in documents)
+        )
+        if read_fingerprint(self.embeddings_path) == fingerprint and os.path.exists(
+            self.embeddings_path
+        ):
+            self.__load_embeddings()
             self.documents = documents
             for doc in documents:
                 self.document_map[doc["id"]] = doc
-            if len(self.documents) != len(self.embeddings):
-                self.build_embeddings(documents)
         else:
             self.build_embeddings(documents)
 
         return self.embeddings
 
-    def save(self):
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        np.save(self.embeddings_path, self.embeddings)
-
 
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self) -> None:
-        super().__init__()
+    def __init__(self, precision: str = "float32", workers: int = 1) -> None:
+        super().__init__(precision, workers)
         self.chunk_embeddings = None
+        self.full_chunk_embeddings = None
         self.chunk_metadata = None
+        self.chunk_groups = None
+        self.ann_index = None
+        self.binary_codes = None
 
         self.chunk_embeddings_path = os.path.join(CACHE_DIR, "chunk_embeddings.npy")
-        self.chunk_metadata_path = os.path.join(CACHE_DIR, "chunk_metadata.json")
+        self.chunk_metadata_path = os.path.join(CACHE_DIR, "chunk_metadata")
+        self.ann_index_path = os.path.join(CACHE_DIR, "chunk_ivf")
+        self.binary_codes_path = os.path.join(CACHE_DIR, "chunk_binary_codes.npy")
 
     def build_chunk_embeddings(self, documents):
         self.documents = documents
-        all_chunks = []
-        chunk_metadata = []
+        # chunking is cheap next to encoding, a first pass only sizes the metadata so the
+        # chunk strings are never all held at once
+        movie_indexes = []
+        chunk_counts = []
+        text_lengths = []
         for doc_idx, doc in enumerate(documents):
             self.document_map[doc["id"]] = doc
-            description = doc["description"]
-            if not description or not description.strip():
+            chunks = description_chunks(doc)
+            if not chunks:
                 continue
-            chunks = chunking_semantic(description, max_chunk_size=4, overlap=1)
-            all_chunks.extend(chunks)
-            for chunk_idx in range(len(chunks)):
-                chunk_metadata.append(
-                    {
-                        "movie_idx": doc_idx,
-                        "chunk_idx": chunk_idx,
-                        "total_chunks": len(chunks),
-                    }
-                )
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=True)
-        self.chunk_metadata = chunk_metadata
-        self.save_chunk_embeddings()
-
-    def save_chunk_embeddings(self):
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        np.save(self.chunk_embeddings_path, self.chunk_embeddings)
-        with open(self.chunk_metadata_path, "w") as f:
-            json.dump(
-                {
-                    "chunks": self.chunk_metadata,
-                    "total_chunks": len(self.chunk_metadata),
-                },
-                f,
-                indent=2,
+            movie_indexes.append(doc_idx)
+            chunk_counts.append(len(chunks))
+            text_lengths.extend(len(chunk.encode()) for chunk in chunks)
+
+        # built over the old chunks, the next search that needs them rebuilds them
+        IVFIndex.remove(self.ann_index_path)
+        BinaryCodes.remove(self.binary_codes_path)
+        remove_quantized(self.chunk_embeddings_path)
+        self.chunk_metadata = ChunkMetadata.allocate(
+            self.chunk_metadata_path, movie_indexes, chunk_counts, text_lengths
+        )
+
+        def chunk_texts():
+            chunk = 0
+            for doc in documents:
+                for text in description_chunks(doc):
+                    self.chunk_metadata.write_text(chunk, text)
+                    chunk += 1
+                    yield text
+
+        fingerprint = self.__chunk_fingerprint(documents)
+        with self.corpus_encoder() as encoder:
+            stream_embeddings(
+                self.chunk_embeddings_path,
+                chunk_texts(),
+                len(self.chunk_metadata),
+                fingerprint,
+                self.embedding_cache,
+                encoder,
+                EMBEDDING_BUILD_BATCH_SIZE * self.workers,
             )
+        self.chunk_metadata.texts.flush()
+        write_fingerprint(self.chunk_embeddings_path, fingerprint)
+        self.__load_chunk_embeddings()
+        self.chunk_groups = ChunkGroups(self.chunk_metadata.movie_idx)
+
+    def __chunk_fingerprint(self, documents):
+        # chunks are cut from the descriptions alone
+        return texts_fingerprint(
+            self.model_name, (doc["description"] or "" for doc in documents)
+        )
+
+    def __load_chunk_embeddings(self):
+        self.chunk_embeddings = load_embeddings(
+            self.chunk_embeddings_path, self.precision
+        )
+        self.full_chunk_embeddings = full_precision_embeddings(
+            self.chunk_embeddings_path, self.precision
+        )
 
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
+    def load_or_create_chunk_embeddings(
+        self, documents: list[dict]
+    ) -> np.ndarray | QuantizedEmbeddings:
         self.documents = documents
         for doc in documents:
             self.document_map[doc["id"]] = doc
 
-        if os.path.exists(self.chunk_embeddings_path) and os.path.exists(
-            self.chunk_metadata_path
+        if (
+            read_fingerprint(self.chunk_embeddings_path)
+            == self.__chunk_fingerprint(documents)
+            and os.path.exists(self.chunk_embeddings_path)
+            and ChunkMetadata.exists(self.chunk_metadata_path)
         ):
-            self.chunk_embeddings = np.load(self.chunk_embeddings_path)
-            with open(self.chunk_metadata_path, "r") as f:
-                data = json.load(f)
-            self.chunk_metadata = data["chunks"]
+            self.__load_chunk_embeddings()
+            self.chunk_metadata = ChunkMetadata.load(self.chunk_metadata_path)
+            self.chunk_groups = ChunkGroups(self.chunk_metadata.movie_idx)
         else:
             self.build_chunk_embeddings(documents)
         return self.chunk_embeddings
 
-    def search_chunks(self, query: str, limit: int = 10):
-        query_embedding = self.model.encode(query.strip())
-        chunk_scores = []
-        for idx, c in enumerate(self.chunk_embeddings):
-            c_sim = cosine_similarity(query_embedding, c)
-            chunk_scores.append(
-                {
-                    "chunk_idx": idx,
-                    "movie_idx": self.chunk_metadata[idx]["movie_idx"],
-                    "score": c_sim,
-                }
+    def load_or_create_ann_index(self) -> IVFIndex:
+        if IVFIndex.exists(self.ann_index_path):
+            self.ann_index = IVFIndex.load(self.ann_index_path)
+            if len(self.ann_index) == len(self.chunk_embeddings):
+                return self.ann_index
+        self.ann_index = IVFIndex.build(self.chunk_embeddings)
+        self.ann_index.save(self.ann_index_path)
+        return self.ann_index
+
+    def load_or_create_binary_codes(self) -> BinaryCodes:
+        if BinaryCodes.exists(self.binary_codes_path):
+            self.binary_codes = BinaryCodes.load(self.binary_codes_path)
+            if len(self.binary_codes) == len(self.chunk_embeddings):
+                return self.binary_codes
+        # int8 rounds small components to zero, take the signs from float32 when there is one
+        embeddings = self.full_chunk_embeddings
+        if embeddings is None:
+            embeddings = self.chunk_embeddings
+        self.binary_codes = BinaryCodes.encode(embeddings)
+        self.binary_codes.save(self.binary_codes_path)
+        return self.binary_codes
+
+    def search_chunks(
+        self,
+        query: str,
+        limit: int = 10,
+        strategy: str = "exact",
+        nprobe: int = IVF_DEFAULT_NPROBE,
+        candidates: int = BINARY_DEFAULT_CANDIDATES,
+        rescore: int = RESCORE_OVERSAMPLING,
+    ):
+        query_embedding = self.query_cache.encode(self.model, query.strip())
+        match strategy:
+            case "exact":
+                rows = None
+            case "ivf":
+                if self.ann_index is None:
+                    self.load_or_create_ann_index()
+                rows = self.ann_index.candidates(query_embedding, nprobe)
+            case "binary":
+                if self.binary_codes is None:
+                    self.load_or_create_binary_codes()
+                rows = self.binary_codes.candidates(query_embedding, candidates)
+            case _:
+                raise ValueError(f"unknown search strategy: {strategy}")
+        results = top_k_movies(
+            self.chunk_embeddings,
+            self.chunk_groups,
+            query_embedding,
+            limit,
+            rows,
+            self.full_chunk_embeddings,
+            rescore,
+        )
+        return self.__chunk_results(results)
+
+    def search_chunks_many(
+        self, queries: list[str], limit: int = 10, strategy: str = "exact", **kwargs
+    ):
+        # search_chunks of every query with their embeddings encoded in one batch. Exact
+        # search of float32 embeddings scores a block of queries per matrix product, the
+        # other strategies and precisions search the queries one by one.
+        if not queries:
+            return []
+        queries = [query.strip() for query in queries]
+        query_embeddings = self.query_cache.encode_many(self.model, queries)
+        if strategy != "exact" or self.full_chunk_embeddings is not None:
+            return [
+                self.search_chunks(query, limit, strategy, **kwargs)
+                for query in queries
+            ]
+        results = []
+        for start in range(0, len(queries), SEMANTIC_QUERY_BATCH_SIZE):
+            results.extend(
+                self.__chunk_results(top)
+                for top in top_k_movies_many(
+                    self.chunk_embeddings,
+                    self.chunk_groups,
+                    query_embeddings[start : start + SEMANTIC_QUERY_BATCH_SIZE],
+                    limit,
+                )
             )
-        movie_scores = {}
-        for c in chunk_scores:
-            if (
-                c["movie_idx"] not in movie_scores
-                or movie_scores[c["movie_idx"]] < c["score"]
-            ):
-                movie_scores[c["movie_idx"]] = c["score"]
-        results = sorted(movie_scores.items(), key=lambda key: key[1], reverse=True)[
-            :limit
-        ]
+        return results
+
+    def search_chunks_ranked(
+        self, query: str, depth: int | None = None, rescore: int = RESCORE_OVERSAMPLING
+    ) -> RankedList:
+        # every movie with chunks ranked by its best chunk and keyed by id, read from the top
+        # it returns what exact search_chunks with limit depth returns. Quantized embeddings
+        # rank the movies of the best depth * rescore chunks by their float32 scores, like
+        # search_chunks rescoring them. Every chunk is scored before the list is read.
+        query_embedding = normalize_rows(
+            self.query_cache.encode(self.model, query.strip())
+        )
+        scores = self.chunk_embeddings @ query_embedding
+        if self.full_chunk_embeddings is not None and rescore > 0:
+            rows, scores = rescore_rows(
+                self.full_chunk_embeddings,
+                query_embedding,
+                np.arange(len(scores)),
+                scores,
+                len(scores) if depth is None else depth * rescore,
+            )
+            movies, scores = self.chunk_groups.candidate_max_scores(rows, scores)
+        else:
+            movies = self.chunk_groups.movies
+            scores = self.chunk_groups.max_scores(scores)
+        return RankedList(
+            [self.documents[movie_id]["id"] for movie_id in movies],
+            scores,
+            tiebreak=movies,
+            depth=depth,
+            scores=[round(score, SCORE_PRECISION) for score in scores.tolist()],
+        )
+
+    def __chunk_results(self, results):
         return [
             {
                 "id": self.documents[movie_id]["id"],
@@ -172,7 +385,7 @@ class ChunkedSemanticSearch(SemanticSearch):
 
 def verify_model():
     ss = SemanticSearch()
-    print(f"Model loaded {ss.model}")
+    print(f"Model loaded {ss.model.get()}")
     print(f"Max sequence length: {ss.model.max_seq_length}")
 
 
@@ -192,6 +405,9 @@ def verify_embeddings():
     print(
         f"Embeddings shape: {ss.embeddings.shape[0]} vectors in {ss.embeddings.shape[1]} dimensions"
     )
+    print(
+        f"Embedding cache:  {ss.embedding_cache.hits} hits, {ss.embedding_cache.misses} misses"
+    )
 
 
 def embed_query_text(query):
@@ -202,11 +418,11 @@ def embed_query_text(query):
     print(f"Shape: {embedding.shape}")
 
 
-def search(query, limit=5):
-    ss = SemanticSearch()
+def search(query, limit=5, precision="float32", rescore=RESCORE_OVERSAMPLING):
+    ss = SemanticSearch(precision)
     movies = load_movies()
     ss.load_or_create_embeddings(movies)
-    results = ss.search(query, limit)
+    results = ss.search(query, limit, rescore)
     for idx, result in enumerate(results, 1):
         print(
             f"{idx}. {result['title']} (score: {result['score']:.4f})\n{result['description'][:200]}...\n"
@@ -260,18 +476,29 @@ def chunking_semantic(text: str, max_chunk_size: int, overlap: int) -> list[str]
     return chunks
 
 
-def embed_chunks():
-    css = ChunkedSemanticSearch()
+def embed_chunks(workers=1):
+    css = ChunkedSemanticSearch(workers=workers)
     movies = load_movies()
     css.load_or_create_chunk_embeddings(movies)
     print(f"Generated {len(css.chunk_embeddings)} chunked embeddings")
+    print(
+        f"Embedding cache: {css.embedding_cache.hits} hits, {css.embedding_cache.misses} misses"
+    )
 
 
-def search_chunked(query, limit=5):
-    css = ChunkedSemanticSearch()
+def search_chunked(
+    query,
+    limit=5,
+    strategy="exact",
+    nprobe=IVF_DEFAULT_NPROBE,
+    candidates=BINARY_DEFAULT_CANDIDATES,
+    precision="float32",
+    rescore=RESCORE_OVERSAMPLING,
+):
+    css = ChunkedSemanticSearch(precision)
     movies = load_movies()
     css.load_or_create_chunk_embeddings(movies)
-    results = css.search_chunks(query, limit)
+    results = css.search_chunks(query, limit, strategy, nprobe, candidates, rescore)
     for idx, result in enumerate(results, 1):
         print(f'{idx}. {result["title"]} (score: {result["score"]:.4f})')
         print(f"{result['document'][:200]}...\n")
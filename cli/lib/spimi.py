@@ -0,0 +1,227 @@
+import heapq
+import json
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+
+import numpy as np
+
+from .analyzer import get_analyzer
+from .index_arrays import (
+    BLOCK_MAX_TFS_FILE,
+    BLOCK_MIN_LENGTHS_FILE,
+    BLOCK_OFFSETS_FILE,
+    DOC_IDS_FILE,
+    DOC_LENGTHS_FILE,
+    DOCS_FILE,
+    DOCS_OFFSETS_FILE,
+    OFFSETS_FILE,
+    POSTINGS_BLOCK_SIZE,
+    POSTINGS_DOCS_FILE,
+    POSTINGS_TFS_FILE,
+    TERMS_FILE,
+)
+
+# rough in-memory cost of the block dictionary, used to decide when to flush a run
+POSTING_BYTES = 8
+TERM_OVERHEAD_BYTES = 250
+
+RUN_TERM_HEADER = struct.Struct("<II")
+
+
+class SpimiBuilder:
+    # Single-pass in-memory indexing: postings are collected per term until the memory budget
+    # is hit, then written out as a term-sorted run. finish() k-way merges the runs into the
+    # array index files, so only one block of postings is ever held in memory. Per document
+    # bookkeeping (ids, lengths, doc offsets) is ~20 bytes and kept in compact arrays.
+    def __init__(self, path: str, memory_budget_mb: float) -> None:
+        self.path = path
+        self.budget_bytes = int(memory_budget_mb * 1024**2)
+        os.makedirs(path, exist_ok=True)
+        self.runs_dir = tempfile.mkdtemp(prefix="spimi-", dir=path)
+        self.runs: list[str] = []
+        self.num_postings = 0
+
+        self.block: dict[str, tuple[array, array]] = {}
+        self.block_bytes = 0
+
+        self.doc_ids = array("q")
+        self.doc_lengths = array("i")
+        self.docs_offsets = array("q", [0])
+        self.docs_file = open(os.path.join(self.runs_dir, DOCS_FILE), "wb")
+
+    def add(self, movie: dict) -> None:
+        dense_idx = len(self.doc_ids)
+        tokens = get_analyzer().tokenize(f"{movie['title']} {movie['description']}")
+        counts: dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+
+        for token, count in counts.items():
+            postings = self.block.get(token)
+            if postings is None:
+                postings = self.block[token] = (array("i"), array("i"))
+                self.block_bytes += TERM_OVERHEAD_BYTES + len(token)
+            postings[0].append(dense_idx)
+            postings[1].append(count)
+        self.block_bytes += POSTING_BYTES * len(counts)
+
+        self.doc_ids.append(movie["id"])
+        self.doc_lengths.append(len(tokens))
+        line = json.dumps(movie).encode() + b"\n"
+        self.docs_file.write(line)
+        self.docs_offsets.append(self.docs_offsets[-1] + len(line))
+
+        if self.block_bytes >= self.budget_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.block:
+            return
+        run_path = os.path.join(self.runs_dir, f"run-{len(self.runs):05d}.bin")
+        with open(run_path, "wb") as f:
+            for term in sorted(self.block):
+                docs, tfs = self.block[term]
+                encoded = term.encode()
+                f.write(RUN_TERM_HEADER.pack(len(encoded), len(docs)))
+                f.write(encoded)
+                f.write(docs.tobytes())
+                f.write(tfs.tobytes())
+                self.num_postings += len(docs)
+        self.runs.append(run_path)
+        self.block = {}
+        self.block_bytes = 0
+
+    def finish(self) -> None:
+        self.flush()
+        self.docs_file.close()
+
+        doc_ids = np.frombuffer(self.doc_ids, dtype=np.int64)
+        doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.int32)
+        # dense indexes have to follow sorted doc ids, streams that aren't sorted get remapped
+        rank = None
+        if np.any(doc_ids[1:] < doc_ids[:-1]):
+            order = np.argsort(doc_ids, kind="stable")
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order))
+            doc_ids, doc_lengths = doc_ids[order], doc_lengths[order]
+            self.__write_sorted_docs(order)
+        else:
+            shutil.move(
+                os.path.join(self.runs_dir, DOCS_FILE),
+                os.path.join(self.path, DOCS_FILE),
+            )
+            np.save(
+                os.path.join(self.path, DOCS_OFFSETS_FILE),
+                np.frombuffer(self.docs_offsets, dtype=np.int64),
+            )
+        np.save(os.path.join(self.path, DOC_IDS_FILE), doc_ids)
+        np.save(os.path.join(self.path, DOC_LENGTHS_FILE), doc_lengths)
+
+        self.__merge_runs(doc_lengths, rank)
+        shutil.rmtree(self.runs_dir, ignore_errors=True)
+
+    def __write_sorted_docs(self, order: np.ndarray) -> None:
+        offsets = np.frombuffer(self.docs_offsets, dtype=np.int64)
+        sorted_offsets = np.zeros(len(offsets), dtype=np.int64)
+        with (
+            open(os.path.join(self.runs_dir, DOCS_FILE), "rb") as src,
+            open(os.path.join(self.path, DOCS_FILE), "wb") as dst,
+        ):
+            for i, dense_idx in enumerate(order.tolist()):
+                src.seek(offsets[dense_idx])
+                line = src.read(offsets[dense_idx + 1] - offsets[dense_idx])
+                dst.write(line)
+                sorted_offsets[i + 1] = sorted_offsets[i] + len(line)
+        np.save(os.path.join(self.path, DOCS_OFFSETS_FILE), sorted_offsets)
+
+    def __merge_runs(self, doc_lengths: np.ndarray, rank: np.ndarray | None) -> None:
+        self.postings_docs = self.__open_output(POSTINGS_DOCS_FILE, self.num_postings)
+        self.postings_tfs = self.__open_output(POSTINGS_TFS_FILE, self.num_postings)
+        self.terms, self.offsets = [], [0]
+        self.block_counts, self.block_max_tfs, self.block_min_lengths = [0], [], []
+
+        # runs hold increasing dense ranges, so per term the runs concatenate in doc order
+        merged = heapq.merge(
+            *[read_run(run_path, run_idx) for run_idx, run_path in enumerate(self.runs)]
+        )
+        current, parts = None, []
+        for term, _, docs, tfs in merged:
+            if term != current and parts:
+                self.__write_term(current, parts, doc_lengths, rank)
+                parts = []
+            current = term
+            parts.append((docs, tfs))
+        if parts:
+            self.__write_term(current, parts, doc_lengths, rank)
+
+        if isinstance(self.postings_docs, np.memmap):
+            self.postings_docs.flush()
+            self.postings_tfs.flush()
+        else:
+            np.save(os.path.join(self.path, POSTINGS_DOCS_FILE), self.postings_docs)
+            np.save(os.path.join(self.path, POSTINGS_TFS_FILE), self.postings_tfs)
+        del self.postings_docs, self.postings_tfs
+
+        np.save(os.path.join(self.path, TERMS_FILE), np.array(self.terms, dtype=str))
+        np.save(
+            os.path.join(self.path, OFFSETS_FILE),
+            np.array(self.offsets, dtype=np.int64),
+        )
+        np.save(
+            os.path.join(self.path, BLOCK_OFFSETS_FILE),
+            np.cumsum(self.block_counts, dtype=np.int64),
+        )
+        np.save(
+            os.path.join(self.path, BLOCK_MAX_TFS_FILE),
+            np.concatenate(self.block_max_tfs + [np.empty(0, dtype=np.int32)]),
+        )
+        np.save(
+            os.path.join(self.path, BLOCK_MIN_LENGTHS_FILE),
+            np.concatenate(self.block_min_lengths + [np.empty(0, dtype=np.int32)]),
+        )
+
+    def __open_output(self, name: str, length: int) -> np.ndarray:
+        # written in place through a memmap, empty files can't be mapped
+        if length == 0:
+            return np.empty(0, dtype=np.int32)
+        return np.lib.format.open_memmap(
+            os.path.join(self.path, name), mode="w+", dtype=np.int32, shape=(length,)
+        )
+
+    def __write_term(self, term, parts, doc_lengths, rank) -> None:
+        docs = np.concatenate([docs for docs, _ in parts])
+        tfs = np.concatenate([tfs for _, tfs in parts])
+        if rank is not None:
+            docs = rank[docs].astype(np.int32)
+            order = np.argsort(docs, kind="stable")
+            docs, tfs = docs[order], tfs[order]
+
+        start = self.offsets[-1]
+        self.postings_docs[start : start + len(docs)] = docs
+        self.postings_tfs[start : start + len(docs)] = tfs
+        self.terms.append(term)
+        self.offsets.append(start + len(docs))
+
+        block_starts = np.arange(0, len(docs), POSTINGS_BLOCK_SIZE)
+        self.block_counts.append(len(block_starts))
+        self.block_max_tfs.append(
+            np.maximum.reduceat(tfs, block_starts).astype(np.int32)
+        )
+        self.block_min_lengths.append(
+            np.minimum.reduceat(doc_lengths[docs], block_starts).astype(np.int32)
+        )
+
+
+def read_run(run_path: str, run_idx: int = 0):
+    # yields (term, run_idx, docs, tfs) in term order from a run written by SpimiBuilder.flush,
+    # run_idx breaks ties so the k-way merge never compares arrays
+    with open(run_path, "rb") as f:
+        while header := f.read(RUN_TERM_HEADER.size):
+            term_length, count = RUN_TERM_HEADER.unpack(header)
+            term = f.read(term_length).decode()
+            docs = np.frombuffer(f.read(4 * count), dtype=np.int32)
+            tfs = np.frombuffer(f.read(4 * count), dtype=np.int32)
+            yield term, run_idx, docs, tfs
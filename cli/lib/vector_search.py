@@ -0,0 +1,120 @@
+import numpy as np
+
+from .bm25 import select_top_k, select_top_k_rows
+
+# quantized searches rescore this many times limit of their best rows in full precision
+RESCORE_OVERSAMPLING = 4
+
+
+def normalize_rows(embeddings) -> np.ndarray:
+    # unit length rows so a dot product is the cosine similarity, zero rows stay zero and score 0
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.where(norms == 0, 1, norms)
+
+
+class ChunkGroups:
+    # Chunks grouped by the movie they came from, so the best chunk of every movie is a single
+    # maximum.reduceat over the chunk scores. movies[g] is the movie index of group g.
+    def __init__(self, chunk_movies) -> None:
+        chunk_movies = np.asarray(chunk_movies, dtype=np.int64)
+        self.chunk_movies = chunk_movies
+        # chunks are built movie after movie, only reorder when the metadata says otherwise
+        self.order = None
+        if np.any(np.diff(chunk_movies) < 0):
+            self.order = np.argsort(chunk_movies, kind="stable")
+            chunk_movies = chunk_movies[self.order]
+        self.starts = np.flatnonzero(np.diff(chunk_movies, prepend=-1))
+        self.movies = chunk_movies[self.starts]
+
+    def max_scores(self, chunk_scores: np.ndarray) -> np.ndarray:
+        # chunk_scores may be (chunks, queries), every column is grouped the same way
+        if self.order is not None:
+            chunk_scores = chunk_scores[self.order]
+        return np.maximum.reduceat(chunk_scores, self.starts, axis=0)
+
+    def candidate_max_scores(
+        self, rows: np.ndarray, scores: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # best score per movie among some of the chunks, for searches that only score candidates
+        movies = self.chunk_movies[rows]
+        order = np.argsort(movies, kind="stable")
+        movies = movies[order]
+        starts = np.flatnonzero(np.diff(movies, prepend=-1))
+        return movies[starts], np.maximum.reduceat(scores[order], starts)
+
+
+def rescore_rows(
+    full_embeddings: np.ndarray,
+    query_embedding: np.ndarray,
+    rows: np.ndarray,
+    scores: np.ndarray,
+    num_candidates: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    # exact cosine similarity of the num_candidates rows with the best approximate scores
+    if len(rows) > num_candidates:
+        best = np.argpartition(scores, -num_candidates)[-num_candidates:]
+        rows = np.sort(rows[best])
+    return rows, normalize_rows(full_embeddings[rows]) @ query_embedding
+
+
+def top_k_rows(
+    embeddings: np.ndarray,
+    query_embedding,
+    limit: int,
+    full_embeddings: np.ndarray | None = None,
+    rescore: int = RESCORE_OVERSAMPLING,
+) -> list[tuple[int, float]]:
+    # (row, cosine similarity) of the closest rows of a normalized embedding matrix, with
+    # full_embeddings the best limit * rescore rows of a quantized matrix are scored again
+    query_embedding = normalize_rows(query_embedding)
+    scores = embeddings @ query_embedding
+    rows = np.arange(len(scores))
+    if full_embeddings is not None and rescore > 0:
+        rows, scores = rescore_rows(
+            full_embeddings, query_embedding, rows, scores, limit * rescore
+        )
+    return select_top_k(rows, scores, limit)
+
+
+def top_k_movies(
+    chunk_embeddings: np.ndarray,
+    groups: ChunkGroups,
+    query_embedding,
+    limit: int,
+    rows: np.ndarray | None = None,
+    full_embeddings: np.ndarray | None = None,
+    rescore: int = RESCORE_OVERSAMPLING,
+) -> list[tuple[int, float]]:
+    # (movie index, best chunk similarity) of the closest movies, only looking at the given
+    # chunk rows when an approximate search picked candidates. With full_embeddings the best
+    # limit * rescore chunks of a quantized matrix are scored again.
+    query_embedding = normalize_rows(query_embedding)
+    rescoring = full_embeddings is not None and rescore > 0
+    if rows is None and not rescoring:
+        scores = groups.max_scores(chunk_embeddings @ query_embedding)
+        return select_top_k(groups.movies, scores, limit)
+    if rows is None:
+        scores = chunk_embeddings @ query_embedding
+        rows = np.arange(len(scores))
+    else:
+        scores = chunk_embeddings[rows] @ query_embedding
+    if rescoring:
+        rows, scores = rescore_rows(
+            full_embeddings, query_embedding, rows, scores, limit * rescore
+        )
+    movies, scores = groups.candidate_max_scores(rows, scores)
+    return select_top_k(movies, scores, limit)
+
+
+def top_k_movies_many(
+    chunk_embeddings: np.ndarray,
+    groups: ChunkGroups,
+    query_embeddings,
+    limit: int,
+) -> list[list[tuple[int, float]]]:
+    # top_k_movies of every query, the chunks are scored against all of them in one
+    # (chunks, queries) matrix product and the best movies picked row by row
+    query_embeddings = normalize_rows(query_embeddings)
+    scores = groups.max_scores(chunk_embeddings @ query_embeddings.T)
+    return select_top_k_rows(groups.movies, np.ascontiguousarray(scores.T), limit)
@@ -1,6 +1,8 @@
 import argparse
 
 from lib.multimodal_search import verify_image_embedding, image_search_command
+from lib.quantization import EMBEDDING_PRECISIONS
+from lib.vector_search import RESCORE_OVERSAMPLING
 
 
 def main():
@@ -17,6 +19,24 @@ def main():
         help="search for documents using image as an input image",
     )
     image_search_parser.add_argument("image", type=str, help="Path to image")
+    image_search_parser.add_argument(
+        "--precision",
+        choices=EMBEDDING_PRECISIONS,
+        default="float32",
+        help="Search the movie text embeddings in float32, or memory-mapped float16 / int8 copies of them (created on first use)",
+    )
+    image_search_parser.add_argument(
+        "--rescore",
+        type=int,
+        default=RESCORE_OVERSAMPLING,
+        help=f"Rescore 5 * N of the best quantized candidates in float32, 0 to skip (default {RESCORE_OVERSAMPLING})",
+    )
+    image_search_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to encode the movie texts with when they changed, each loads its own model (default 1)",
+    )
 
     args = parser.parse_args()
 
@@ -24,7 +44,7 @@ def main():
         case "verify_image_embedding":
             verify_image_embedding(args.image)
         case "image_search":
-            image_search_command(args.image)
+            image_search_command(args.image, args.precision, args.rescore, args.workers)
         case _:
             parser.print_help()
 
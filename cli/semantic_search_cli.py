@@ -2,7 +2,11 @@
 
 import argparse
 
+from lib.binary_codes import BINARY_DEFAULT_CANDIDATES
+from lib.ivf_index import IVF_DEFAULT_NPROBE
+from lib.quantization import EMBEDDING_PRECISIONS
 from lib.semantic_search import (
+    SEARCH_STRATEGIES,
     verify_model,
     embed_text,
     verify_embeddings,
@@ -13,6 +17,22 @@ from lib.semantic_search import (
     embed_chunks,
     search_chunked,
 )
+from lib.vector_search import RESCORE_OVERSAMPLING
+
+
+def add_precision_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--precision",
+        choices=EMBEDDING_PRECISIONS,
+        default="float32",
+        help="Search float32 embeddings, or memory-mapped float16 / int8 copies of them (created on first use)",
+    )
+    parser.add_argument(
+        "--rescore",
+        type=int,
+        default=RESCORE_OVERSAMPLING,
+        help=f"Rescore limit * N of the best quantized candidates in float32, 0 to skip (default {RESCORE_OVERSAMPLING})",
+    )
 
 
 def main():
@@ -43,6 +63,7 @@ def main():
     search_parser.add_argument(
         "--limit", type=int, default=5, help="Number of results to return"
     )
+    add_precision_arguments(search_parser)
 
     search_parser = subparsers.add_parser(
         "chunk",
@@ -69,10 +90,16 @@ def main():
         "--overlap", default=0, type=int, help="amount of sentences to overlap"
     )
 
-    subparsers.add_parser(
+    embed_chunks_parser = subparsers.add_parser(
         "embed_chunks",
         help="chunks the moviedescriptions using semantic chunking, embeds them and caches the embeddings and metadata for fast document lookups",
     )
+    embed_chunks_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to encode the chunks with, each loads its own model (default 1)",
+    )
 
     search_parser = subparsers.add_parser(
         "search_chunked",
@@ -82,6 +109,25 @@ def main():
     search_parser.add_argument(
         "--limit", type=int, default=5, help="Number of results to return"
     )
+    search_parser.add_argument(
+        "--strategy",
+        choices=SEARCH_STRATEGIES,
+        default="exact",
+        help="exact scores every chunk, ivf only the closest lists of the ANN index, binary only the chunks with the closest sign bit codes (both built on first use)",
+    )
+    search_parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=IVF_DEFAULT_NPROBE,
+        help=f"ANN lists to search with --strategy ivf, higher is slower with better recall (default {IVF_DEFAULT_NPROBE})",
+    )
+    search_parser.add_argument(
+        "--candidates",
+        type=int,
+        default=BINARY_DEFAULT_CANDIDATES,
+        help=f"Chunks the hamming prefilter keeps for exact scoring with --strategy binary (default {BINARY_DEFAULT_CANDIDATES})",
+    )
+    add_precision_arguments(search_parser)
 
     args = parser.parse_args()
 
@@ -95,7 +141,7 @@ def main():
         case "embed_query":
             embed_query_text(args.query)
         case "search":
-            search(args.query, args.limit)
+            search(args.query, args.limit, args.precision, args.rescore)
         case "chunk":
             chunks = chunking_fixed(args.text, args.chunk_sizes, args.overlap)
             print(f"Chunking {len(args.text)} characters")
@@ -107,9 +153,17 @@ def main():
             for idx, c in enumerate(chunks, 1):
                 print(f"{idx}. {c}")
         case "embed_chunks":
-            embed_chunks()
+            embed_chunks(args.workers)
         case "search_chunked":
-            search_chunked(args.query, args.limit)
+            search_chunked(
+                args.query,
+                args.limit,
+                args.strategy,
+                args.nprobe,
+                args.candidates,
+                args.precision,
+                args.rescore,
+            )
         case _:
             parser.print_help()
 